@@ -0,0 +1,74 @@
+"""
+サーバーごとの管理者メンバーの索引
+
+/secret_role の一時チャンネルから管理者を締め出すために、
+毎回 guild.members を全員調べる代わりに管理者だけを覚えておく。
+メンバー・ロール・サーバーの更新イベントで最新の状態に保つ。
+
+メンバーのイベント（Server Members Intent）を受け取らない場合や、起動時に全員を読み込まない場合は、
+最初に作った時のキャッシュには一部のメンバーしかいない。その後にキャッシュに加わったメンバー
+（VCへの出入り、VC参加者の取得）も update_member で索引に加える。
+"""
+
+
+class AdminIndex:
+    """
+    サーバーID → 管理者権限を持つ（Botでない）メンバーIDの集合
+    """
+
+    def __init__(self):
+        self._admins = {}
+        self.metrics = {'builds': 0, 'member_updates': 0}
+
+    def __len__(self):
+        return len(self._admins)
+
+    def admin_ids(self, guild):
+        """
+        サーバーの管理者メンバーIDの集合（未構築ならここで構築）
+        """
+        admins = self._admins.get(guild.id)
+        if admins is None:
+            admins = self.build(guild)
+        return admins
+
+    def build(self, guild):
+        """
+        サーバーの全メンバーを調べて索引を作り直す（O(メンバー数)）
+        """
+        admins = {member.id for member in guild.members if _is_admin(member)}
+        self._admins[guild.id] = admins
+        self.metrics['builds'] += 1
+        return admins
+
+    def update_member(self, member):
+        """
+        1人分の管理者状態を反映する（ロールの付け外し・参加時）
+        """
+        admins = self._admins.get(member.guild.id)
+        if admins is None:
+            return
+        self.metrics['member_updates'] += 1
+        if _is_admin(member):
+            admins.add(member.id)
+        else:
+            admins.discard(member.id)
+
+    def remove_member(self, guild_id, member_id):
+        admins = self._admins.get(guild_id)
+        if admins is not None:
+            admins.discard(member_id)
+
+    def invalidate(self, guild_id):
+        """
+        ロールの権限変更など、誰が管理者か一度に変わりうる場合は次回に作り直す
+        """
+        self._admins.pop(guild_id, None)
+
+
+def _is_admin(member):
+    return not member.bot and member.guild_permissions.administrator
+
+
+def role_grants_admin(role):
+    return role.permissions.administrator
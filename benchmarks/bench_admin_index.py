@@ -0,0 +1,87 @@
+"""
+/secret_role の管理者除外の権限設定作成コストのベンチマーク
+
+大規模サーバーを模したメンバー一覧で、
+- 旧方式: 毎回 guild.members を全員調べる
+- 新方式: AdminIndex から管理者だけを取り出す
+を比較する。
+
+使い方:
+    python benchmarks/bench_admin_index.py [--members 100000] [--admins 50]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admin_index import AdminIndex  # noqa: E402
+
+
+def make_guild(n_members, n_admins, rng):
+    admin_ids = set(rng.sample(range(n_members), n_admins))
+    guild = SimpleNamespace(id=1, members=[])
+    for member_id in range(n_members):
+        guild.members.append(SimpleNamespace(
+            id=member_id,
+            bot=member_id % 500 == 0,
+            guild=guild,
+            guild_permissions=SimpleNamespace(administrator=member_id in admin_ids)
+        ))
+    return guild
+
+
+def legacy_overwrites(guild, vc_member_ids):
+    overwrites = {}
+    for member in guild.members:
+        if member.guild_permissions.administrator and member.id not in vc_member_ids and not member.bot:
+            overwrites[member.id] = False
+    return overwrites
+
+
+def indexed_overwrites(index, guild, vc_member_ids):
+    overwrites = {}
+    for admin_id in index.admin_ids(guild):
+        if admin_id not in vc_member_ids:
+            overwrites[admin_id] = False
+    return overwrites
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat * 1e6, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=100000)
+    parser.add_argument('--admins', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    guild = make_guild(args.members, args.admins, rng)
+    vc_member_ids = {member.id for member in rng.sample(guild.members, 5)}
+
+    index = AdminIndex()
+    build_us, _ = timed(lambda: index.build(guild), 1)
+    legacy_us, legacy = timed(lambda: legacy_overwrites(guild, vc_member_ids), args.repeat)
+    indexed_us, indexed = timed(lambda: indexed_overwrites(index, guild, vc_member_ids), args.repeat)
+    assert legacy.keys() == indexed.keys()
+
+    member = guild.members[123]
+    update_us, _ = timed(lambda: index.update_member(member), 10000)
+
+    print(f"メンバー数: {args.members}、管理者: {len(indexed)} 人")
+    print(f"索引の構築（起動時・ロール権限変更時のみ）: {build_us / 1e3:.1f} ms")
+    print(f"メンバー更新イベント1件の反映: {update_us:.2f} µs")
+    print(f"権限設定の作成 旧: {legacy_us / 1e3:.2f} ms / 新: {indexed_us:.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
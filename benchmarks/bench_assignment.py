@@ -0,0 +1,122 @@
+"""
+除外設定付きロール割り当てのベンチマーク
+
+旧実装（100回ランダム試行）と二部マッチングエンジンを、
+意地悪な除外パターンで比較する。
+
+使い方:
+    python benchmarks/bench_assignment.py [--trials 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import ROLES, assign_roles_with_exclusions  # noqa: E402
+from role_matching import count_assignments, roles_to_mask  # noqa: E402
+
+
+def legacy_assign_roles_with_exclusions(valid_assignments, all_roles):
+    """
+    置き換え前の実装（比較用にそのまま残している）
+    """
+    available_roles = random.sample(all_roles, len(valid_assignments))
+    sorted_assignments = sorted(valid_assignments, key=lambda x: len(x['available_roles']))
+
+    for attempt in range(100):
+        assignments = {}
+        used_roles = set()
+        success = True
+
+        current_available_roles = available_roles.copy()
+        random.shuffle(current_available_roles)
+        assignment_order = sorted_assignments.copy()
+        random.shuffle(assignment_order)
+
+        for player_data in assignment_order:
+            user = player_data['user']
+            available_for_user = [role for role in player_data['available_roles']
+                                  if role in current_available_roles and role not in used_roles]
+
+            if not available_for_user:
+                success = False
+                break
+
+            chosen_role = random.choice(available_for_user)
+            assignments[user] = chosen_role
+            used_roles.add(chosen_role)
+
+        if success and len(assignments) == len(valid_assignments):
+            return assignments
+
+        if attempt % 10 == 9:
+            available_roles = random.sample(all_roles, len(valid_assignments))
+
+    return None
+
+
+def make_players(allowed_lists):
+    return [
+        {'user': f"player{i}", 'available_roles': list(allowed), 'excluded_count': 0}
+        for i, allowed in enumerate(allowed_lists)
+    ]
+
+
+def chain_profile(roles):
+    # プレイヤー i は i番目と i+1番目のロールだけ可能、最後の1人は1つだけ（解は1通り）
+    n = len(roles)
+    allowed = [[roles[i], roles[i + 1]] for i in range(n - 1)] + [[roles[n - 1]]]
+    return allowed
+
+
+def profiles():
+    roles = list(ROLES.keys())
+    wide_roles = [f"r{i}" for i in range(12)]
+    return [
+        ('5人・除外なし', roles, [roles] * 5),
+        ('2人・それぞれ1ロールのみ', roles, [['top'], ['sup']]),
+        ('5人・鎖状（解1通り）', roles, chain_profile(roles)),
+        ('4人・2ロールずつ（解2通り）', roles,
+         [['top', 'jg'], ['jg', 'mid'], ['mid', 'adc'], ['adc', 'top']]),
+        ('5人・4人がtop/jgのみ（不可能）', roles,
+         [['top', 'jg'], ['top', 'jg'], ['top', 'jg'], roles, roles]),
+        ('12人・鎖状（解1通り）', wide_roles, chain_profile(wide_roles)),
+        ('8人/12ロール・3ロールずつ', wide_roles,
+         [[wide_roles[(i * 3 + k) % 12] for k in range(3)] for i in range(8)]),
+    ]
+
+
+def run(func, players, all_roles, trials):
+    failures = 0
+    start = time.perf_counter()
+    for _ in range(trials):
+        if func(players, all_roles) is None:
+            failures += 1
+    elapsed = time.perf_counter() - start
+    return elapsed / trials * 1e6, failures / trials
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=2000)
+    args = parser.parse_args()
+
+    header = f"{'プロファイル':<32} {'解の数':>8} {'旧: µs/回':>10} {'旧: 失敗率':>10} {'新: µs/回':>10} {'新: 失敗率':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, all_roles, allowed in profiles():
+        players = make_players(allowed)
+        role_index = {role: i for i, role in enumerate(all_roles)}
+        masks = [roles_to_mask(a, role_index) for a in allowed]
+        solutions = count_assignments(masks, len(all_roles))
+
+        legacy_us, legacy_fail = run(legacy_assign_roles_with_exclusions, players, all_roles, args.trials)
+        new_us, new_fail = run(assign_roles_with_exclusions, players, all_roles, args.trials)
+        print(f"{name:<32} {solutions:>8} {legacy_us:>10.1f} {legacy_fail:>10.1%} {new_us:>10.1f} {new_fail:>10.1%}")
+
+
+if __name__ == "__main__":
+    main()
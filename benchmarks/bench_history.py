@@ -0,0 +1,70 @@
+"""
+ロール履歴ストアのベンチマーク
+
+大量の履歴を書き込み、/stats が使う集計クエリの応答時間を測る。
+書き込み中のイベントループの遅延（record の呼び出し時間）も表示する。
+
+使い方:
+    python benchmarks/bench_history.py [--rows 1000000] [--db /tmp/bench_history.sqlite3]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_store import HistoryStore  # noqa: E402
+
+ROLE_KEYS = ['top', 'jg', 'mid', 'adc', 'sup']
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--guilds', type=int, default=100)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--db', default='/tmp/bench_history.sqlite3')
+    args = parser.parse_args()
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+
+    rng = random.Random(0)
+    store = HistoryStore(args.db, batch_size=5000)
+
+    # 5人1ゲームとして積む
+    slowest_record = 0.0
+    start = time.perf_counter()
+    for game in range(args.rows // 5):
+        guild_id = rng.randrange(args.guilds)
+        assignments = [(rng.randrange(args.users), role_key) for role_key in ROLE_KEYS]
+        t = time.perf_counter()
+        store.record(guild_id, 0, f"game_{game}", 'role', assignments)
+        slowest_record = max(slowest_record, time.perf_counter() - t)
+    queued = time.perf_counter() - start
+    store.flush()
+    written = time.perf_counter() - start
+    print(f"書き込み: {store.metrics['written']} 行 / {written:.1f} 秒 "
+          f"（積むだけなら {queued:.1f} 秒、record の最大 {slowest_record * 1e3:.2f} ms、{store.metrics['batches']} バッチ）")
+
+    timings = []
+    for _ in range(200):
+        t = time.perf_counter()
+        await store.role_frequency(rng.randrange(args.guilds), rng.randrange(args.users))
+        timings.append(time.perf_counter() - t)
+    timings.sort()
+    print(f"ユーザー別集計: p50 {timings[len(timings) // 2] * 1e3:.2f} ms / p99 {timings[int(len(timings) * 0.99)] * 1e3:.2f} ms")
+
+    t = time.perf_counter()
+    await store.guild_role_frequency(0)
+    print(f"サーバー全体の集計: {(time.perf_counter() - t) * 1e3:.2f} ms")
+
+    store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
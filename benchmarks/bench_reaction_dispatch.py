@@ -0,0 +1,110 @@
+"""
+リアクションイベント1件あたりの振り分けコストのベンチマーク
+
+同時進行セッション数を変えながら、
+- 旧方式: セッションごとに bot.wait_for のリスナーを登録し、discord.py の dispatch で全条件を評価
+- 新方式: ReactionRouter でメッセージIDから持ち主へ直接振り分け
+を比較する。
+
+使い方:
+    python benchmarks/bench_reaction_dispatch.py [--sessions 1000] [--events 20000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord  # noqa: E402
+from discord.ext import commands  # noqa: E402
+
+from reaction_router import ReactionEvent, ReactionRouter  # noqa: E402
+
+EMOJIS = ['1️⃣', '2️⃣', '3️⃣', '⚔️', '🌲', '❌', '▶️', '🎲']
+
+
+def listen(bot, event, check):
+    # wait_for はリスナーを同期的に登録するので、待機用のコルーチンは使わずに閉じる
+    bot.wait_for(event, check=check).close()
+
+
+def add_legacy_listeners(bot, message_id, kind):
+    # 置き換え前の各監視処理が登録していたリスナーを再現する
+    if kind == 'lottery':
+        listen(bot, 'reaction_add', lambda r, u: r.message.id == message_id and str(r.emoji) == '🎲' and not u.bot)
+    elif kind == 'secret':
+        numbers = {'1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣'}
+        listen(bot, 'reaction_add', lambda r, u: r.message.id == message_id and str(r.emoji) in numbers and not u.bot)
+    else:
+        # /exclude_role は1回の待機で5つのリスナーを作っていた
+        members = {1, 2, 3, 4, 5}
+        letters = {'⚔️', '🌲', '🪄', '🏹', '❤️'}
+        for event in ('reaction_add', 'reaction_remove'):
+            listen(bot, event, lambda r, u: r.message.id == message_id and u.id in members and str(r.emoji) in letters)
+            listen(bot, event, lambda r, u: r.message.id == message_id and u.id in members and str(r.emoji) == '❌')
+        listen(bot, 'reaction_add', lambda r, u: r.message.id == message_id and str(r.emoji) == '▶️' and u.id in members)
+
+
+async def bench_legacy(n_sessions, n_events, rng):
+    bot = commands.Bot(command_prefix='!', intents=discord.Intents.default())
+    # ログインせずに wait_for を使うため、イベントループだけ設定する
+    bot.loop = asyncio.get_running_loop()
+    kinds = ['lottery', 'secret', 'exclude']
+    for message_id in range(n_sessions):
+        add_legacy_listeners(bot, message_id, kinds[message_id % 3])
+
+    # どのセッションの条件にも当たらないイベント（＝全リスナーの条件を評価する）で計測
+    user = SimpleNamespace(id=999, bot=False)
+    reactions = [
+        SimpleNamespace(message=SimpleNamespace(id=n_sessions + rng.randrange(n_sessions)), emoji=rng.choice(EMOJIS))
+        for _ in range(n_events)
+    ]
+    start = time.perf_counter()
+    for reaction in reactions:
+        bot.dispatch('reaction_add', reaction, user)
+    elapsed = time.perf_counter() - start
+    listeners = sum(len(v) for v in bot._listeners.values())
+    return elapsed / n_events * 1e6, listeners
+
+
+async def bench_router(n_sessions, n_events, rng):
+    router = ReactionRouter()
+    received = [0]
+
+    def handler(event):
+        received[0] += 1
+
+    for message_id in range(n_sessions):
+        router.register(message_id, handler)
+
+    events = [
+        (rng.randrange(n_sessions * 2), ReactionEvent(rng.choice(EMOJIS), 999, None, True))
+        for _ in range(n_events)
+    ]
+    start = time.perf_counter()
+    for message_id, event in events:
+        router.dispatch(message_id, event)
+    elapsed = time.perf_counter() - start
+    return elapsed / n_events * 1e6, len(router)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=20000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'セッション数':>10} {'旧: リスナー数':>14} {'旧: µs/イベント':>16} {'新: µs/イベント':>16}")
+    for n_sessions in sorted({10, 100, args.sessions}):
+        legacy_us, listeners = await bench_legacy(n_sessions, args.events, rng)
+        router_us, _ = await bench_router(n_sessions, args.events, rng)
+        print(f"{n_sessions:>10} {listeners:>14} {legacy_us:>16.2f} {router_us:>16.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
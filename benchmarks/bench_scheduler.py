@@ -0,0 +1,61 @@
+"""
+セッションのタイムアウト用タイマーのベンチマーク
+
+進行中のセッションが多数ある状態で、リアクションのたびにタイムアウトを
+張り直す（登録して取り消す）コストを
+- 旧方式: loop.call_later（イベントループのヒープ）
+- 新方式: TimerWheel（タイマーホイール）
+で比較する。
+
+使い方:
+    python benchmarks/bench_scheduler.py [--sessions 1000 10000 100000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import TimerWheel  # noqa: E402
+
+
+def noop():
+    pass
+
+
+def rearm_cost(timers, sessions, rearms):
+    # 各セッションが5分のタイムアウトを持っている状態にする
+    handles = [timers.call_later(300.0, noop) for _ in range(sessions)]
+    start = time.perf_counter()
+    for i in range(rearms):
+        index = i % sessions
+        handles[index].cancel()
+        handles[index] = timers.call_later(300.0, noop)
+    elapsed = time.perf_counter() - start
+    for handle in handles:
+        handle.cancel()
+    return elapsed / rearms * 1e6
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--rearms', type=int, default=200000)
+    args = parser.parse_args()
+
+    loop = asyncio.get_running_loop()
+    print(f"{'セッション数':>10} {'旧: µs/張り直し':>16} {'新: µs/張り直し':>16}")
+    for sessions in args.sessions:
+        legacy = rearm_cost(loop, sessions, args.rearms)
+        # 取り消したタイマーがヒープに残っている分を掃除させる
+        await asyncio.sleep(0)
+        wheel = TimerWheel()
+        wheeled = rearm_cost(wheel, sessions, args.rearms)
+        wheel.stop()
+        print(f"{sessions:>10} {legacy:>16.2f} {wheeled:>16.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+"""
+セッション状態のメモリのベンチマーク
+
+進行中のセッションを大量に（既定 10000 件）持った時のメモリを
+- 旧方式: 辞書のセッション、除外設定は ユーザーID → {'user': Member, 'excluded_roles': set, 'participating': bool}、
+  /secret_role は role_mapping の辞書と selected_roles の set
+- 新方式: session_state の __slots__ 付きオブジェクト（ユーザーIDとロールのビットマスク）
+で比較する。メンバーはどちらの方式でも Discord のキャッシュと共有するので、測定の前に作っておく。
+あわせて、抽選時に除外設定から担当可能ロールのビットマスクを作る時間も比較する。
+
+使い方:
+    python benchmarks/bench_session_memory.py [--sessions 10000] [--players 5]
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from role_matching import roles_to_mask  # noqa: E402
+from session_state import ExclusionSession, SecretSession  # noqa: E402
+
+ROLES = ['top', 'jg', 'mid', 'adc', 'sup']
+ROLE_INDEX = {role: i for i, role in enumerate(ROLES)}
+ALL_ROLES_MASK = (1 << len(ROLES)) - 1
+NUMBER_EMOJIS = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣']
+
+
+def make_inputs(rng, n_sessions, n_players):
+    """
+    セッションごとの (メンバー, 各自の除外ロール, 不参加か, /secret_role の数字 → ロール)
+    """
+    inputs = []
+    for number in range(n_sessions):
+        members = [SimpleNamespace(id=number * 100 + p, display_name=f"player{number}-{p}") for p in range(n_players)]
+        excluded = [rng.sample(ROLES, rng.randint(0, 2)) for _ in members]
+        absent = [rng.random() < 0.1 for _ in members]
+        shuffled = rng.sample(ROLES, len(ROLES))
+        inputs.append((members, excluded, absent, dict(zip(NUMBER_EMOJIS, shuffled))))
+    return inputs
+
+
+def build_old(inputs):
+    exclusion_sessions, user_role_exclusions, secret_sessions = [], [], []
+    for number, (members, excluded, absent, role_mapping) in enumerate(inputs):
+        exclusion_sessions.append({
+            'session_id': f"channel_{number}",
+            'channel': None,
+            'members': {member.id: member for member in members},
+            'executed': False,
+            'last_activity': 0.0,
+            'inbox': None,
+            'view': None,
+            'trace': None,
+            'team_mode': False,
+            'ratings': {}
+        })
+        entries = {}
+        for member, roles, is_absent in zip(members, excluded, absent):
+            if roles or is_absent:
+                entries[member.id] = {'user': member, 'excluded_roles': set(roles), 'participating': not is_absent}
+        user_role_exclusions.append(entries)
+        picks = [(member, role) for member, role in zip(members, role_mapping.values())]
+        secret_sessions.append({
+            'embed': None,
+            'role_mapping': dict(role_mapping),
+            'selected_roles': set(role_mapping.values()),
+            'picks': picks,
+            'picked_users': {member.id: role for member, role in picks},
+            'warnings': {},
+            'status': None,
+            'closed': False,
+            'inbox': None,
+            'status_message': None
+        })
+    return exclusion_sessions, user_role_exclusions, secret_sessions
+
+
+def build_new(inputs):
+    exclusion_sessions, user_role_exclusions, secret_sessions = [], [], []
+    for number, (members, excluded, absent, role_mapping) in enumerate(inputs):
+        session = ExclusionSession(f"channel_{number}", None, [member.id for member in members], 0.0, None)
+        exclusion_sessions.append(session)
+        settings = session.settings
+        for member, roles, is_absent in zip(members, excluded, absent):
+            for role in roles:
+                settings.set_excluded(member.id, ROLE_INDEX[role], True)
+            if is_absent:
+                settings.set_participating(member.id, False)
+        user_role_exclusions.append(settings)
+        session = SecretSession(None, {emoji: (ROLE_INDEX[role], role) for emoji, role in role_mapping.items()})
+        for member, (role_number, role) in zip(members, session.role_mapping.values()):
+            session.selected |= 1 << role_number
+            session.picks.append((member.id, member.display_name, role))
+        secret_sessions.append(session)
+    return exclusion_sessions, user_role_exclusions, secret_sessions
+
+
+def old_allowed_masks(members, entries):
+    # 旧方式: 除外ロールの set から担当可能ロールのリストを作り、ビットマスクに変換する
+    masks = []
+    for member in members:
+        entry = entries.get(member.id)
+        if entry is not None and not entry['participating']:
+            continue
+        excluded_roles = entry['excluded_roles'] if entry is not None else set()
+        available_roles = [role for role in ROLES if role not in excluded_roles]
+        masks.append(roles_to_mask(available_roles, ROLE_INDEX))
+    return masks
+
+
+def new_allowed_masks(members, settings):
+    return [
+        ALL_ROLES_MASK & ~settings.excluded_mask(member.id)
+        for member in members if settings.is_participating(member.id)
+    ]
+
+
+def measure_memory(build, inputs):
+    gc.collect()
+    tracemalloc.start()
+    state = build(inputs)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return state, current
+
+
+def measure_conversion(func, inputs, exclusions, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        results = [func(members, entries) for (members, *_), entries in zip(inputs, exclusions)]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return results, best / len(inputs) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--players', type=int, default=5)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    inputs = make_inputs(random.Random(args.seed), args.sessions, args.players)
+    old_state, old_bytes = measure_memory(build_old, inputs)
+    new_state, new_bytes = measure_memory(build_new, inputs)
+    old_masks, old_us = measure_conversion(old_allowed_masks, inputs, old_state[1], args.repeats)
+    new_masks, new_us = measure_conversion(new_allowed_masks, inputs, new_state[1], args.repeats)
+
+    print(f"{args.sessions} セッション（各 {args.players} 人、除外セッションと /secret_role を1つずつ）")
+    print(f"{'方式':<8} {'合計 MB':>9} {'バイト/セッション':>16} {'変換 µs/回':>12}")
+    for name, total, conversion in (('旧方式', old_bytes, old_us), ('新方式', new_bytes, new_us)):
+        print(f"{name:<8} {total / 2**20:>9.2f} {total / args.sessions:>16.0f} {conversion:>12.2f}")
+    print(f"\nメモリ: {new_bytes / old_bytes:.0%}、変換時間: {new_us / old_us:.0%}（旧方式比）")
+    # どちらも同じ担当可能ロールになっているか
+    mismatches = sum(1 for old, new in zip(old_masks, new_masks) if old != new)
+    print(f"担当可能ロールの不一致: {mismatches}/{args.sessions}")
+
+
+if __name__ == "__main__":
+    main()
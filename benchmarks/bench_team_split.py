@@ -0,0 +1,86 @@
+"""
+/team_role のチーム分けのベンチマーク
+
+10人の除外設定とレートから、両チームとも割り当て可能でレート差が最小の分け方を選ぶ処理を
+- 素朴な方法: 分け方ごとにチームのレート合計を足し、割り当て可否を二部マッチングで判定
+- 新方式: team_split.choose_split（5人組の表・部分集合のレート合計と割り当て可否の表を引く）
+で比較する。
+
+使い方:
+    python benchmarks/bench_team_split.py [--trials 200] [--max-excluded 2]
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from role_matching import FeasibilityIndex, is_feasible  # noqa: E402
+from team_split import choose_split  # noqa: E402
+
+N_ROLES = 5
+N_PLAYERS = 2 * N_ROLES
+
+
+def naive_best_difference(allowed_masks, ratings):
+    best = None
+    for team in itertools.combinations(range(N_PLAYERS), N_PLAYERS // 2):
+        if 0 not in team:
+            continue
+        other = [p for p in range(N_PLAYERS) if p not in team]
+        if not is_feasible([allowed_masks[p] for p in team], N_ROLES):
+            continue
+        if not is_feasible([allowed_masks[p] for p in other], N_ROLES):
+            continue
+        difference = abs(sum(ratings[p] for p in team) - sum(ratings[p] for p in other))
+        if best is None or difference < best:
+            best = difference
+    return best
+
+
+def make_profile(rng, max_excluded):
+    full = (1 << N_ROLES) - 1
+    masks = []
+    for _ in range(N_PLAYERS):
+        excluded = rng.sample(range(N_ROLES), rng.randint(0, max_excluded))
+        masks.append(full & ~sum(1 << r for r in excluded))
+    ratings = [rng.randint(800, 2400) for _ in range(N_PLAYERS)]
+    return masks, ratings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=200)
+    parser.add_argument('--max-excluded', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    profiles = [make_profile(rng, args.max_excluded) for _ in range(args.trials)]
+    index = FeasibilityIndex(N_ROLES)
+
+    start = time.perf_counter()
+    expected = [naive_best_difference(masks, ratings) for masks, ratings in profiles]
+    naive = (time.perf_counter() - start) / args.trials * 1e3
+
+    start = time.perf_counter()
+    splits = [choose_split(masks, index, ratings, rng) for masks, ratings in profiles]
+    fast = (time.perf_counter() - start) / args.trials * 1e3
+
+    # どちらも同じ最小のレート差を見つけているか
+    mismatches = sum(
+        1 for best, split in zip(expected, splits)
+        if (best is None) != (split is None) or (split is not None and split[2] != best)
+    )
+    infeasible = sum(1 for split in splits if split is None)
+    print(f"{'方式':<10} {'ms/回':>8}")
+    print(f"{'素朴':<10} {naive:>8.3f}")
+    print(f"{'新方式':<10} {fast:>8.3f}")
+    print(f"\n分けられない入力: {infeasible}/{args.trials}、結果の不一致: {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
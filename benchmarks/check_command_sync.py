@@ -0,0 +1,91 @@
+"""
+スラッシュコマンド同期の動作確認
+
+インストールされている discord.py（requirements.txt で固定した版を想定）で、
+- bot.py のコマンド定義のハッシュが計算でき、同じ定義なら同じ値になる
+- 1回目は同期し、定義が変わらなければ2回目は同期を省く
+- 定義を変えると再び同期する
+を確かめる。問題があれば終了コード 1 で終わる。
+
+使い方:
+    pip install -r requirements.txt
+    python benchmarks/check_command_sync.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 履歴・予定の保存先を作らずに bot.py を読み込む
+os.environ['HISTORY_DB_PATH'] = ''
+os.environ['SCHEDULER_DB_PATH'] = ''
+
+import discord  # noqa: E402
+
+import bot  # noqa: E402
+from command_sync import command_fingerprint, sync_if_changed  # noqa: E402
+
+
+def pinned_version():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'requirements.txt')
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip().startswith('discord.py=='):
+                return line.strip().split('==', 1)[1]
+    return None
+
+
+async def check(tree, path):
+    calls = []
+
+    async def fake_sync(guild=None):
+        calls.append(guild)
+        return tree.get_commands(guild=guild)
+
+    tree.sync = fake_sync
+    first = await sync_if_changed(tree, 1, path)
+    second = await sync_if_changed(tree, 1, path)
+
+    @tree.command(name='check-command-sync', description='確認用')
+    async def probe(interaction: discord.Interaction):
+        pass
+
+    third = await sync_if_changed(tree, 1, path)
+    return first, second, third, len(calls)
+
+
+def main():
+    pinned = pinned_version()
+    print(f"discord.py {discord.__version__}（requirements.txt: {pinned}）")
+    if pinned is not None and discord.__version__ != pinned:
+        print("⚠️ 固定した版と異なる discord.py で確認しています")
+
+    tree = bot.bot.tree
+    failures = []
+    fingerprint = command_fingerprint(tree)
+    if fingerprint != command_fingerprint(tree):
+        failures.append("同じ定義でハッシュが変わりました")
+    print(f"コマンド {len(tree.get_commands())} 個、ハッシュ {fingerprint[:16]}…")
+
+    with tempfile.TemporaryDirectory() as directory:
+        first, second, third, calls = asyncio.run(check(tree, os.path.join(directory, 'state.json')))
+    if first is None:
+        failures.append("初回に同期されませんでした")
+    if second is not None:
+        failures.append("定義が変わっていないのに同期されました")
+    if third is None:
+        failures.append("定義を変えたのに同期されませんでした")
+    if calls != 2:
+        failures.append(f"同期の回数が {calls} 回でした（2回のはず）")
+
+    for failure in failures:
+        print(f"❌ {failure}")
+    if failures:
+        sys.exit(1)
+    print("✅ 同期の判定は正常です")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,437 @@
+"""
+負荷試験用の Discord の代役
+
+bot.py のコマンドが触るオブジェクト（インタラクション、サーバー、チャンネル、
+メッセージ、メンバー、ボイスチャンネル）と REST API、ゲートウェイのイベント配送を
+プロセス内で真似る。
+
+- FakeRestAPI: 呼び出しごとに遅延を入れ、ルート（とチャンネルなどの主パラメータ）ごとの
+  レート制限と全体のレート制限を再現する。制限に当たると 429 として数え、
+  discord.py と同じく retry_after だけ待ってから再送する。
+- FakeGateway: リアクションのイベントを bot.py の on_raw_reaction_add/remove と
+  同じ入口（dispatch_raw_reaction）に届ける。ボタン方式（SESSION_UI_MODE=components）では
+  メッセージに付いた View の項目の callback を、コンポーネントのインタラクションとして呼ぶ。
+"""
+import asyncio
+import itertools
+import random
+from collections import defaultdict
+from types import SimpleNamespace
+
+import discord
+
+# ルート → (回数, 秒)。Discord の実際の制限に近い値
+DEFAULT_ROUTE_LIMITS = {
+    'reaction_add': (1, 0.25),
+    'reaction_clear': (1, 0.25),
+    'message_create': (5, 5.0),
+    'message_edit': (5, 5.0),
+    'webhook_send': (5, 2.0),
+    'channel_create': (10, 10.0),
+    'channel_edit': (2, 600.0),
+    'channel_delete': (5, 5.0),
+}
+
+_ids = itertools.count(10 ** 17)
+
+
+def next_id():
+    return next(_ids)
+
+
+class _Bucket:
+    __slots__ = ('limit', 'per', 'remaining', 'reset_at')
+
+    def __init__(self, limit, per):
+        self.limit = limit
+        self.per = per
+        self.remaining = limit
+        self.reset_at = 0.0
+
+
+class FakeRestAPI:
+    """
+    遅延とレート制限を再現する REST API の代役
+    """
+
+    def __init__(self, latency=0.05, jitter=0.02, route_limits=None, global_rate=0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.route_limits = DEFAULT_ROUTE_LIMITS if route_limits is None else route_limits
+        self.global_rate = global_rate
+        self._rng = random.Random(seed)
+        self._buckets = {}
+        self._global = _Bucket(global_rate, 1.0) if global_rate else None
+        self.calls = defaultdict(int)
+        self.rate_limited = defaultdict(int)
+        self.rate_limit_wait = 0.0
+
+    async def call(self, route, major=None):
+        loop = asyncio.get_running_loop()
+        self.calls[route] += 1
+        limit = self.route_limits.get(route)
+        bucket = None
+        if limit is not None:
+            bucket = self._buckets.get((route, major))
+            if bucket is None:
+                bucket = self._buckets[(route, major)] = _Bucket(*limit)
+        while True:
+            scope, retry_after = route, 0.0
+            if self._global is not None:
+                scope, retry_after = 'global', self._take(self._global, loop.time())
+            if not retry_after and bucket is not None:
+                scope, retry_after = route, self._take(bucket, loop.time())
+            if not retry_after:
+                break
+            # 429: retry_after だけ待って再送
+            self.rate_limited[scope] += 1
+            self.rate_limit_wait += retry_after
+            await asyncio.sleep(retry_after)
+        await asyncio.sleep(max(0.0, self._rng.gauss(self.latency, self.jitter)))
+
+    @staticmethod
+    def _take(bucket, now):
+        if now >= bucket.reset_at:
+            bucket.remaining = bucket.limit
+            bucket.reset_at = now + bucket.per
+        if bucket.remaining <= 0:
+            return bucket.reset_at - now
+        bucket.remaining -= 1
+        return 0.0
+
+    def summary(self):
+        return {
+            'calls': sum(self.calls.values()),
+            'calls_by_route': dict(self.calls),
+            'rate_limited': sum(self.rate_limited.values()),
+            'rate_limited_by_route': dict(self.rate_limited),
+            'rate_limit_wait_seconds': round(self.rate_limit_wait, 3)
+        }
+
+
+class FakeMember:
+    def __init__(self, guild, name, bot=False, administrator=False):
+        self.id = next_id()
+        self.guild = guild
+        self.name = name
+        self.display_name = name
+        self.mention = f"<@{self.id}>"
+        self.bot = bot
+        self.guild_permissions = SimpleNamespace(administrator=administrator)
+        self.voice = None
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+
+class FakeRole:
+    # 権限設定の辞書のキーになるので SimpleNamespace（ハッシュ不可）は使わない
+    def __init__(self, role_id, name):
+        self.id = role_id
+        self.name = name
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild, name, members):
+        self.id = next_id()
+        self.guild = guild
+        self.name = name
+        self.members = list(members)
+        for member in self.members:
+            member.voice = SimpleNamespace(channel=self)
+
+    @property
+    def voice_states(self):
+        return {member.id: member.voice for member in self.members}
+
+
+class FakeReaction:
+    def __init__(self, emoji):
+        self.emoji = emoji
+        self.count = 0
+        self._users = []
+
+    async def users(self):
+        for user in list(self._users):
+            yield user
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None, view=None):
+        self.id = next_id()
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.view = view
+        self.reactions = []
+        self._reaction_added = asyncio.Event()
+
+    @property
+    def _rest(self):
+        return self.channel.guild.rest
+
+    async def add_reaction(self, emoji):
+        await self._rest.call('reaction_add', self.channel.id)
+        reaction = next((r for r in self.reactions if r.emoji == emoji), None)
+        if reaction is None:
+            reaction = FakeReaction(emoji)
+            self.reactions.append(reaction)
+        reaction.count += 1
+        reaction._users.append(self.channel.guild.me)
+        self._reaction_added.set()
+
+    async def clear_reactions(self):
+        await self._rest.call('reaction_clear', self.channel.id)
+        self.reactions = []
+
+    async def edit(self, **fields):
+        await self._rest.call('message_edit', self.channel.id)
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    async def delete(self):
+        await self._rest.call('message_delete', self.channel.id)
+
+    async def wait_for_reactions(self, emojis):
+        """
+        Bot が emojis を全て付け終わるまで待つ（利用者はそれから押せる）
+        """
+        while not set(emojis) <= {reaction.emoji for reaction in self.reactions}:
+            self._reaction_added.clear()
+            await self._reaction_added.wait()
+
+
+class FakeTextChannel:
+    def __init__(self, guild, name, topic=None, category=None):
+        self.id = next_id()
+        self.guild = guild
+        self.name = name
+        self.topic = topic
+        self.category = category
+        self.mention = f"<#{self.id}>"
+        self.messages = {}
+        self._message_sent = asyncio.Event()
+
+    async def send(self, content=None, embed=None, view=None):
+        await self.guild.rest.call('message_create', self.id)
+        message = FakeMessage(self, content, embed, view)
+        self.messages[message.id] = message
+        self._message_sent.set()
+        return message
+
+    async def fetch_message(self, message_id):
+        await self.guild.rest.call('message_get', self.id)
+        return self.messages[message_id]
+
+    async def edit(self, **fields):
+        await self.guild.rest.call('channel_edit', self.id)
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    async def purge(self, limit=None):
+        await self.guild.rest.call('message_bulk_delete', self.id)
+        self.messages.clear()
+
+    async def delete(self):
+        await self.guild.rest.call('channel_delete', self.guild.id)
+        self.guild.channels.pop(self.id, None)
+
+    async def first_message(self):
+        while not self.messages:
+            self._message_sent.clear()
+            await self._message_sent.wait()
+        return next(iter(self.messages.values()))
+
+
+class FakeGuild:
+    def __init__(self, rest, name="guild", n_admins=3):
+        self.id = next_id()
+        self.rest = rest
+        self.name = name
+        self.default_role = FakeRole(self.id, '@everyone')
+        self.me = FakeMember(self, "bot", bot=True)
+        self.members = [self.me] + [FakeMember(self, f"admin{i}", administrator=True) for i in range(n_admins)]
+        self.channels = {}
+        self._channel_waiters = {}
+
+    @property
+    def text_channels(self):
+        return list(self.channels.values())
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_member(self, member_id):
+        return next((member for member in self.members if member.id == member_id), None)
+
+    def add_text_channel(self, name):
+        channel = FakeTextChannel(self, name)
+        self.channels[channel.id] = channel
+        return channel
+
+    def add_voice_channel(self, name, n_members):
+        members = [FakeMember(self, f"{name}-player{i}") for i in range(n_members)]
+        self.members.extend(members)
+        return FakeVoiceChannel(self, name, members)
+
+    async def create_text_channel(self, name, category=None, overwrites=None, topic=None):
+        await self.rest.call('channel_create', self.id)
+        channel = FakeTextChannel(self, name, topic, category)
+        self.channels[channel.id] = channel
+        waiter = self._channel_waiters.pop(name, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(channel)
+        return channel
+
+    def wait_for_channel(self, name):
+        """
+        name のチャンネルが作られたら結果が入る Future
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._channel_waiters[name] = waiter
+        return waiter
+
+
+class FakeInteractionResponse:
+    def __init__(self, interaction):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, ephemeral=False, thinking=False):
+        interaction = self._interaction
+        self._done = True
+        await interaction.guild.rest.call('interaction_response')
+        # 「考え中」の応答（edit_original_response で中身が入る）
+        message = FakeMessage(interaction.channel)
+        interaction.channel.messages[message.id] = message
+        interaction._original = message
+
+    async def send_message(self, content=None, embed=None, view=None, ephemeral=False):
+        interaction = self._interaction
+        self._done = True
+        await interaction.guild.rest.call('interaction_response')
+        message = FakeMessage(interaction.channel, content, embed, view)
+        interaction.channel.messages[message.id] = message
+        interaction._original = message
+        if not interaction.responded.done():
+            interaction.responded.set_result(message)
+
+
+class FakeWebhook:
+    def __init__(self, interaction):
+        self._interaction = interaction
+
+    async def send(self, content=None, embed=None, view=None):
+        interaction = self._interaction
+        await interaction.guild.rest.call('webhook_send', interaction.id)
+        message = FakeMessage(interaction.channel, content, embed, view)
+        interaction.followups.append(message)
+        return message
+
+
+class FakeInteraction:
+    def __init__(self, guild, channel, user):
+        self.id = next_id()
+        self.guild = guild
+        self.guild_id = guild.id
+        self.application_id = 0
+        self.token = f"token-{self.id}"
+        self.channel = channel
+        self.channel_id = channel.id
+        self.user = user
+        self.response = FakeInteractionResponse(self)
+        self.followup = FakeWebhook(self)
+        self.followups = []
+        self.responded = asyncio.get_running_loop().create_future()
+        self._original = None
+
+    async def original_response(self):
+        await self.guild.rest.call('webhook_get')
+        return self._original
+
+    async def edit_original_response(self, content=None, embed=None, view=None):
+        await self.guild.rest.call('webhook_edit', self.id)
+        message = self._original
+        message.content, message.embed, message.view = content, embed, view
+        if not self.responded.done():
+            self.responded.set_result(message)
+        return message
+
+
+class FakeGateway:
+    """
+    リアクションのイベントを bot.py に届ける（latency 秒遅れて届く）
+    """
+
+    def __init__(self, bot_module, latency=0.0):
+        self.bot_module = bot_module
+        self.latency = latency
+        self.events = 0
+        # 実行中のボタン操作のタスク
+        self._components = set()
+
+    def react(self, message, member, emoji, added=True):
+        # メッセージ側のリアクション一覧（再取得した時に見える状態）も更新
+        reaction = next((r for r in message.reactions if r.emoji == emoji), None)
+        if added:
+            if reaction is None:
+                reaction = FakeReaction(emoji)
+                message.reactions.append(reaction)
+            reaction.count += 1
+            reaction._users.append(member)
+        elif reaction is not None and member in reaction._users:
+            reaction.count -= 1
+            reaction._users.remove(member)
+
+        payload = SimpleNamespace(
+            message_id=message.id,
+            user_id=member.id,
+            member=member if added else None,
+            emoji=emoji
+        )
+        if self.latency:
+            asyncio.get_running_loop().call_later(self.latency, self._deliver, payload, added)
+        else:
+            self._deliver(payload, added)
+
+    def _deliver(self, payload, added):
+        self.events += 1
+        self.bot_module.dispatch_raw_reaction(payload, added)
+
+    def press(self, message, member, emoji, values=None):
+        """
+        メッセージのボタンを押す（values を渡すとセレクトメニューで選ぶ。emoji は使わない）
+
+        コンポーネントのインタラクションとして、View の項目の callback を latency 秒遅れて呼ぶ。
+        """
+        view = message.view
+        if values is None:
+            item = next(item for item in view.children if getattr(item, 'reaction_emoji', None) == emoji)
+        else:
+            item = next(item for item in view.children if isinstance(item, discord.ui.Select))
+        loop = asyncio.get_running_loop()
+        if self.latency:
+            loop.call_later(self.latency, self._start_component, view, item, message, member, values)
+        else:
+            self._start_component(view, item, message, member, values)
+
+    def _start_component(self, view, item, message, member, values):
+        task = asyncio.get_running_loop().create_task(self._run_component(view, item, message, member, values))
+        self._components.add(task)
+        task.add_done_callback(self._components.discard)
+
+    async def _run_component(self, view, item, message, member, values):
+        self.events += 1
+        interaction = FakeInteraction(message.channel.guild, message.channel, member)
+        if not await view.interaction_check(interaction):
+            return
+        if values is not None:
+            # discord.py はインタラクションで選ばれた値がなければ _values を返す
+            item._values = list(values)
+        await item.callback(interaction)
@@ -0,0 +1,275 @@
+"""
+bot.py の負荷試験（Discord に接続せずに実行）
+
+benchmarks/fake_discord.py の代役の上で、/role・/secret_role・/exclude_role・/team_role の
+セッションを多数同時に動かす。各セッションでは参加者が Bot の付けたリアクション
+（--ui-mode components ならボタン・セレクトメニュー）を押し、抽選・ロール決定まで進める。
+/team_role は10人のVCで、レートを付けて実行する。
+
+終了時にスループット、コマンド種類ごとのエンドツーエンド遅延（p50/p99）、
+REST呼び出し数・429の回数、最大メモリ使用量を表示する（--json で JSON 出力）。
+
+使い方:
+    python benchmarks/loadtest.py [--sessions 3000] [--concurrency 1000]
+        [--mix role=1,secret_role=1,exclude_role=1,team_role=0] [--ui-mode reactions|components]
+        [--rest-latency 0.05] [--global-rate 0] [--gateway-latency 0.0] [--think-time 0.0] [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+UI_MODES = ('reactions', 'components')
+
+
+def parse_ui_mode(argv):
+    # bot.py は読み込み時に SESSION_UI_MODE を読むので、他の引数より先に取り出す
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--ui-mode', choices=UI_MODES, default='reactions')
+    return parser.parse_known_args(argv)[0].ui_mode
+
+
+# 永続化とメトリクスは切り、--ui-mode のUIで動かす
+os.environ['HISTORY_DB_PATH'] = ''
+os.environ['SCHEDULER_DB_PATH'] = ''
+os.environ['SESSION_UI_MODE'] = parse_ui_mode(sys.argv[1:])
+os.environ.pop('METRICS_PORT', None)
+os.environ.pop('TRACE_DIR', None)
+
+import bot as bot_module  # noqa: E402
+from fake_discord import FakeGateway, FakeGuild, FakeInteraction, FakeRestAPI  # noqa: E402
+
+NUMBER_EMOJIS = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣']
+ROLE_LETTERS = list(bot_module.ROLE_LETTERS.keys())
+COMMANDS = ('role', 'secret_role', 'exclude_role', 'team_role')
+# コマンドごとのVCの人数
+VOICE_CHANNEL_SIZES = {'team_role': bot_module.TEAM_MATCH_SIZE}
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"不明なコマンドです: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.rest = FakeRestAPI(latency=args.rest_latency, jitter=args.rest_jitter,
+                                global_rate=args.global_rate, seed=args.seed)
+        self.gateway = FakeGateway(bot_module, latency=args.gateway_latency)
+        self.guilds = [FakeGuild(self.rest, f"guild{i}") for i in range(args.guilds)]
+        self.callbacks = {
+            name: bot_module.bot.tree.get_command(name).callback
+            for name in COMMANDS
+        }
+        self.latencies = {name: [] for name in self.callbacks}
+        self.failures = {name: 0 for name in self.callbacks}
+
+    async def think(self):
+        if self.args.think_time:
+            await asyncio.sleep(self.rng.uniform(0, 2 * self.args.think_time))
+
+    @property
+    def components(self):
+        return self.args.ui_mode == 'components'
+
+    def press(self, message, player, emoji):
+        """
+        リアクションを付ける（ボタン方式ならボタンを押す）
+        """
+        if self.components:
+            self.gateway.press(message, player, emoji)
+        else:
+            self.gateway.react(message, player, emoji)
+
+    def exclude(self, message, player, letter):
+        """
+        ロールを1つ除外する（ボタン方式ならセレクトメニューで選ぶ）
+        """
+        if self.components:
+            self.gateway.press(message, player, None, values=[letter])
+        else:
+            self.gateway.react(message, player, letter)
+
+    async def wait_for_controls(self, message, emojis):
+        # ボタン方式ではメッセージの作成と同時にボタンが付いている
+        if not self.components:
+            await message.wait_for_reactions(emojis)
+
+    def command_args(self, kind, players):
+        if kind == 'team_role':
+            # 参加者全員にレートを付ける
+            return {'ratings': " ".join(f"{player.mention} {self.rng.randint(800, 2400)}" for player in players)}
+        return {}
+
+    async def run_session(self, number, kind):
+        guild = self.guilds[number % len(self.guilds)]
+        text_channel = guild.add_text_channel(f"text-{number}")
+        voice_channel = guild.add_voice_channel(f"vc-{number}", VOICE_CHANNEL_SIZES.get(kind, 5))
+        players = voice_channel.members
+        interaction = FakeInteraction(guild, text_channel, players[0])
+
+        start = time.perf_counter()
+        command = asyncio.create_task(self.callbacks[kind](interaction, **self.command_args(kind, players)))
+        driver = asyncio.create_task(getattr(self, f"drive_{kind}")(interaction, guild, voice_channel, players))
+        try:
+            await asyncio.wait_for(command, timeout=self.args.session_timeout)
+            self.latencies[kind].append(time.perf_counter() - start)
+        except Exception as e:
+            self.failures[kind] += 1
+            if self.failures[kind] <= 3:
+                print(f"{kind} のセッションが失敗しました: {e!r}")
+        finally:
+            driver.cancel()
+
+    async def drive_role(self, interaction, guild, voice_channel, players):
+        message = await interaction.responded
+        await self.wait_for_controls(message, NUMBER_EMOJIS + ['🎲'])
+        for player, emoji in zip(players, NUMBER_EMOJIS):
+            await self.think()
+            self.press(message, player, emoji)
+        await self.think()
+        self.press(message, players[0], '🎲')
+
+    async def drive_secret_role(self, interaction, guild, voice_channel, players):
+        temp_channel = await guild.wait_for_channel(f"🔒role-決め-{voice_channel.name.lower()}")
+        message = await temp_channel.first_message()
+        await self.wait_for_controls(message, NUMBER_EMOJIS)
+        for player, emoji in zip(players, NUMBER_EMOJIS):
+            await self.think()
+            self.press(message, player, emoji)
+
+    async def drive_exclude_role(self, interaction, guild, voice_channel, players):
+        message = await interaction.responded
+        await self.wait_for_controls(message, ROLE_LETTERS + ['❌', '▶️'])
+        for player in players:
+            await self.think()
+            # 各自0〜1個のロールを除外（必ず割り当て可能な範囲）
+            if self.rng.random() < 0.5:
+                self.exclude(message, player, self.rng.choice(ROLE_LETTERS))
+        await self.think()
+        self.press(message, players[0], '▶️')
+
+    async def drive_team_role(self, interaction, guild, voice_channel, players):
+        message = await interaction.responded
+        await self.wait_for_controls(message, ROLE_LETTERS + ['❌', '▶️'])
+        for number, player in enumerate(players):
+            await self.think()
+            # プレイヤー i が除外できるのは i % 5 番目のロールだけなので、どのロールも8人以上が担当でき、
+            # 0〜4番と5〜9番に分ければ必ず割り当て可能
+            if self.rng.random() < 0.5:
+                self.exclude(message, player, ROLE_LETTERS[number % len(ROLE_LETTERS)])
+        await self.think()
+        self.press(message, players[0], '▶️')
+
+    async def run(self):
+        kinds = list(self.args.mix.keys())
+        weights = list(self.args.mix.values())
+        plan = self.rng.choices(kinds, weights, k=self.args.sessions)
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(number, kind):
+            async with semaphore:
+                await self.run_session(number, kind)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(limited(number, kind) for number, kind in enumerate(plan)))
+        elapsed = time.perf_counter() - start
+        bot_module.scheduler.close()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        completed = sum(len(values) for values in self.latencies.values())
+        return {
+            'sessions': self.args.sessions,
+            'concurrency': self.args.concurrency,
+            'ui_mode': self.args.ui_mode,
+            'completed': completed,
+            'failed': sum(self.failures.values()),
+            # 送信待ちが溢れていたため断られたセッション（完了に含まれる）
+            'rejected': bot_module.metrics.sessions_rejected.value(),
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput_sessions_per_second': round(completed / elapsed, 2) if elapsed else None,
+            'latency': {
+                kind: {
+                    'count': len(values),
+                    'p50_seconds': round(percentile(values, 0.5), 3) if values else None,
+                    'p99_seconds': round(percentile(values, 0.99), 3) if values else None,
+                    'max_seconds': round(max(values), 3) if values else None
+                }
+                for kind, values in self.latencies.items() if values or self.failures[kind]
+            },
+            'rest': self.rest.summary(),
+            'gateway_events': self.gateway.events,
+            # Linux の ru_maxrss は KB 単位
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'leftover_router_entries': len(bot_module.reaction_router),
+            'leftover_exclusion_sessions': len(bot_module.exclusion_sessions)
+        }
+
+
+def print_report(report):
+    print(f"セッション: {report['completed']}/{report['sessions']} 完了、失敗 {report['failed']}"
+          f"（同時 {report['concurrency']}、UI {report['ui_mode']}）")
+    if report['rejected']:
+        print(f"⚠️ 送信待ちが溢れていたため断られたセッション: {report['rejected']} 件")
+    print(f"所要時間: {report['elapsed_seconds']} 秒、スループット: {report['throughput_sessions_per_second']} セッション/秒")
+    for kind, latency in report['latency'].items():
+        print(f"  /{kind:<13} {latency['count']:>6} 件  p50 {latency['p50_seconds']} 秒  "
+              f"p99 {latency['p99_seconds']} 秒  最大 {latency['max_seconds']} 秒")
+    rest = report['rest']
+    print(f"REST呼び出し: {rest['calls']} 回、429: {rest['rate_limited']} 回（待ち合計 {rest['rate_limit_wait_seconds']} 秒）")
+    print(f"最大メモリ使用量: {report['peak_rss_mb']} MB")
+    if report['leftover_router_entries'] or report['leftover_exclusion_sessions']:
+        print(f"⚠️ 後片付けされていないセッション: ルーター {report['leftover_router_entries']} 件、"
+              f"除外セッション {report['leftover_exclusion_sessions']} 件")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=3000)
+    parser.add_argument('--concurrency', type=int, default=1000)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('role=1,secret_role=1,exclude_role=1'))
+    parser.add_argument('--ui-mode', choices=UI_MODES, default='reactions',
+                        help="セッションのUI（reactions: リアクション、components: ボタン・セレクトメニュー）")
+    parser.add_argument('--guilds', type=int, default=100)
+    parser.add_argument('--rest-latency', type=float, default=0.05, help="REST呼び出し1回の平均遅延（秒）")
+    parser.add_argument('--rest-jitter', type=float, default=0.02)
+    parser.add_argument('--global-rate', type=int, default=0, help="全体のレート制限（回/秒、0で無制限）")
+    parser.add_argument('--gateway-latency', type=float, default=0.0, help="リアクションイベントが届くまでの遅延（秒）")
+    parser.add_argument('--think-time', type=float, default=0.0, help="参加者がリアクションを押すまでの平均時間（秒）")
+    parser.add_argument('--session-timeout', type=float, default=600.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="結果を JSON で出力する")
+    args = parser.parse_args()
+
+    report = await LoadTest(args).run()
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
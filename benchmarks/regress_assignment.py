@@ -0,0 +1,269 @@
+"""
+ロール割り当てアルゴリズムの回帰ベンチマーク
+
+/role の抽選（draw_lottery_assignments）と /exclude_role の割り当て
+（assign_roles_with_exclusions）を、代表的な除外パターンと意地悪な除外パターンで測る。
+
+- 1回あたりの処理時間（µs）
+- 割り当て可能な入力での失敗率
+- 結果の一様性（全ての有効な割り当てが等確率か。カイ二乗検定の p 値と全変動距離）
+
+乱数の種を固定しているので、同じコードなら毎回同じ結果（処理時間以外）になる。
+結果は JSON で保存でき、--baseline に以前の結果を渡すと、
+閾値を超えて悪化した項目があれば一覧を表示して終了コード 1 で終わる。
+処理時間は repeats 回の中央値で比べ、閾値を超えたケースは測り直して、それでも超えた場合だけ悪化とする
+（同じコードでもたまたま他の処理に割り込まれて遅くなることがあるため）。
+
+使い方:
+    python benchmarks/regress_assignment.py [--output results.json] [--baseline baseline.json]
+        [--latency-tolerance 0.5] [--failure-tolerance 0.0] [--min-p-value 0.0001]
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from bot import ROLES, assign_roles_with_exclusions, draw_lottery_assignments  # noqa: E402
+from bench_assignment import make_players, profiles as adversarial_profiles  # noqa: E402
+from role_matching import count_assignments, roles_to_mask  # noqa: E402
+
+# 一様性を調べる有効な割り当ての数の上限（これより多いと十分な標本が取れない）
+MAX_UNIFORMITY_OUTCOMES = 3000
+# 有効な割り当て1通りあたりの期待度数
+SAMPLES_PER_OUTCOME = 50
+# 処理時間の比較でこれ未満の差は誤差として無視する（µs）
+LATENCY_FLOOR_US = 2.0
+# 処理時間が閾値を超えたケースを測り直す最大の回数
+LATENCY_RECHECKS = 3
+
+
+def representative_profiles(rng):
+    """
+    実際の使われ方に近い、各自0〜2ロールを除外した割り当て可能な入力
+    """
+    roles = list(ROLES.keys())
+    result = []
+    for n_players in (2, 3, 4, 5, 5, 5):
+        while True:
+            allowed = [
+                [role for role in roles if role not in rng.sample(roles, rng.randint(0, 2))]
+                for _ in range(n_players)
+            ]
+            role_index = {role: i for i, role in enumerate(roles)}
+            if count_assignments([roles_to_mask(a, role_index) for a in allowed], len(roles)):
+                break
+        result.append((f"代表: {n_players}人・各0〜2除外 #{len(result) + 1}", roles, allowed))
+    return result
+
+
+def chi_square_p_value(statistic, df):
+    """
+    カイ二乗分布の上側確率（Wilson–Hilferty 近似）
+    """
+    if df <= 0:
+        return 1.0
+    z = ((statistic / df) ** (1 / 3) - (1 - 2 / (9 * df))) / math.sqrt(2 / (9 * df))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def uniformity(outcomes, n_outcomes):
+    """
+    観測した結果の分布と、n_outcomes 通りの一様分布とのずれ
+    """
+    samples = sum(outcomes.values())
+    expected = samples / n_outcomes
+    unseen = n_outcomes - len(outcomes)
+    statistic = sum((count - expected) ** 2 / expected for count in outcomes.values()) + unseen * expected
+    total_variation = 0.5 * (sum(abs(count / samples - 1 / n_outcomes) for count in outcomes.values())
+                             + unseen / n_outcomes)
+    return chi_square_p_value(statistic, n_outcomes - 1), total_variation
+
+
+def measure_latency(func, trials, repeats):
+    # 処理時間は repeats 回測った中の中央値（1回だけの割り込みの影響を受けない）
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(trials):
+            func()
+        latencies.append((time.perf_counter() - start) / trials * 1e6)
+    return round(statistics.median(latencies), 3)
+
+
+def measure(func, n_outcomes, trials, repeats):
+    result = {'outcomes': n_outcomes, 'latency_us': measure_latency(func, trials, repeats)}
+    if n_outcomes == 0:
+        return result
+
+    samples = max(trials, SAMPLES_PER_OUTCOME * n_outcomes) if n_outcomes <= MAX_UNIFORMITY_OUTCOMES else trials
+    outcomes = Counter()
+    failures = 0
+    for _ in range(samples):
+        outcome = func()
+        if outcome is None:
+            failures += 1
+        else:
+            outcomes[outcome] += 1
+    result['failure_rate'] = failures / samples
+    if 1 < n_outcomes <= MAX_UNIFORMITY_OUTCOMES and outcomes:
+        p_value, total_variation = uniformity(outcomes, n_outcomes)
+        result['uniformity_p_value'] = p_value
+        result['total_variation'] = round(total_variation, 5)
+    return result
+
+
+def exclusion_case(all_roles, allowed):
+    players = make_players(allowed)
+    role_index = {role: i for i, role in enumerate(all_roles)}
+    n_outcomes = count_assignments([roles_to_mask(a, role_index) for a in allowed], len(all_roles))
+
+    def run():
+        assignments = assign_roles_with_exclusions(players, all_roles)
+        if assignments is None:
+            return None
+        return tuple(assignments[player['user']] for player in players)
+
+    return run, n_outcomes
+
+
+def lottery_case(n_participants, available_roles):
+    participants = [{'user': f"player{i}", 'number': i % 5 + 1} for i in range(n_participants)]
+    assigned = min(n_participants, len(available_roles))
+    n_outcomes = math.perm(n_participants, assigned)
+
+    def run():
+        assignments = draw_lottery_assignments(participants, available_roles)
+        return tuple(assignments[p['user']]['role'] if p['user'] in assignments else None for p in participants)
+
+    return run, n_outcomes
+
+
+def cases(rng):
+    roles = list(ROLES.keys())
+    for n_participants in (3, 5, 7):
+        yield f"抽選: {n_participants}人/5ロール", lottery_case(n_participants, roles)
+    for name, all_roles, allowed in representative_profiles(rng):
+        yield name, exclusion_case(all_roles, allowed)
+    for name, all_roles, allowed in adversarial_profiles():
+        yield f"意地悪: {name}", exclusion_case(all_roles, allowed)
+
+
+def latency_regressed(previous, current, args):
+    """
+    処理時間が許容割合と誤差の幅の両方を超えて遅くなったか
+    """
+    if 'latency_us' not in previous:
+        return False
+    allowed_latency = previous['latency_us'] * (1 + args.latency_tolerance)
+    return current['latency_us'] > allowed_latency and current['latency_us'] - previous['latency_us'] > LATENCY_FLOOR_US
+
+
+def recheck_latency(results, baseline, funcs, args):
+    """
+    処理時間が閾値を超えたケースを測り直し、最も速かった値に置き換える（超えなくなったらやめる）
+    """
+    for name, current in results.items():
+        previous = baseline.get(name, {})
+        for _ in range(LATENCY_RECHECKS):
+            if not latency_regressed(previous, current, args):
+                break
+            random.seed(args.seed)
+            latency = measure_latency(funcs[name], args.trials, args.repeats)
+            print(f"  測り直し: {name} {current['latency_us']} → {latency} µs")
+            current['latency_us'] = min(current['latency_us'], latency)
+
+
+def compare(results, baseline, args):
+    """
+    閾値を超えて悪化した項目の一覧
+    """
+    regressions = []
+    for name, current in results.items():
+        # 以前の結果がないケースは、失敗率 0 を基準にする
+        previous = baseline.get(name, {})
+        if latency_regressed(previous, current, args):
+            regressions.append(f"{name}: 処理時間 {previous['latency_us']} → {current['latency_us']} µs")
+        if current.get('failure_rate', 0) > previous.get('failure_rate', 0) + args.failure_tolerance:
+            regressions.append(f"{name}: 失敗率 {previous.get('failure_rate', 0):.2%} → {current['failure_rate']:.2%}")
+        # 一様性は以前の結果によらず閾値で判定する
+        if current.get('uniformity_p_value', 1.0) < args.min_p_value:
+            regressions.append(f"{name}: 一様でない（p = {current['uniformity_p_value']:.2e}、"
+                               f"全変動距離 {current['total_variation']}）")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=2000)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="結果を保存する JSON ファイル")
+    parser.add_argument('--baseline', help="比較する以前の結果の JSON ファイル")
+    parser.add_argument('--latency-tolerance', type=float, default=0.5, help="処理時間の悪化の許容割合")
+    parser.add_argument('--failure-tolerance', type=float, default=0.0, help="失敗率の悪化の許容幅")
+    parser.add_argument('--min-p-value', type=float, default=1e-4, help="一様性の検定の p 値の下限")
+    args = parser.parse_args()
+
+    results = {}
+    funcs = {}
+    header = f"{'ケース':<36} {'結果の数':>8} {'µs/回':>8} {'失敗率':>8} {'p値':>10} {'全変動距離':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, (func, n_outcomes) in cases(random.Random(args.seed)):
+        random.seed(args.seed)
+        result = measure(func, n_outcomes, args.trials, args.repeats)
+        results[name] = result
+        funcs[name] = func
+        p_value = f"{result['uniformity_p_value']:.3g}" if 'uniformity_p_value' in result else '-'
+        total_variation = result.get('total_variation', '-')
+        failure_rate = f"{result['failure_rate']:.1%}" if 'failure_rate' in result else '-'
+        print(f"{name:<36} {n_outcomes:>8} {result['latency_us']:>8.1f} {failure_rate:>8} {p_value:>10} {total_variation:>10}")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        recheck_latency(results, baseline, funcs, args)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'commit': git_commit(),
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'seed': args.seed,
+                'results': results
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を {args.output} に保存しました")
+
+    regressions = compare(results, baseline, args)
+    if regressions:
+        print("\n❌ 悪化した項目:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("\n✅ 悪化した項目はありません")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+セッションストアの長時間稼働シミュレーション
+
+仮想時計で何日分ものロール結果を流し込み、
+上限なしの dict（置き換え前の role_results）と、セッション状態の保存先の既定である
+MemoryBackend（期限付き・件数上限付き）のメモリ使用量の推移を比較する。
+
+使い方:
+    python benchmarks/soak_session_store.py [--days 14] [--sessions-per-hour 300]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_backend import MemoryBackend  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_result(game_number):
+    # 5人分の結果（ID・表示名・ロール）
+    return {
+        'kind': 'role',
+        'channel_id': game_number % 50,
+        'assignments': [(game_number * 10 + i, f"player{i}", 'top') for i in range(5)],
+        'created_at': float(game_number)
+    }
+
+
+async def measure(store, write, clock, days, sessions_per_hour):
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    samples = []
+    interval = 3600.0 / sessions_per_hour
+    game_number = 0
+    for day in range(1, days + 1):
+        for _ in range(24 * sessions_per_hour):
+            clock.now += interval
+            await write(f"result:game_{game_number}", make_result(game_number))
+            game_number += 1
+        samples.append((day, len(store), (tracemalloc.get_traced_memory()[0] - baseline) / 1024))
+    tracemalloc.stop()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=14)
+    parser.add_argument('--sessions-per-hour', type=int, default=300)
+    args = parser.parse_args()
+
+    clock = FakeClock()
+    store = MemoryBackend(max_entries=10000, clock=clock)
+
+    async def write_store(key, value):
+        await store.set(key, value, ttl=24 * 60 * 60)
+
+    unbounded_store = {}
+
+    async def write_dict(key, value):
+        unbounded_store[key] = value
+
+    bounded = asyncio.run(measure(store, write_store, clock, args.days, args.sessions_per_hour))
+    unbounded = asyncio.run(measure(unbounded_store, write_dict, FakeClock(), args.days, args.sessions_per_hour))
+
+    print(f"{'日数':>4} {'dict: 件数':>12} {'dict: KiB':>12} {'Store: 件数':>12} {'Store: KiB':>12}")
+    for (day, dict_entries, dict_kib), (_, store_entries, store_kib) in zip(unbounded, bounded):
+        print(f"{day:>4} {dict_entries:>12} {dict_kib:>12.0f} {store_entries:>12} {store_kib:>12.0f}")
+    print(f"削除数: {store.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,86 @@ import discord
 from discord.ext import commands
 import random
 import asyncio
+import copy
 import os
+import re
+import socket
+import time
+from types import SimpleNamespace
+
+from reaction_router import ReactionEvent, ReactionInbox, ReactionRouter
+from role_matching import FeasibilityIndex, mask_to_indices, roles_to_mask, sample_assignment
+from admin_index import AdminIndex, role_grants_admin
+from channel_pool import ChannelPool
+from command_sync import sync_if_changed
+from history_store import HistoryStore
+from live_message import CoalescedEditor
+import metrics
+from outbound import OutboundScheduler, PRIORITY_BACKGROUND, PRIORITY_FOLLOWUP, PRIORITY_RESPONSE
+import tracing
+from scheduler import Scheduler
+from session_backend import BACKEND_ERRORS, open_backend
+from session_state import ABSENT_BIT, ExclusionSession, ExclusionSettings, SecretSession
+import session_views
+from team_split import assign_teams, scarce_roles
+
+# シャード設定（cluster.py から起動されたワーカーは担当シャードを環境変数で受け取る）
+# AUTO_SHARD=1 なら1プロセスで推奨数の全シャードを動かす
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS').split(',')] if os.getenv('SHARD_IDS') else None
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', '0'))
+
+# メトリクス（Prometheus形式）を返すポート。未設定なら公開しない
+# クラスタ構成ではワーカーごとに METRICS_PORT + クラスタID で公開する
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT')) + CLUSTER_ID if os.getenv('METRICS_PORT') else None
+
+# セッションごとの処理のタイムラインの書き出し先（未設定なら記録しない）と形式（chrome または json）
+TRACE_DIR = os.getenv('TRACE_DIR') or None
+tracing.configure(TRACE_DIR, os.getenv('TRACE_FORMAT', 'chrome'))
+
+# 全メンバーを受け取る（Server Members Intent）か。管理者の索引を最初から揃えたい場合に使う
+MEMBERS_INTENT = os.getenv('MEMBERS_INTENT') == '1'
+
+# 起動を速くするモード: 起動時のメンバー読み込み（チャンク）を行わず、サーバー情報の到着待ちも短くする
+# コマンドに必要なVC参加者は実行時にボイス状態から解決する（resolve_voice_members）
+FAST_STARTUP = os.getenv('FAST_STARTUP') == '1'
+FAST_STARTUP_GUILD_READY_TIMEOUT = 0.5
+
+# メモリの使い方: 'default'（discord.py の既定のキャッシュ）または 'low'
+# low ではメッセージをキャッシュせず（Botは自分のセッションのメッセージを参照で持っている）、
+# メンバーはVCにいる人だけを残し、使わないイベント（入力中・招待・絵文字の更新など）を受け取らない
+LOW_MEMORY = os.getenv('MEMORY_PROFILE', 'default') == 'low'
+LOW_MEMORY_DISABLED_INTENTS = (
+    'typing', 'invites', 'integrations', 'webhooks', 'emojis_and_stickers',
+    'guild_scheduled_events', 'auto_moderation'
+)
 
 # Botの設定
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+intents.members = MEMBERS_INTENT
+if LOW_MEMORY:
+    for intent_name in LOW_MEMORY_DISABLED_INTENTS:
+        setattr(intents, intent_name, False)
+http_trace = None
+if METRICS_PORT:
+    http_trace = metrics.http_trace(http_trace)
+if TRACE_DIR:
+    http_trace = tracing.http_trace(http_trace)
+bot_options = {'http_trace': http_trace} if http_trace is not None else {}
+if FAST_STARTUP:
+    bot_options['chunk_guilds_at_startup'] = False
+    bot_options['guild_ready_timeout'] = FAST_STARTUP_GUILD_READY_TIMEOUT
+if LOW_MEMORY:
+    bot_options['max_messages'] = None
+    bot_options['member_cache_flags'] = discord.MemberCacheFlags.none()
+    bot_options['member_cache_flags'].voice = True
+if SHARD_IDS is not None or os.getenv('AUTO_SHARD') == '1':
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, **bot_options)
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents, **bot_options)
+metrics_server = None
 
 # ロールの定義
 ROLES = {
@@ -18,6 +92,10 @@ ROLES = {
     'sup': 'サポート'
 }
 
+# ロールキー → ロール番号（除外・選択済みのロールを表すビットマスクのビット位置）
+ROLE_INDEX = {role: i for i, role in enumerate(ROLES)}
+ALL_ROLES_MASK = (1 << len(ROLES)) - 1
+
 # ロール毎のメッセージ
 ROLE_MESSAGES = {
     'top': {
@@ -52,16 +130,274 @@ ROLE_MESSAGES = {
     }
 }
 
-# ロール結果を保存
-role_results = {}
+# 参加表明用の数字リアクション
+NUMBER_MAP = {'1️⃣': 1, '2️⃣': 2, '3️⃣': 3, '4️⃣': 4, '5️⃣': 5}
+
+# 抽選前にメッセージを再取得し、追跡した参加者とサーバー側のリアクションを照合するか
+VERIFY_REACTION_STATE = os.getenv('VERIFY_REACTION_STATE') == '1'
+
+# セッションのUI: 'reactions'（リアクション）または 'components'（ボタン・セレクトメニュー）
+USE_COMPONENT_UI = os.getenv('SESSION_UI_MODE', 'reactions') == 'components'
+
+# /secret_role の一時チャンネルを使い回すプールの大きさ（サーバーごと、0 なら毎回作成・削除）
+SECRET_CHANNEL_POOL_SIZE = int(os.getenv('SECRET_CHANNEL_POOL_SIZE', '0'))
+# 後片付けを予約済みのチャンネルは予約どおりに片付け、取り残しとして回収しない
+channel_pool = ChannelPool(
+    SECRET_CHANNEL_POOL_SIZE,
+    owns=lambda channel_id: scheduler.is_scheduled(f"dispose_temp_channel:{channel_id}")
+)
+channel_pool_sweeper = None
+
+# /secret_role の操作待ちの時間と、終了後にチャンネルを削除するまでの時間（秒）
+SECRET_SESSION_TIMEOUT = 300
+SECRET_CHANNEL_DELETE_DELAY = 30
+
+# /secret_role の進行状況の書き換えをまとめる時間（秒）。同時に押された分は1回の編集になる
+SECRET_STATUS_EDIT_DELAY = 0.3
+
+# ロール結果を残す時間（秒）
+ROLE_RESULT_TTL = 24 * 60 * 60
+
+# セッション状態（ロール結果と進行中のセッション）の保存先
+# 未設定ならプロセス内。kv://host:port を指定すると session_backend.py のサーバーに置いて複数のプロセスで共有し、
+# 1つのプロセスが再起動・交代しても、進行中のセッションをそのサーバーを受け持つプロセスが引き継ぐ
+SESSION_BACKEND_URL = os.getenv('SESSION_BACKEND_URL') or None
+session_backend = open_backend(SESSION_BACKEND_URL)
+# 進行中のセッションの記録を残す時間（秒）。フォローアップの送信に使うインタラクションのトークンは15分で切れる
+SHARED_SESSION_TTL = 15 * 60
+# 引き継いだセッションの持ち主としてのこのプロセスの識別子
+INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}"
+# 持ち主の期限（秒）。持ち主はその3分の1ごとに延ばし、延ばされずに切れたセッションだけを他のプロセスが引き継ぐ
+# 期限はプロセスをまたいで比べるので時計（time.time）で持つ。各ホストの時計は NTP などで合わせておくこと
+SHARED_SESSION_LEASE = 30
+# このプロセスが持ち主の、保存先のセッションのキー
+owned_shared_sessions = set()
+shared_sessions_resumed = False
+
+# ロール割り当て履歴（SQLite）。空文字を指定すると保存しない
+HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', 'role_history.sqlite3')
+history_store = HistoryStore(HISTORY_DB_PATH) if HISTORY_DB_PATH else None
+
+# セッションのタイムアウトと一時チャンネルの後片付けのスケジューラー
+# 後片付けはSQLiteに保存し、再起動しても実行される（空文字にすると保存しない）
+# クラスタ構成ではワーカーごとに別のファイルにし、再起動したワーカーが他のワーカーの予約（使用中のチャンネルの削除など）を実行しないようにする
+SCHEDULER_DB_PATH = os.getenv('SCHEDULER_DB_PATH', 'scheduled_jobs.sqlite3')
+if SCHEDULER_DB_PATH and 'CLUSTER_ID' in os.environ:
+    root, ext = os.path.splitext(SCHEDULER_DB_PATH)
+    SCHEDULER_DB_PATH = f"{root}.cluster{CLUSTER_ID}{ext}"
+scheduler = Scheduler(SCHEDULER_DB_PATH or None)
+
+# スラッシュコマンドの同期設定
+# 前回同期したコマンド定義のハッシュの保存先（定義が変わった時だけ同期する）
+COMMAND_SYNC_STATE_PATH = os.getenv('COMMAND_SYNC_STATE_PATH', '.command_sync.json')
+# 開発用: このサーバーだけにコマンドを同期する（グローバルと違い即時反映される）
+DEV_GUILD_ID = int(os.getenv('DEV_GUILD_ID')) if os.getenv('DEV_GUILD_ID') else None
+# 1 なら定義が変わっていなくても同期する
+FORCE_COMMAND_SYNC = os.getenv('FORCE_COMMAND_SYNC') == '1'
+
+# メッセージIDごとにリアクションイベントを各セッションへ振り分ける
+reaction_router = ReactionRouter(timers=scheduler)
+
+# Discord への送信をバケットごとに並べて送るスケジューラー
+# 同時に送る数と、これを超えて送信待ちが溜まったら新しいセッションを待たせる数
+OUTBOUND_MAX_IN_FLIGHT = int(os.getenv('OUTBOUND_MAX_IN_FLIGHT', '500'))
+OUTBOUND_MAX_PENDING = int(os.getenv('OUTBOUND_MAX_PENDING', '5000'))
+# バケットの種類ごとのレート制限（回数, 秒）。使い切ったバケットの送信は送信枠を塞がずに待つ
+OUTBOUND_BUCKET_LIMITS = {
+    'reactions': (1, 0.25),  # チャンネルごとのリアクション追加・削除
+    'messages': (5, 5.0),    # チャンネルごとのメッセージ送信・編集
+    'channels': (10, 10.0),  # サーバーごとのチャンネル作成・削除
+}
+# 新しいセッションを待たせる最大時間（秒）。インタラクションの応答期限（3秒）に収まるように
+OUTBOUND_ADMISSION_TIMEOUT = 1.5
+outbound = OutboundScheduler(OUTBOUND_MAX_IN_FLIGHT, OUTBOUND_MAX_PENDING, OUTBOUND_BUCKET_LIMITS)
+
+def respond(interaction, *args, **kwargs):
+    """
+    インタラクションへの最初の応答を最優先で送る（defer 済みなら保留中の応答を書き換える）
+    """
+    return outbound.submit(('interaction', interaction.id), send_response, interaction, *args,
+                           priority=PRIORITY_RESPONSE, **kwargs)
+
+async def send_response(interaction, content=None, *, ephemeral=False, **fields):
+    if interaction.response.is_done():
+        # 公開・非公開は defer の時に決まっている
+        return await interaction.edit_original_response(content=content, **fields)
+    return await interaction.response.send_message(content, ephemeral=ephemeral, **fields)
+
+def defer(interaction):
+    """
+    3秒の応答期限に間に合わないかもしれない処理の前に、応答を保留する（まだ応答していなければ）
+
+    同じインタラクションの送信は順番どおりに届くので、後の respond は保留中の応答の書き換えになる。
+    """
+    async def send_defer():
+        if not interaction.response.is_done():
+            await interaction.response.defer()
+    return outbound.submit(('interaction', interaction.id), send_defer, priority=PRIORITY_RESPONSE)
+
+def send_followup(interaction, *args, **kwargs):
+    """
+    フォローアップを送る（同じインタラクションの応答より後に、順番どおりに届く）
+    """
+    return outbound.submit(('interaction', interaction.id), interaction.followup.send, *args,
+                           priority=PRIORITY_FOLLOWUP, **kwargs)
+
+def send_to_channel(channel, *args, **kwargs):
+    return outbound.submit(('messages', channel.id), channel.send, *args, **kwargs)
+
+def edit_message(message, **fields):
+    """
+    メッセージを編集する。同じメッセージへの編集がまだ送られていなければ、新しい内容に置き換える
+    """
+    return outbound.submit(('messages', message.channel.id), message.edit, coalesce_key=('edit', message.id), **fields)
+
+async def add_reactions(message, emojis):
+    """
+    リアクションをまとめて積み、順番を保ったまま送る（待っている間も他のバケットの送信は進む）
+    """
+    bucket = ('reactions', message.channel.id)
+    results = await asyncio.gather(
+        *[outbound.submit(bucket, message.add_reaction, emoji) for emoji in emojis],
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+async def admit_session(interaction):
+    """
+    送信待ちが溢れている間は新しいセッションを待たせ、待ちきれなければ断る
+    """
+    if await outbound.wait_for_capacity(OUTBOUND_ADMISSION_TIMEOUT):
+        return True
+    metrics.sessions_rejected.inc()
+    await respond(interaction, "⚠️ 混雑しています。少し待ってから再実行してください。", ephemeral=True)
+    return False
+
+@bot.event
+async def on_raw_reaction_add(payload):
+    dispatch_raw_reaction(payload, added=True)
+
+@bot.event
+async def on_raw_reaction_remove(payload):
+    dispatch_raw_reaction(payload, added=False)
+
+def dispatch_raw_reaction(payload, added):
+    """
+    ゲートウェイのリアクションイベントを、メッセージを持つセッションへ振り分ける
+    """
+    # Bot自身や他のBotのリアクションは無視
+    if bot.user is not None and payload.user_id == bot.user.id:
+        return
+    if payload.member is not None and payload.member.bot:
+        return
+    event = ReactionEvent(str(payload.emoji), payload.user_id, payload.member, added)
+    reaction_router.dispatch(payload.message_id, event)
+
+async def resolve_voice_members(channel, interaction=None):
+    """
+    VCに参加している（Botでない）メンバー
+
+    メンバーを読み込み終えていなくても（FAST_STARTUP）、ボイス状態に載っているIDから取得する。
+    """
+    return await resolve_members(channel.guild, channel.voice_states, interaction)
+
+async def resolve_members(guild, user_ids, interaction=None):
+    """
+    ユーザーIDのメンバー（Botと、サーバーにいない人は除く）
+
+    キャッシュにいない人だけをゲートウェイでまとめて取得し、それでも見つからなければRESTで取得する。
+    取得には応答期限を超えうるので、interaction を渡すと取得の前に応答を保留する。
+    """
+    members = {user_id: guild.get_member(user_id) for user_id in user_ids}
+    missing = [user_id for user_id, member in members.items() if member is None]
+    if missing and interaction is not None:
+        await defer(interaction)
+    # ゲートウェイのメンバー要求は1回100人まで
+    for start in range(0, len(missing), 100):
+        chunk = missing[start:start + 100]
+        try:
+            found = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=True)
+        except (asyncio.TimeoutError, discord.ClientException) as e:
+            print(f"VC参加者の取得に失敗しました: {e!r}")
+            continue
+        metrics.members_resolved.inc(len(found), source='gateway')
+        for member in found:
+            members[member.id] = member
+            # キャッシュに加わったメンバー
+            admin_index.update_member(member)
+    for user_id in missing:
+        if members[user_id] is not None:
+            continue
+        try:
+            members[user_id] = await guild.fetch_member(user_id)
+            metrics.members_resolved.inc(source='rest')
+        except discord.HTTPException:
+            # 取得の間にVCから抜けた（サーバーから抜けた）人は数えない
+            pass
+    return [member for member in members.values() if member is not None and not member.bot]
+
+def report_startup(phase, label):
+    """
+    起動から phase に初めて達した時間を記録して表示する
+    """
+    elapsed = metrics.mark_startup(phase)
+    if elapsed is not None:
+        print(f"起動から {elapsed:.2f} 秒で{label}")
+
+@bot.event
+async def on_connect():
+    report_startup('connected', 'ゲートウェイに接続しました')
+
+@bot.event
+async def on_interaction(interaction):
+    report_startup('first_command', '最初のコマンドを受け付けました')
 
 @bot.event
 async def on_ready():
+    global channel_pool_sweeper, metrics_server, shared_sessions_resumed
     print(f'{bot.user} がログインしました！')
-    # スラッシュコマンドを同期
+    report_startup('ready', f"準備が完了しました（{len(bot.guilds)} サーバー）")
+    summary = metrics.cache_summary(bot)
+    if summary['guilds']:
+        print(f"常駐メモリ {summary['rss_bytes'] / 2**20:.1f} MB（サーバーあたり {summary['per_guild_bytes'] / 2**10:.1f} KB、"
+              f"メンバー {summary['members']}、メッセージ {summary['messages']} をキャッシュ中）")
+    # メトリクスの公開を開始（初回のみ）
+    if METRICS_PORT and metrics_server is None:
+        metrics_server = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        metrics.install_log_hooks()
+        metrics.watch_client(bot)
+        metrics.watch_outbound(outbound)
+        metrics.watch_cache(bot)
+        metrics.watch_session_backend(session_backend)
+        asyncio.create_task(metrics.monitor_loop_lag())
+        print(f"メトリクスを http://{METRICS_HOST}:{METRICS_PORT}/metrics で公開しています")
+    # 停止中に期限が来た後片付けを実行（初回のみ）
+    await scheduler.start()
+    # 持ち主がいなくなった他のプロセスのセッションを引き継ぎ、持ち主の期限の延長を始める（初回のみ）
+    # 引き継ぐ一時チャンネルを貸し出し中にするため、チャンネルプールの回収より先に行う
+    if not shared_sessions_resumed:
+        shared_sessions_resumed = True
+        await resume_shared_sessions()
+        asyncio.create_task(keep_shared_sessions())
+    # 取り残されたチャンネルの回収とプールの補充を開始
+    if channel_pool.enabled and channel_pool_sweeper is None:
+        channel_pool_sweeper = asyncio.create_task(channel_pool.run_sweeper(bot))
+    # 再接続時は切断中のリアクションを照合
+    await reconcile_exclusion_sessions()
+    # スラッシュコマンドを同期（クラスタ構成では代表の1プロセスだけが行う）
+    if CLUSTER_ID != 0:
+        return
+    # 開発用サーバーが指定されていればそのサーバーだけに同期（即時反映）
+    dev_guild = discord.Object(id=DEV_GUILD_ID) if DEV_GUILD_ID else None
     try:
-        synced = await bot.tree.sync()
-        print(f"{len(synced)} 個のスラッシュコマンドを同期しました")
+        synced = await sync_if_changed(bot.tree, bot.application_id, COMMAND_SYNC_STATE_PATH,
+                                       guild=dev_guild, force=FORCE_COMMAND_SYNC)
+        if synced is None:
+            print("スラッシュコマンドに変更がないため同期を省略しました")
+        else:
+            print(f"{len(synced)} 個のスラッシュコマンドを同期しました")
     except Exception as e:
         print(f"スラッシュコマンドの同期に失敗しました: {e}")
 
@@ -69,10 +405,15 @@ async def on_ready():
 @discord.app_commands.describe(
     excluded_roles='除外するロール（スペース区切り）例: top mid'
 )
+@metrics.track_command('role')
+@tracing.traced('role')
 async def start_role_assignment(interaction: discord.Interaction, excluded_roles: str = None):
     """
     ロール決めを開始するスラッシュコマンド
     """
+    if not await admit_session(interaction):
+        return
+    
     # 除外ロールの処理
     excluded = set()
     if excluded_roles:
@@ -81,7 +422,8 @@ async def start_role_assignment(interaction: discord.Interaction, excluded_roles
             if role in ROLES:
                 excluded.add(role)
             else:
-                await interaction.response.send_message(
+                await respond(
+                    interaction,
                     f"'{role}' は無効なロールです。利用可能なロール: {', '.join(ROLES.keys())}", 
                     ephemeral=True
                 )
@@ -90,7 +432,7 @@ async def start_role_assignment(interaction: discord.Interaction, excluded_roles
     available_roles = [role for role in ROLES.keys() if role not in excluded]
     
     if len(available_roles) == 0:
-        await interaction.response.send_message("全てのロールが除外されています！", ephemeral=True)
+        await respond(interaction, "全てのロールが除外されています！", ephemeral=True)
         return
     
     excluded_text = f" (除外: {', '.join(excluded)})" if excluded else ""
@@ -106,37 +448,62 @@ async def start_role_assignment(interaction: discord.Interaction, excluded_roles
     number_emojis = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣']
     display_numbers = number_emojis[:max_participants]
     
-    participation_text = f"{' '.join(display_numbers)} のいずれかでリアクション"
+    if USE_COMPONENT_UI:
+        participation_text = f"{' '.join(display_numbers)} のいずれかのボタンを押す（もう一度押すと取り消し）"
+    else:
+        participation_text = f"{' '.join(display_numbers)} のいずれかでリアクション"
     embed.add_field(name="参加方法", value=participation_text, inline=False)
     embed.add_field(name="抽選開始", value="🎲 をクリックして抽選スタート！", inline=False)
     embed.add_field(name="参加可能人数", value=f"最大 {max_participants} 人", inline=False)
     embed.set_footer(text="参加者が揃ったら🎲で抽選開始（5分でタイムアウト）")
     
-    await interaction.response.send_message(embed=embed)
-    message = await interaction.original_response()
-    
-    # 利用可能なロール数分だけ数字の絵文字を追加
-    for num in display_numbers:
-        await message.add_reaction(num)
-    
-    # 抽選開始用の絵文字を追加
-    await message.add_reaction('🎲')
+    if USE_COMPONENT_UI:
+        # ボタン付きでメッセージを1回で作成
+        inbox = ReactionInbox(timers=scheduler)
+        view = session_views.lottery_view(inbox.push, display_numbers)
+        with tracing.span('send_message'):
+            await respond(interaction, embed=embed, view=view)
+            message = await interaction.original_response()
+    else:
+        view = None
+        with tracing.span('send_message'):
+            await respond(interaction, embed=embed)
+            message = await interaction.original_response()
+        
+        # リアクションの追加中に押された分も受け取れるよう、先に受信箱を登録
+        inbox = reaction_router.open_inbox(message.id)
+        
+        # 利用可能なロール数分だけ数字の絵文字と、抽選開始用の絵文字を追加
+        with tracing.span('add_reactions', count=len(display_numbers) + 1):
+            await add_reactions(message, display_numbers + ['🎲'])
     
     # リアクション監視を開始
-    await monitor_lottery_reaction(interaction, message, available_roles)
+    try:
+        await monitor_lottery_reaction(interaction, message, available_roles, inbox)
+    finally:
+        if view is not None:
+            view.stop()
 
-async def monitor_lottery_reaction(interaction, message, available_roles):
+async def monitor_lottery_reaction(interaction, message, available_roles, inbox):
     """
     抽選開始リアクションを監視する
     """
-    def check(reaction, user):
-        return (reaction.message.id == message.id and 
-                str(reaction.emoji) == '🎲' and 
-                not user.bot)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + 300.0  # 5分でタイムアウト
+    
+    # 参加者と選んだ数字をリアクションの到着順に追跡
+    participant_numbers = {}  # ユーザーID → 選んでいる数字のビットマスク
+    participant_members = {}  # ユーザーID → Member
     
     try:
         # 抽選開始リアクションを待機
-        reaction, user = await bot.wait_for('reaction_add', timeout=300.0, check=check)  # 5分でタイムアウト
+        while True:
+            event = await inbox.get(timeout=deadline - loop.time())
+            if event.emoji in NUMBER_MAP:
+                track_participant_event(participant_numbers, participant_members, event)
+            elif event.added and event.emoji == '🎲':
+                break
+        inbox.close()
         
         # 抽選開始メッセージ
         lottery_embed = discord.Embed(
@@ -144,17 +511,28 @@ async def monitor_lottery_reaction(interaction, message, available_roles):
             description="ロールを決めています...",
             color=0xffff00
         )
-        await interaction.followup.send(embed=lottery_embed)
+        await send_followup(interaction, embed=lottery_embed)
         
-        # 少し待機（演出）
-        await asyncio.sleep(2)
+        participants = {
+            # 一番小さい数字（最下位のビット）で参加
+            user_id: {'user': participant_members[user_id], 'number': (numbers & -numbers).bit_length() - 1}
+            for user_id, numbers in participant_numbers.items()
+        }
         
-        # メッセージを再取得してリアクションを確認
-        try:
-            message = await interaction.channel.fetch_message(message.id)
-            await assign_roles(interaction, message, available_roles)
-        except discord.NotFound:
-            await interaction.followup.send("メッセージが見つかりません。")
+        if VERIFY_REACTION_STATE and not USE_COMPONENT_UI:
+            # メッセージを再取得してリアクションを確認
+            try:
+                message = await interaction.channel.fetch_message(message.id)
+                server_participants = await fetch_role_participants(message)
+            except discord.NotFound:
+                await send_followup(interaction, "メッセージが見つかりません。")
+                return
+            tracked = {user_id: data['number'] for user_id, data in participants.items()}
+            if tracked != {user_id: data['number'] for user_id, data in server_participants.items()}:
+                print(f"参加者の追跡結果がサーバーと一致しません（メッセージ {message.id}）。サーバー側を使用します")
+                participants = server_participants
+        
+        await assign_roles(interaction, message, available_roles, participants)
             
     except asyncio.TimeoutError:
         timeout_embed = discord.Embed(
@@ -162,51 +540,60 @@ async def monitor_lottery_reaction(interaction, message, available_roles):
             description="5分間反応がなかったため、ゲームを終了しました。",
             color=0xff0000
         )
-        await interaction.followup.send(embed=timeout_embed)
+        await send_followup(interaction, embed=timeout_embed)
+    finally:
+        inbox.close()
 
-async def assign_roles(interaction, message, available_roles):
+def track_participant_event(participant_numbers, participant_members, event):
     """
-    実際にロールを割り当てる処理
+    数字リアクションの追加・削除で参加者の選んだ数字を更新する
+    """
+    bit = 1 << NUMBER_MAP[event.emoji]
+    if event.added:
+        participant_numbers[event.user_id] = participant_numbers.get(event.user_id, 0) | bit
+        participant_members[event.user_id] = event.member
+    elif event.user_id in participant_numbers:
+        numbers = participant_numbers[event.user_id] & ~bit
+        participant_numbers[event.user_id] = numbers
+        if not numbers:
+            # 数字を全て外したら参加取り消し
+            del participant_numbers[event.user_id]
+            del participant_members[event.user_id]
+
+async def fetch_role_participants(message):
+    """
+    メッセージのリアクションから参加者を収集する（サーバーとの照合用）
     """
     participants = {}
     
-    # リアクションから参加者を収集
-    number_map = {'1️⃣': 1, '2️⃣': 2, '3️⃣': 3, '4️⃣': 4, '5️⃣': 5}
-    
     for reaction in message.reactions:
-        if reaction.emoji in number_map:
+        if reaction.emoji in NUMBER_MAP:
             async for user in reaction.users():
                 if not user.bot:  # Botを除外
-                    user_number = number_map[reaction.emoji]
+                    user_number = NUMBER_MAP[reaction.emoji]
                     if user.id not in participants:  # 重複参加防止
                         participants[user.id] = {
                             'user': user,
                             'number': user_number
                         }
     
+    return participants
+
+async def assign_roles(interaction, message, available_roles, participants):
+    """
+    実際にロールを割り当てる処理
+    """
     if len(participants) == 0:
-        await interaction.followup.send("参加者がいません！")
+        await send_followup(interaction, "参加者がいません！")
         return
     
     # ロール割り当て
-    assignments = {}
-    
-    # 参加者をシャッフル
-    participant_list = list(participants.values())
-    random.shuffle(participant_list)
-    
-    # ロールを割り当て
-    for i, participant in enumerate(participant_list):
-        if i < len(available_roles):
-            role = available_roles[i]
-            assignments[participant['user']] = {
-                'role': role,
-                'number': participant['number']
-            }
+    assignments = draw_lottery_assignments(list(participants.values()), available_roles)
     
     # 結果を保存（チャンネルとゲームIDで識別）
     game_id = f"{interaction.channel_id}_{message.id}"
-    role_results[game_id] = assignments
+    await save_role_result(game_id, interaction.guild_id, interaction.channel_id, 'role',
+                     [(user.id, user.display_name, data['role']) for user, data in assignments.items()])
     
     # 結果をチャンネルに表示（参加者のみ表示、ロールは隠す）
     if assignments:
@@ -227,18 +614,216 @@ async def assign_roles(interaction, message, available_roles):
         # 参加者に通知するためのメンションを作成
         mentions = " ".join([user.mention for user in assignments.keys()])
         
-        await interaction.followup.send(f"🎉 {mentions}", embed=embed)
+        await send_followup(interaction, f"🎉 {mentions}", embed=embed)
     else:
-        await interaction.followup.send("ロールを割り当てできませんでした。")
+        await send_followup(interaction, "ロールを割り当てできませんでした。")
+
+def draw_lottery_assignments(participant_list, available_roles):
+    """
+    参加者をシャッフルし、先頭から順にロールを割り当てる（ロール数を超えた参加者は割り当てなし）
+    """
+    participant_list = list(participant_list)
+    random.shuffle(participant_list)
+    
+    assignments = {}
+    for participant, role in zip(participant_list, available_roles):
+        assignments[participant['user']] = {
+            'role': role,
+            'number': participant['number']
+        }
+    return assignments
+
+async def save_role_result(game_id, guild_id, channel_id, kind, assignments):
+    """
+    ロール結果を保存する（どのプロセスの /last_role からも見えるようにセッション状態の保存先に置く）
+
+    assignments は (ユーザーID, 表示名, ロールキー) のリスト。
+    """
+    result = {
+        'kind': kind,
+        'channel_id': channel_id,
+        'assignments': list(assignments),
+        'created_at': time.time()
+    }
+    try:
+        await session_backend.set(f"result:{game_id}", result, ttl=ROLE_RESULT_TTL)
+        await session_backend.set(f"last_result:{channel_id}", game_id, ttl=ROLE_RESULT_TTL)
+    except BACKEND_ERRORS as e:
+        print(f"ロール結果を保存できませんでした: {e!r}")
+    
+    # 履歴に追記（書き込みは別スレッドで行われる）
+    if history_store is not None and guild_id is not None:
+        history_store.record(guild_id, channel_id, game_id, kind,
+                             [(user_id, role_key) for user_id, _, role_key in assignments])
+
+async def get_last_result(channel_id):
+    """
+    チャンネルで最後に決まったロール結果（なければ None）
+    """
+    game_id, _ = await session_backend.get(f"last_result:{channel_id}")
+    if game_id is None:
+        return None
+    result, _ = await session_backend.get(f"result:{game_id}")
+    return result
+
+async def update_shared_session(key, func):
+    """
+    保存先の進行中のセッションの記録を func で書き換える（他のプロセスと衝突したら読み直す）
+
+    記録がない・保存先が使えない時は None を返す（呼び出し側はこのプロセスだけで続ける）。
+    """
+    if key is None:
+        return None
+    try:
+        return await session_backend.update(key, func, ttl=SHARED_SESSION_TTL)
+    except BACKEND_ERRORS as e:
+        print(f"セッション状態を更新できませんでした（{key}）: {e!r}")
+        return None
+
+async def record_session_message(key, message_id):
+    """
+    セッションのメッセージIDを記録する（これが記録されたセッションだけを引き継げる）
+    """
+    await update_shared_session(key, lambda record: record and {**record, 'message_id': message_id})
+
+async def delete_shared_session(key):
+    if key is None:
+        return
+    owned_shared_sessions.discard(key)
+    try:
+        await session_backend.delete(key)
+    except BACKEND_ERRORS as e:
+        print(f"セッション状態を削除できませんでした（{key}）: {e!r}")
+
+async def publish_shared_session(key, record):
+    """
+    このプロセスを持ち主としてセッションを保存先に記録する。記録できたら True
+    """
+    record = {**record, 'owner': INSTANCE_ID, 'lease_until': time.time() + SHARED_SESSION_LEASE}
+    try:
+        await session_backend.set(key, record, ttl=SHARED_SESSION_TTL)
+    except BACKEND_ERRORS as e:
+        print(f"セッション状態を保存できませんでした（{key}）: {e!r}")
+        return False
+    owned_shared_sessions.add(key)
+    return True
+
+async def take_over_shared_session(key, owner):
+    """
+    持ち主が owner のまま期限の切れたセッションをこのプロセスのものにする。引き継げたら新しい記録を返す
+    """
+    def take_over(record):
+        if record is None or record['owner'] != owner or record.get('executed'):
+            return None
+        if record['lease_until'] > time.time():
+            # 持ち主がまだ期限を延ばしている
+            return None
+        return {**record, 'owner': INSTANCE_ID, 'lease_until': time.time() + SHARED_SESSION_LEASE}
+    record = await update_shared_session(key, take_over)
+    if record is not None:
+        owned_shared_sessions.add(key)
+    return record
+
+async def renew_shared_sessions():
+    """
+    このプロセスが持ち主のセッションの期限を延ばす
+    """
+    def renew(record):
+        if record is None or record['owner'] != INSTANCE_ID:
+            return record
+        return {**record, 'lease_until': time.time() + SHARED_SESSION_LEASE}
+    for key in list(owned_shared_sessions):
+        record = await update_shared_session(key, renew)
+        if record is not None and record['owner'] != INSTANCE_ID:
+            # 延ばせないほど止まっていた間に他のプロセスが引き継いだ
+            print(f"セッションの持ち主が他のプロセスに移りました（{key}）")
+            owned_shared_sessions.discard(key)
+
+async def keep_shared_sessions():
+    """
+    持ち主の期限を定期的に延ばし、期限の切れた他のプロセスのセッションを引き継ぎ続ける
+    """
+    while not bot.is_closed():
+        await asyncio.sleep(SHARED_SESSION_LEASE / 3)
+        await renew_shared_sessions()
+        await resume_shared_sessions()
+
+@bot.tree.command(name='last_role', description='このチャンネルで最後に決まったロール結果を表示します')
+@metrics.track_command('last_role')
+async def show_last_role_result(interaction: discord.Interaction):
+    """
+    直近のロール結果を表示するスラッシュコマンド
+    """
+    try:
+        result = await get_last_result(interaction.channel_id)
+    except BACKEND_ERRORS as e:
+        print(f"ロール結果を読み込めませんでした: {e!r}")
+        result = None
+    if result is None:
+        await respond(interaction, "このチャンネルのロール結果はありません。", ephemeral=True)
+        return
+    
+    embed = discord.Embed(
+        title="📜 直近のロール結果",
+        description=f"<t:{int(result['created_at'])}:R> に決定",
+        color=0x0099ff
+    )
+    result_text = ""
+    for user_id, display_name, role_key in result['assignments']:
+        role_name = ROLES[role_key]
+        role_emoji = ROLE_MESSAGES[role_key]['emoji']
+        result_text += f"{display_name} → **{role_emoji} {role_name}**\n"
+    embed.add_field(name="🎯 ロール割り当て結果", value=result_text, inline=False)
+    await respond(interaction, embed=embed)
+
+@bot.tree.command(name='stats', description='ロールの担当回数を表示します')
+@discord.app_commands.describe(
+    member='集計するメンバー（省略時は自分）'
+)
+@metrics.track_command('stats')
+async def show_role_stats(interaction: discord.Interaction, member: discord.Member = None):
+    """
+    サーバー内でのロール担当回数を表示するスラッシュコマンド
+    """
+    if history_store is None:
+        await respond(interaction, "履歴の保存が無効になっています。", ephemeral=True)
+        return
+    if interaction.guild_id is None:
+        await respond(interaction, "サーバー内で実行してください。", ephemeral=True)
+        return
+    
+    target = member or interaction.user
+    frequency = await history_store.role_frequency(interaction.guild_id, target.id)
+    total = sum(frequency.values())
+    if total == 0:
+        await respond(interaction, f"{target.display_name} のロール履歴はまだありません。", ephemeral=True)
+        return
+    
+    embed = discord.Embed(
+        title=f"📊 {target.display_name} のロール担当回数",
+        description=f"合計 {total} 回",
+        color=0x0099ff
+    )
+    stats_text = ""
+    for role_key, role_name in ROLES.items():
+        count = frequency.get(role_key, 0)
+        stats_text += f"{ROLE_MESSAGES[role_key]['emoji']} {role_name}: {count}回 ({count / total:.0%})\n"
+    embed.add_field(name="🎯 ロール別", value=stats_text, inline=False)
+    await respond(interaction, embed=embed)
 
 @bot.tree.command(name='secret_role', description='秘密のロール決めを開始します（VC参加者限定）')
 @discord.app_commands.describe(
     excluded_roles='除外するロール（スペース区切り）例: top mid'
 )
+@metrics.track_command('secret_role')
+@tracing.traced('secret_role')
 async def secret_role_assignment(interaction: discord.Interaction, excluded_roles: str = None):
     """
     秘密のロール決めを開始するスラッシュコマンド（VC参加者限定）
     """
+    if not await admit_session(interaction):
+        return
+    
     # 除外ロールの処理
     excluded = set()
     if excluded_roles:
@@ -247,7 +832,8 @@ async def secret_role_assignment(interaction: discord.Interaction, excluded_role
             if role in ROLES:
                 excluded.add(role)
             else:
-                await interaction.response.send_message(
+                await respond(
+                    interaction,
                     f"'{role}' は無効なロールです。利用可能なロール: {', '.join(ROLES.keys())}", 
                     ephemeral=True
                 )
@@ -256,7 +842,7 @@ async def secret_role_assignment(interaction: discord.Interaction, excluded_role
     available_roles = [role for role in ROLES.keys() if role not in excluded]
     
     if len(available_roles) == 0:
-        await interaction.response.send_message("全てのロールが除外されています！", ephemeral=True)
+        await respond(interaction, "全てのロールが除外されています！", ephemeral=True)
         return
     
     # ロールをランダムにシャッフル
@@ -272,17 +858,19 @@ async def secret_role_assignment(interaction: discord.Interaction, excluded_role
     
     if command_user.voice and command_user.voice.channel:
         vc_channel = command_user.voice.channel
-        vc_members = [member for member in vc_channel.members if not member.bot]
+        vc_members = await resolve_voice_members(vc_channel, interaction)
         vc_channel_name = vc_channel.name
         
         if len(vc_members) < len(available_roles):
-            await interaction.response.send_message(
+            await respond(
+                interaction,
                 f"⚠️ VC参加者が不足しています。必要: {len(available_roles)}人、現在: {len(vc_members)}人", 
                 ephemeral=True
             )
             return
     else:
-        await interaction.response.send_message(
+        await respond(
+            interaction,
             "⚠️ ボイスチャンネルに参加してからコマンドを実行してください。", 
             ephemeral=True
         )
@@ -297,6 +885,9 @@ async def secret_role_assignment(interaction: discord.Interaction, excluded_role
         guild.default_role: discord.PermissionOverwrite(read_messages=False),  # @everyone は見えない
         guild.me: discord.PermissionOverwrite(read_messages=True, send_messages=True)  # Bot権限のみ
     }
+    if channel_pool.enabled:
+        # 使い回す前にメッセージを消せるように
+        overwrites[guild.me].update(manage_messages=True, read_message_history=True)
     
     # VC参加者にのみ権限を付与
     for member in vc_members:
@@ -304,18 +895,30 @@ async def secret_role_assignment(interaction: discord.Interaction, excluded_role
     
     # 管理者権限を持つ人も明示的に除外（VC参加者でない場合）
     vc_member_ids = {member.id for member in vc_members}
-    for member in guild.members:
-        if member.guild_permissions.administrator and member.id not in vc_member_ids and not member.bot:
-            overwrites[member] = discord.PermissionOverwrite(read_messages=False)  # 管理者でもVC非参加なら見えない
+    for admin_id in admin_index.admin_ids(guild):
+        if admin_id not in vc_member_ids:
+            # 管理者でもVC非参加なら見えない
+            overwrites[discord.Object(id=admin_id, type=discord.Member)] = discord.PermissionOverwrite(read_messages=False)
+    
+    # チャンネル作成はサーバーごとのレート制限で待たされることがあるので、先に応答を保留する
+    await defer(interaction)
     
-    # 一時チャンネル作成
+    # 一時チャンネル作成（プールが有効なら待機中のチャンネルを借りる）
     temp_channel_name = f"🔒role-決め-{vc_channel_name.lower()}"
-    temp_channel = await guild.create_text_channel(
-        name=temp_channel_name,
-        category=category,
-        overwrites=overwrites,
-        topic=f"🎤 {vc_channel_name} 参加者限定のロール決め"
-    )
+    temp_channel_topic = f"🎤 {vc_channel_name} 参加者限定のロール決め"
+    if channel_pool.enabled:
+        temp_channel = await channel_pool.acquire(guild, temp_channel_name, category, overwrites, temp_channel_topic)
+    else:
+        temp_channel = await outbound.submit(
+            ('channels', guild.id),
+            guild.create_text_channel,
+            name=temp_channel_name,
+            category=category,
+            overwrites=overwrites,
+            topic=temp_channel_topic
+        )
+    # 途中で落ちても取り残されないよう、タイムアウト後の削除を先に予約しておく
+    schedule_temp_channel_disposal(temp_channel, SECRET_SESSION_TIMEOUT + SECRET_CHANNEL_DELETE_DELAY)
     
     # 元のチャンネルで案内メッセージ
     vc_member_list = ", ".join([member.display_name for member in vc_members])
@@ -328,7 +931,8 @@ async def secret_role_assignment(interaction: discord.Interaction, excluded_role
     guide_embed.add_field(name="👥 対象者", value=vc_member_list, inline=False)
     guide_embed.add_field(name="⚠️ 注意", value="ロール決め完了後、チャンネルは自動削除されます", inline=False)
     
-    await interaction.response.send_message(embed=guide_embed)
+    # 案内は専用チャンネルへの送信と並行して送る
+    guide_response = respond(interaction, embed=guide_embed)
     
     # 専用チャンネルでロール決めメッセージを送信
     embed = discord.Embed(
@@ -346,114 +950,332 @@ async def secret_role_assignment(interaction: discord.Interaction, excluded_role
     display_numbers = number_emojis[:max_participants]
     
     # 数字とロールの対応を表示（ロール名は隠す）
-    participation_text = f"{' '.join(display_numbers)} から選択してください"
+    if USE_COMPONENT_UI:
+        participation_text = f"{' '.join(display_numbers)} のボタンから選択してください"
+    else:
+        participation_text = f"{' '.join(display_numbers)} から選択してください"
     embed.add_field(name="参加方法", value=participation_text, inline=False)
     embed.add_field(name="利用可能なロール", value=f"{', '.join([ROLES[role] for role in available_roles])}", inline=False)
-    embed.add_field(name="⚠️ 重要", value="数字を選ぶと即座にロールが確定します！", inline=False)
+    embed.add_field(name="⚠️ 重要", value="数字を選ぶと即座にロールが確定します！（1人1ロールまで）", inline=False)
     embed.add_field(name="🔒 プライバシー", value="結果はチャンネル内で表示されます", inline=False)
     embed.set_footer(text="一度選択すると変更できません")
     
-    message = await temp_channel.send(embed=embed)
-    
-    # 利用可能なロール数分だけ数字の絵文字を追加
-    for num in display_numbers:
-        await message.add_reaction(num)
-    
-    # 数字とロールの対応を保存
-    role_mapping = {}
-    for i, role in enumerate(shuffled_roles):
-        if i < len(display_numbers):
-            role_mapping[display_numbers[i]] = role
+    # 数字とロール（番号とキー）の対応を保存
+    role_mapping = {
+        emoji: (ROLE_INDEX[role], role)
+        for emoji, role in zip(display_numbers, shuffled_roles)
+    }
+    session = SecretSession(embed, role_mapping)
+    # 選択は保存先で確定するので、メッセージより先に記録を置く
+    await share_secret_session(session, temp_channel, vc_member_ids)
+    
+    if USE_COMPONENT_UI:
+        # ボタン付きでメッセージを1回で作成
+        session.inbox = ReactionInbox(timers=scheduler)
+        view = session_views.secret_selection_view(lambda event: claim_secret_pick(session, event), display_numbers, vc_member_ids)
+        message = await send_to_channel(temp_channel, embed=embed, view=view)
+    else:
+        view = None
+        message = await send_to_channel(temp_channel, embed=embed)
+        
+        # リアクションの追加中に押された分も受け取れるよう、先に登録
+        session.inbox = ReactionInbox(reaction_router, message.id, timers=scheduler)
+        reaction_router.register(message.id, lambda event: claim_secret_pick(session, event))
+    await record_session_message(session.shared_key, message.id)
+    
+    session.status_message = CoalescedEditor(
+        message, lambda: {'embed': build_secret_status_embed(session)}, delay=SECRET_STATUS_EDIT_DELAY,
+        edit=edit_message
+    )
     
-    # 選択済みロールを管理
-    selected_roles = set()
+    if not USE_COMPONENT_UI:
+        # 利用可能なロール数分だけ数字の絵文字を追加
+        with tracing.span('add_reactions', count=len(display_numbers)):
+            await add_reactions(message, display_numbers)
     
     # リアクション監視を開始
-    await monitor_temp_channel_role_selection(interaction, message, role_mapping, selected_roles, temp_channel)
+    try:
+        await guide_response
+        await monitor_temp_channel_role_selection(interaction, message, session, temp_channel)
+    finally:
+        if view is not None:
+            view.stop()
+
+async def share_secret_session(session, temp_channel, member_ids):
+    """
+    /secret_role のセッションを保存先に記録する（保存先が使えなければこのプロセスだけで進める）
+    """
+    key = f"secret:{temp_channel.id}"
+    record = {
+        'guild_id': temp_channel.guild.id,
+        'channel_id': temp_channel.id,
+        'message_id': None,
+        'embed': session.embed.to_dict(),
+        'role_mapping': session.role_mapping,
+        'member_ids': sorted(member_ids),
+        'selected': 0,
+        'picks': [],
+        'ui': 'components' if USE_COMPONENT_UI else 'reactions'
+    }
+    if await publish_shared_session(key, record):
+        session.shared_key = key
+
+def claim_secret_pick(session, event):
+    """
+    数字の選択を受け取ったら、セッション状態の保存先でロールを確定する（REST呼び出しなし）
+
+    確定は保存先の compare-and-set で行うので、同時に押されても（別のプロセスで受け取っても）
+    同じロールが二重に確定したり、1人が複数のロールを取ったりすることはない。表示の更新は後でまとめて行う。
+    """
+    if session.closed or not event.added or event.emoji not in session.role_mapping:
+        return
+    # 受け取った順に1件ずつ確定する（失敗は表示され、セッションの終了時に残りを待つ）
+    session.claims.submit(_claim_secret_pick, session, event)
+
+def secret_pick_outcome(selected, picks, user_id, role_number, role_key):
+    """
+    選択の結果: 'claimed'（確定）・'picked'（同じ選択が確定済み）・'already'（既に別のロールが決まっている）・
+    'taken'（他の人が選択済み）
+
+    同じ選択が2回届いた時（2つのプロセスが同じイベントを受け取った時など）は 'picked' で、成功として扱う。
+    """
+    for pick in picks:
+        if pick[0] == user_id:
+            return 'picked' if pick[2] == role_key else 'already'
+    if selected >> role_number & 1:
+        return 'taken'
+    return 'claimed'
+
+async def _claim_secret_pick(session, event):
+    user = event.member
+    role_number, assigned_role = session.role_mapping[event.emoji]
+    pick = (user.id, user.display_name, assigned_role)
+    outcome = None
+    
+    def claim(record):
+        nonlocal outcome
+        if record is None:
+            return None
+        outcome = secret_pick_outcome(record['selected'], record['picks'], user.id, role_number, assigned_role)
+        if outcome != 'claimed':
+            return record
+        return {**record, 'selected': record['selected'] | 1 << role_number, 'picks': record['picks'] + [list(pick)]}
+    
+    record = None
+    if session.shared_key is not None:
+        try:
+            record = await session_backend.update(session.shared_key, claim, ttl=SHARED_SESSION_TTL)
+        except BACKEND_ERRORS as e:
+            # 保存先で確定できなかった選択は手元でも確定しない（他のプロセスと食い違わないように）
+            print(f"ロールの選択を確定できませんでした（{session.shared_key}）: {e!r}")
+            outcome = 'failed'
+    if session.closed:
+        return
+    if record is not None:
+        # 他のプロセスで確定した分も含めて手元の状態を合わせる
+        session.selected = record['selected']
+        session.picks = [tuple(p) for p in record['picks']]
+    if outcome is None:
+        # 保存先に記録していないセッションはこのプロセスだけで確定する
+        outcome = secret_pick_outcome(session.selected, session.picks, user.id, role_number, assigned_role)
+        if outcome == 'claimed':
+            session.selected |= 1 << role_number
+            session.picks.append(pick)
+    
+    if outcome == 'failed':
+        session.warnings[user.id] = f"{user.mention} 数字 {event.emoji} の選択を確定できませんでした。もう一度選んでください。"
+    elif outcome == 'already':
+        # 1人1ロールまで
+        session.warnings[user.id] = f"{user.mention} は既にロールが決まっています（1人1ロールまで）。"
+    elif outcome == 'taken':
+        # すでに選択済みのロールの場合
+        session.warnings[user.id] = f"{user.mention} 数字 {event.emoji} のロールは既に他の人が選択しています。別の数字を選んでください。"
+    else:
+        session.warnings.pop(user.id, None)
+    
+    if session.status_message is not None:
+        session.status_message.update()
+    # 監視側にはタイムアウトの延長と完了の確認だけを任せる
+    session.inbox.push(event)
 
-async def monitor_temp_channel_role_selection(interaction, message, role_mapping, selected_roles, temp_channel):
+async def monitor_temp_channel_role_selection(interaction, message, session, temp_channel):
     """
-    一時チャンネルでの数字リアクションを監視して即座にロール決定
+    一時チャンネルでのロール選択の完了とタイムアウトを監視する
+
+    ロールの確定は claim_secret_pick が選択の受信時に行う。決定したロールと残りの選択肢は、
+    新しいメッセージを送らずにロール決めメッセージを書き換えて表示する（同時に押された分は1回の編集）。
     """
-    def check_number_reaction(reaction, user):
-        return (reaction.message.id == message.id and 
-                str(reaction.emoji) in role_mapping.keys() and 
-                not user.bot)
+    # 結果は一時チャンネル側に保存（元のチャンネルから秘密の結果が見えないように）
+    game_id = f"{temp_channel.id}_{message.id}"
+    inbox = session.inbox
+    status_message = session.status_message
     
     try:
-        while len(selected_roles) < len(role_mapping):
-            reaction, user = await bot.wait_for('reaction_add', timeout=300.0, check=check_number_reaction)
-            
-            selected_emoji = str(reaction.emoji)
-            assigned_role = role_mapping[selected_emoji]
-            
-            # 重複チェック
-            if assigned_role in selected_roles:
-                # すでに選択済みのロールの場合
-                duplicate_embed = discord.Embed(
-                    title="⚠️ 既に選択済み",
-                    description=f"数字 {selected_emoji} のロールは既に他の人が選択しています。\n{user.mention} は別の数字を選んでください。",
-                    color=0xff9900
-                )
-                await temp_channel.send(embed=duplicate_embed)
-                continue
-            
-            # ロールを確定
-            selected_roles.add(assigned_role)
-            
-            # ユーザーに結果を通知（普通のメッセージ）
-            role_data = ROLE_MESSAGES[assigned_role]
-            role_name = ROLES[assigned_role]
-            number_index = list(role_mapping.keys()).index(selected_emoji) + 1
-            
-            result_embed = discord.Embed(
-                title=f"{role_data['emoji']} {user.display_name} のロール: {role_data['title']}",
-                description=role_data['message'],
-                color=0x9932cc
-            )
-            result_embed.add_field(name="🎯 選んだ数字", value=f"{selected_emoji} (番号: {number_index})", inline=True)
-            result_embed.add_field(name="🎮 確定ロール", value=role_name, inline=True)
-            result_embed.add_field(name="💡 アドバイス", value=role_data['tips'], inline=False)
-            
-            await temp_channel.send(embed=result_embed)
-            
-            # 進行状況を表示
-            progress_embed = discord.Embed(
-                title="🔒 秘密ロール選択中...",
-                description=f"参加者: {len(selected_roles)}/{len(role_mapping)} 人がロール決定",
-                color=0x9932cc
-            )
-            if len(selected_roles) == len(role_mapping):
-                progress_embed.add_field(name="✅ 完了", value="全てのロールが決定しました！\n30秒後にこのチャンネルを削除します", inline=False)
-                await temp_channel.send(embed=progress_embed)
-                
-                # 30秒待ってからチャンネル削除
-                await asyncio.sleep(30)
-                try:
-                    await temp_channel.delete()
-                except:
-                    print(f"チャンネル削除失敗: {temp_channel.name}")
-                break
-            else:
-                remaining_numbers = [emoji for emoji, role in role_mapping.items() if role not in selected_roles]
-                progress_embed.add_field(name="🎯 残り選択肢", value=' '.join(remaining_numbers), inline=False)
-                await temp_channel.send(embed=progress_embed)
+        # 選択のたびに5分間の待機を延長
+        while not session.complete:
+            await inbox.get(timeout=SECRET_SESSION_TIMEOUT)
+            schedule_temp_channel_disposal(temp_channel, SECRET_SESSION_TIMEOUT + SECRET_CHANNEL_DELETE_DELAY)
+        
+        session.closed = True
+        session.status = ("✅ 完了", "全てのロールが決定しました！\n30秒後にこのチャンネルを削除します")
+        with tracing.span('edit_status', step='complete'):
+            await status_message.flush()
+        await save_role_result(game_id, temp_channel.guild.id, temp_channel.id, 'secret_role', session.picks)
+        
+        # 30秒後にチャンネル削除
+        schedule_temp_channel_disposal(temp_channel, SECRET_CHANNEL_DELETE_DELAY)
                 
     except asyncio.TimeoutError:
-        timeout_embed = discord.Embed(
-            title="⏰ タイムアウト",
-            description="5分間反応がなかったため、秘密ロール決めを終了しました。\n30秒後にこのチャンネルを削除します。",
-            color=0xff0000
+        session.closed = True
+        session.status = ("⏰ タイムアウト", "5分間反応がなかったため、秘密ロール決めを終了しました。\n30秒後にこのチャンネルを削除します。")
+        with tracing.span('edit_status', step='timeout'):
+            await status_message.flush()
+        if session.picks:
+            await save_role_result(game_id, temp_channel.guild.id, temp_channel.id, 'secret_role', session.picks)
+        schedule_temp_channel_disposal(temp_channel, SECRET_CHANNEL_DELETE_DELAY)
+    finally:
+        session.closed = True
+        inbox.close()
+        # 確定中の選択が終わってから記録を消す
+        await session.claims.drain()
+        await status_message.close()
+        await delete_shared_session(session.shared_key)
+
+# Embed の項目の値の最大文字数
+EMBED_FIELD_LIMIT = 1024
+
+def join_field_lines(lines, limit=EMBED_FIELD_LIMIT):
+    """
+    Embed の項目に収まるだけ行を並べ、収まらない分は「…他N人」にまとめる
+    """
+    text = "\n".join(lines)
+    if len(text) <= limit:
+        return text
+    shown = []
+    length = 0
+    for line in lines:
+        # 次の行と、残りの人数の行（「…他N人」は最大でもこの長さ）が収まる間だけ載せる
+        length += len(line) + 1
+        if length + len(f"…他{len(lines)}人") > limit:
+            break
+        shown.append(line)
+    return "\n".join(shown + [f"…他{len(lines) - len(shown)}人"])
+
+def build_secret_status_embed(session):
+    """
+    秘密のロール決めメッセージに、決定したロール・残りの選択肢・注意を書き足した Embed
+    """
+    role_mapping = session.role_mapping
+    status = session.status
+    # Embed.copy() は項目のリストを共有するので、元の Embed を書き換えないよう丸ごと複製する
+    status_embed = discord.Embed.from_dict(copy.deepcopy(session.embed.to_dict()))
+    emoji_by_role = {role: emoji for emoji, (_, role) in role_mapping.items()}
+    
+    for _, display_name, role_key in session.picks:
+        role_data = ROLE_MESSAGES[role_key]
+        status_embed.add_field(
+            name=f"{role_data['emoji']} {display_name} のロール: {role_data['title']}",
+            value=f"{emoji_by_role[role_key]} を選択 → **{ROLES[role_key]}**\n{role_data['message']}\n💡 {role_data['tips']}",
+            inline=False
         )
-        await temp_channel.send(embed=timeout_embed)
-        await asyncio.sleep(30)
+    
+    status_embed.add_field(name="📊 進行状況", value=f"参加者: {len(session.picks)}/{len(role_mapping)} 人がロール決定", inline=False)
+    if status is None:
+        remaining_numbers = [emoji for emoji, (role_number, _) in role_mapping.items() if not session.selected >> role_number & 1]
+        status_embed.add_field(name="🎯 残り選択肢", value=' '.join(remaining_numbers), inline=False)
+        if session.warnings:
+            status_embed.add_field(name="⚠️ 選択できません", value=join_field_lines(list(session.warnings.values())), inline=False)
+    else:
+        status_embed.add_field(name=status[0], value=status[1], inline=False)
+    return status_embed
+
+def schedule_temp_channel_disposal(temp_channel, delay):
+    """
+    一時チャンネルの削除を delay 秒後に予約する（予約済みなら置き換える）
+    """
+    scheduler.schedule('dispose_temp_channel', delay, {'channel_id': temp_channel.id},
+                       job_id=f"dispose_temp_channel:{temp_channel.id}")
+
+@scheduler.job('dispose_temp_channel')
+async def run_temp_channel_disposal(payload):
+    temp_channel = bot.get_channel(payload['channel_id'])
+    if temp_channel is None:
         try:
-            await temp_channel.delete()
-        except:
-            print(f"チャンネル削除失敗: {temp_channel.name}")
+            temp_channel = await bot.fetch_channel(payload['channel_id'])
+        except (discord.NotFound, discord.Forbidden):
+            # 既に削除済み
+            return
+    await dispose_temp_channel(temp_channel)
+
+async def dispose_temp_channel(temp_channel):
+    """
+    一時チャンネルを削除する（プールが有効なら片付けてプールに戻す）
+    """
+    try:
+        if channel_pool.enabled:
+            await channel_pool.release(temp_channel)
+        else:
+            # チャンネルの作成と削除はサーバーごとに同じ制限を受けるので、作成と同じバケットに並べる
+            await outbound.submit(('channels', temp_channel.guild.id), temp_channel.delete, priority=PRIORITY_BACKGROUND)
+    except:
+        print(f"チャンネル削除失敗: {temp_channel.name}")
+
+# サーバーごとの管理者メンバーの索引（/secret_role の権限設定用）
+admin_index = AdminIndex()
+
+@bot.event
+async def on_member_join(member):
+    admin_index.update_member(member)
+
+@bot.event
+async def on_member_update(before, after):
+    if before.roles != after.roles:
+        admin_index.update_member(after)
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    # メンバーのイベントを受け取らない場合も、ボイス状態で新しくキャッシュに加わった管理者を索引に載せる
+    admin_index.update_member(member)
+
+@bot.event
+async def on_raw_member_remove(payload):
+    admin_index.remove_member(payload.guild_id, payload.user.id)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    # ロールの管理者権限が変わったら、そのロールを持つ全員が変わりうるので作り直す
+    if role_grants_admin(before) != role_grants_admin(after):
+        admin_index.invalidate(after.guild.id)
 
-# ロール除外データを保存する辞書
-user_role_exclusions = {}
+@bot.event
+async def on_guild_role_delete(role):
+    if role_grants_admin(role):
+        admin_index.invalidate(role.guild.id)
+
+@bot.event
+async def on_guild_update(before, after):
+    # オーナーは常に管理者扱い
+    if before.owner_id != after.owner_id:
+        admin_index.invalidate(after.id)
+
+@bot.event
+async def on_guild_remove(guild):
+    admin_index.invalidate(guild.id)
+
+# 除外ロール選択メッセージID → 進行中の除外セッション
+# 除外設定はセッションが持つので、セッションが終わる（抽選・タイムアウト）と一緒に捨てられる
+exclusion_sessions = {}
+
+
+def count_active_sessions():
+    """
+    進行中のセッション数（リアクション方式の除外セッションは両方に登録されるので、メッセージIDで重複を除く）
+    """
+    return len(set(reaction_router.message_ids()) | exclusion_sessions.keys())
+
+
+# 切断などでリアクションイベントを取りこぼした可能性があるか
+reaction_events_may_be_missed = False
 
 # ロール文字のマッピング
 ROLE_LETTERS = {
@@ -464,11 +1286,61 @@ ROLE_LETTERS = {
     '❤️': 'sup'
 }
 
+# 除外設定の組み合わせごとの割り当て可否・割り当て数（起動時に一度だけ計算）
+FEASIBILITY_INDEX = FeasibilityIndex(len(ROLES))
+
+# /team_role の参加人数（5人ずつの2チーム）
+TEAM_MATCH_SIZE = 2 * len(ROLES)
+
+# /team_role のレート指定（「@メンバー 1500」の並び）
+RATING_PATTERN = re.compile(r'<@!?(\d+)>\s*[:=]?\s*(-?\d+(?:\.\d+)?)')
+
 @bot.tree.command(name='exclude_role', description='VC参加者限定：やりたくないロールを選んでからロール分けします')
+@metrics.track_command('exclude_role')
+@tracing.traced('exclude_role')
 async def exclude_role_assignment(interaction: discord.Interaction):
     """
     VC参加者限定でやりたくないロールを除外してロール分けを行う
     """
+    await open_exclusion_session(interaction)
+
+@bot.tree.command(name='team_role', description='VC参加者限定：10人を5人ずつのチームに分けてからロール分けします')
+@discord.app_commands.describe(
+    ratings='チーム分けに使うレート（任意）例: @Aさん 1500 @Bさん 1200'
+)
+@metrics.track_command('team_role')
+@tracing.traced('team_role')
+async def team_role_assignment(interaction: discord.Interaction, ratings: str = None):
+    """
+    VC参加者10人を、やりたくないロールを除外しつつレートが釣り合う2チームに分けてロール分けを行う
+    """
+    try:
+        rating_map = parse_ratings(ratings)
+    except ValueError as e:
+        await respond(interaction, f"⚠️ {e}", ephemeral=True)
+        return
+    await open_exclusion_session(interaction, team_mode=True, ratings=rating_map)
+
+def parse_ratings(text):
+    """
+    「@メンバー レート」の並びを {ユーザーID: レート} にする
+    """
+    if not text or not text.strip():
+        return {}
+    ratings = {int(user_id): float(value) for user_id, value in RATING_PATTERN.findall(text)}
+    if not ratings:
+        raise ValueError("レートは「@メンバー 1500」の形式で指定してください。")
+    return ratings
+
+async def open_exclusion_session(interaction, team_mode=False, ratings=None):
+    """
+    除外ロール選択のメッセージを出してセッションを始める（team_mode なら2チームに分ける）
+    """
+    if not await admit_session(interaction):
+        return
+    
+    min_members = TEAM_MATCH_SIZE if team_mode else 2
+    
     # コマンド実行者のVC参加者を取得
     command_user = interaction.user
     vc_members = []
@@ -476,25 +1348,25 @@ async def exclude_role_assignment(interaction: discord.Interaction):
     
     if command_user.voice and command_user.voice.channel:
         vc_channel = command_user.voice.channel
-        vc_members = [member for member in vc_channel.members if not member.bot]
+        vc_members = await resolve_voice_members(vc_channel, interaction)
         vc_channel_name = vc_channel.name
         
-        if len(vc_members) < 2:
-            await interaction.response.send_message(
-                "⚠️ VC参加者が2人以上必要です。", 
+        if len(vc_members) < min_members:
+            await respond(
+                interaction,
+                f"⚠️ VC参加者が{min_members}人以上必要です。", 
                 ephemeral=True
             )
             return
     else:
-        await interaction.response.send_message(
+        await respond(
+            interaction,
             "⚠️ ボイスチャンネルに参加してからコマンドを実行してください。", 
             ephemeral=True
         )
         return
     
-    # 除外設定をリセット
     session_id = f"{interaction.channel_id}_{vc_channel.id}"
-    user_role_exclusions[session_id] = {}
     
     # VC参加者リスト
     vc_member_list = ", ".join([member.display_name for member in vc_members])
@@ -507,9 +1379,15 @@ async def exclude_role_assignment(interaction: discord.Interaction):
     )
     embed.add_field(name="🎤 対象VC", value=f"**{vc_channel_name}**", inline=False)
     embed.add_field(name="👥 VC参加者", value=vc_member_list, inline=False)
-    embed.add_field(name="📋 手順", value="1️⃣ 参加しない人は ❌ をクリック\n2️⃣ やりたくないロールを選択\n3️⃣ 選択完了後 ▶️ でロール分け実行", inline=False)
+    if USE_COMPONENT_UI:
+        embed.add_field(name="📋 手順", value="1️⃣ 参加しない人は ❌ 不参加 をクリック\n2️⃣ メニューからやりたくないロールを選択\n3️⃣ 選択完了後 ▶️ でロール分け実行", inline=False)
+    else:
+        embed.add_field(name="📋 手順", value="1️⃣ 参加しない人は ❌ をクリック\n2️⃣ やりたくないロールを選択\n3️⃣ 選択完了後 ▶️ でロール分け実行", inline=False)
     embed.add_field(name="🚫 不参加", value="❌ → 今回のロール決めに参加しない（観戦）", inline=False)
-    embed.add_field(name="⚠️ 注意", value="• 複数のロールを除外可能\n• どれも選択しなければ全ロール候補\n• 参加者は2-5人まで", inline=False)
+    if team_mode:
+        embed.add_field(name="⚠️ 注意", value=f"• 複数のロールを除外可能\n• どれも選択しなければ全ロール候補\n• 参加者はちょうど{TEAM_MATCH_SIZE}人（5人ずつの2チーム）", inline=False)
+    else:
+        embed.add_field(name="⚠️ 注意", value="• 複数のロールを除外可能\n• どれも選択しなければ全ロール候補\n• 参加者は2-5人まで", inline=False)
     
     # ロール選択肢を表示
     role_list = ""
@@ -521,96 +1399,95 @@ async def exclude_role_assignment(interaction: discord.Interaction):
     embed.add_field(name="💡 ヒント", value="リアクションなし = どのロールでもOK", inline=False)
     embed.set_footer(text="除外選択完了後、▶️ で実行開始！")
     
-    await interaction.response.send_message(embed=embed)
-    message = await interaction.original_response()
-    
-    # ロール除外用の文字リアクションを追加
-    for letter in ROLE_LETTERS.keys():
-        await message.add_reaction(letter)
-    
-    # 不参加リアクションを常に追加
-    await message.add_reaction('❌')
+    session = ExclusionSession(
+        session_id,
+        interaction.channel,
+        [member.id for member in vc_members],
+        asyncio.get_running_loop().time(),
+        ReactionInbox(timers=scheduler),
+        trace=tracing.current_trace.get(),
+        team_mode=team_mode,
+        ratings=ratings
+    )
     
-    # 実行開始用の絵文字を追加
-    await message.add_reaction('▶️')
+    if USE_COMPONENT_UI:
+        # メニューとボタン付きでメッセージを1回で作成
+        role_options = [(letter, ROLES[role_key]) for letter, role_key in ROLE_LETTERS.items()]
+        session.view = session_views.exclusion_view(
+            lambda event: apply_exclusion_reaction_event(session, event),
+            role_options,
+            session.member_ids
+        )
+        with tracing.span('send_message'):
+            await respond(interaction, embed=embed, view=session.view)
+            message = await interaction.original_response()
+        exclusion_sessions[message.id] = session
+        # 除外の切り替えと実行開始は保存先でも不可分に反映する（応答の期限に関わらないよう、応答の後で記録する）
+        await share_exclusion_session(session, interaction, message.id)
+    else:
+        with tracing.span('send_message'):
+            await respond(interaction, embed=embed)
+            message = await interaction.original_response()
+        
+        # リアクションの追加中に押された分も取りこぼさないよう、先にセッションを登録
+        exclusion_sessions[message.id] = session
+        reaction_router.register(message.id, lambda event: apply_exclusion_reaction_event(session, event))
+        await share_exclusion_session(session, interaction, message.id)
+        
+        # ロール除外用の文字リアクション、不参加リアクション、実行開始用の絵文字を追加
+        emojis = list(ROLE_LETTERS.keys()) + ['❌', '▶️']
+        with tracing.span('add_reactions', count=len(emojis)):
+            await add_reactions(message, emojis)
     
     # リアクション監視を開始
-    await monitor_exclusion_and_lottery(interaction, message, vc_members, session_id)
+    await monitor_exclusion_and_lottery(interaction, message, vc_members)
 
-async def monitor_exclusion_and_lottery(interaction, message, vc_members, session_id):
+async def monitor_exclusion_and_lottery(interaction, message, vc_members):
     """
     除外リアクションと実行開始を監視
+
+    除外・不参加の切り替えはリアクションイベントの受信時に直接セッション状態に反映するので、
+    ここでは実行開始リアクションとタイムアウトだけを待つ
     """
-    vc_member_ids = {member.id for member in vc_members}
-    executed = False  # 実行フラグ
-    
-    def check_exclusion_reaction(reaction, user):
-        return (reaction.message.id == message.id and 
-                user.id in vc_member_ids and 
-                str(reaction.emoji) in ROLE_LETTERS.keys())
-    
-    def check_non_participation_reaction(reaction, user):
-        return (reaction.message.id == message.id and 
-                user.id in vc_member_ids and 
-                str(reaction.emoji) == '❌')
-    
-    def check_execute_reaction(reaction, user):
-        return (reaction.message.id == message.id and 
-                str(reaction.emoji) == '▶️' and 
-                user.id in vc_member_ids)
+    loop = asyncio.get_running_loop()
+    session = exclusion_sessions[message.id]
     
     try:
         while True:
-            # 除外リアクション、不参加リアクション、または実行開始リアクションを待機
-            tasks = [
-                asyncio.create_task(bot.wait_for('reaction_add', check=check_exclusion_reaction)),
-                asyncio.create_task(bot.wait_for('reaction_remove', check=check_exclusion_reaction)),
-                asyncio.create_task(bot.wait_for('reaction_add', check=check_execute_reaction)),
-                asyncio.create_task(bot.wait_for('reaction_add', check=check_non_participation_reaction)),
-                asyncio.create_task(bot.wait_for('reaction_remove', check=check_non_participation_reaction))
-            ]
-            
-            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED, timeout=300.0)
-            
-            # 未完了のタスクをキャンセル
-            for task in pending:
-                task.cancel()
-            
-            if not done:
+            # 最後の操作から5分経つまで実行開始リアクションを待機
+            remaining = 300.0 - (loop.time() - session.last_activity)
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            try:
+                with tracing.span('wait_for_start'):
+                    await session.inbox.get(timeout=remaining)
+            except asyncio.TimeoutError:
                 continue
-                
-            reaction, user = await done.pop()
-            
-            # 実行開始の場合
-            if str(reaction.emoji) == '▶️':
-                if not executed:
-                    executed = True
-                    # リアクションを削除して再実行を防止
-                    try:
-                        await message.clear_reactions()
-                        await message.add_reaction('🔒')  # 実行済みマーク
-                    except:
-                        pass
-                    
-                    # 抽選を実行
-                    await execute_exclusion_lottery(interaction, message, vc_members, session_id)
-                    break
-                else:
-                    # 既に実行済みの場合
-                    await interaction.followup.send(
-                        f"⚠️ {user.mention} ロール分けは既に実行済みです。", 
-                        ephemeral=True
-                    )
             
-            # 不参加リアクションの場合
-            elif str(reaction.emoji) == '❌':
-                if not executed:
-                    await handle_non_participation_reaction(interaction, reaction, user, session_id)
+            session.executed = True
+            if not await claim_exclusion_execution(session):
+                # 他のプロセスが実行した（記録はそのプロセスが片付ける）
+                owned_shared_sessions.discard(session.shared_key)
+                session.shared_key = None
+                break
+            # リアクション（ボタン）を無効にして再実行を防止
+            try:
+                with tracing.span('lock_message'):
+                    if session.view is not None:
+                        session.view.disable_all()
+                        await edit_message(message, view=session.view)
+                    else:
+                        await outbound.submit(('reaction_clear', message.channel.id), message.clear_reactions)
+                        await add_reactions(message, ['🔒'])  # 実行済みマーク
+            except:
+                pass
             
-            # 除外ロール選択の場合
+            # 抽選を実行
+            if session.team_mode:
+                await execute_team_lottery(interaction, message, vc_members, session.settings, session.ratings)
             else:
-                if not executed:
-                    await handle_exclusion_reaction(interaction, reaction, user, session_id)
+                await execute_exclusion_lottery(interaction, message, vc_members, session.settings)
+            break
                 
     except asyncio.TimeoutError:
         timeout_embed = discord.Embed(
@@ -618,74 +1495,318 @@ async def monitor_exclusion_and_lottery(interaction, message, vc_members, sessio
             description="5分間反応がなかったため、除外ロール選択を終了しました。",
             color=0xff0000
         )
-        await interaction.followup.send(embed=timeout_embed)
-        # セッションデータをクリア（ただし実行後はクリアしない）
-        # if session_id in user_role_exclusions:
-        #     del user_role_exclusions[session_id]
+        with tracing.span('followup_send', step='timeout'):
+            await send_followup(interaction, embed=timeout_embed)
+    finally:
+        if session.view is not None:
+            session.view.stop()
+        reaction_router.unregister(message.id)
+        exclusion_sessions.pop(message.id, None)
+        # 書き込み中の切り替えが終わってから記録を消す
+        await session.writes.drain()
+        await delete_shared_session(session.shared_key)
+
+async def share_exclusion_session(session, interaction, message_id):
+    """
+    除外セッションを保存先に記録する（保存先が使えなければこのプロセスだけで進める）
 
-async def handle_non_participation_reaction(interaction, reaction, user, session_id):
+    引き継いだプロセスが結果をフォローアップで送れるよう、インタラクションのトークンも記録する。
+    """
+    key = f"exclusion:{interaction.id}"
+    flags = session.settings.to_dict()
+    record = {
+        'guild_id': interaction.guild_id,
+        'channel_id': interaction.channel_id,
+        'message_id': message_id,
+        'session_id': session.session_id,
+        'member_ids': sorted(session.member_ids),
+        'team_mode': session.team_mode,
+        'ratings': {str(user_id): rating for user_id, rating in session.ratings.items()},
+        'flags': flags,
+        'executed': False,
+        'ui': 'components' if USE_COMPONENT_UI else 'reactions',
+        'interaction': {'id': interaction.id, 'application_id': interaction.application_id, 'token': interaction.token}
+    }
+    if not await publish_shared_session(key, record):
+        return
+    session.shared_key = key
+    if session.settings.to_dict() != flags:
+        # 記録している間に切り替えられた分
+        await publish_exclusion_settings(session)
+
+def share_exclusion_change(session, user_id, bit, on):
+    """
+    除外・不参加の切り替えを保存先に反映する（受け取った順に、裏で書き込む）
+    """
+    if session.shared_key is None:
+        return
+    
+    def change(record):
+        if record is None or record['executed']:
+            return None
+        flags = record['flags'].get(str(user_id), 0)
+        flags = flags | bit if on else flags & ~bit
+        return {**record, 'flags': {**record['flags'], str(user_id): flags}}
+    
+    session.writes.submit(update_shared_session, session.shared_key, change)
+
+async def publish_exclusion_settings(session):
+    """
+    照合し直した除外設定を丸ごと保存先に反映する
+    """
+    if session.shared_key is None:
+        return
+    flags = session.settings.to_dict()
+    await write_exclusion_record(session, lambda record: None if record is None or record['executed'] else {**record, 'flags': flags})
+
+async def write_exclusion_record(session, func):
+    # 同じセッションの書き込みは1つずつ、受け取った順に行う（先に受け取った切り替えの書き込みが終わってから）
+    return await session.writes.submit(update_shared_session, session.shared_key, func)
+
+async def claim_exclusion_execution(session):
+    """
+    実行開始を保存先で確定する。他のプロセスが先に実行していたら False
+
+    確定したら、他のプロセスで受け取った分も含めた保存先の除外設定で抽選する。
+    このプロセスで受け取った切り替えの書き込みが全て終わってから確定する。
+    記録がない・保存先が使えない時はこのプロセスだけで実行する。
+    """
+    if session.shared_key is None:
+        return True
+    claimed = False
+    
+    def claim(record):
+        nonlocal claimed
+        claimed = False
+        if record is None or record['executed']:
+            return record
+        claimed = True
+        return {**record, 'executed': True}
+    
+    record = await write_exclusion_record(session, claim)
+    if record is None:
+        return True
+    if claimed:
+        session.settings = ExclusionSettings.from_dict(record['flags'])
+    return claimed
+
+def apply_exclusion_reaction_event(session, event):
+    """
+    リアクションイベントから除外セッションの状態を更新する（REST呼び出しなし）
+    """
+    if session.executed or event.user_id not in session.member_ids:
+        return
+    
+    if event.emoji == '❌':
+        handle_non_participation_reaction(session.settings, event.user_id, event.added)
+        share_exclusion_change(session, event.user_id, ABSENT_BIT, event.added)
+    elif event.emoji in ROLE_LETTERS:
+        handle_exclusion_reaction(session.settings, event.user_id, ROLE_LETTERS[event.emoji], event.added)
+        share_exclusion_change(session, event.user_id, 1 << ROLE_INDEX[ROLE_LETTERS[event.emoji]], event.added)
+    elif event.emoji == '▶️' and event.added:
+        # 実行開始は監視側に渡す
+        session.inbox.push(event)
+        return
+    else:
+        return
+    session.last_activity = asyncio.get_running_loop().time()
+
+def handle_non_participation_reaction(settings, user_id, added):
     """
     不参加リアクションの処理
     """
-    # ユーザーの設定を初期化
-    if user.id not in user_role_exclusions[session_id]:
-        user_role_exclusions[session_id][user.id] = {'user': user, 'excluded_roles': set(), 'participating': True}
+    # リアクションがある場合は不参加、ない場合は参加
+    settings.set_participating(user_id, not added)
+
+def handle_exclusion_reaction(settings, user_id, role_key, added):
+    """
+    除外ロールのリアクション処理
+    """
+    # リアクションがある場合は除外に追加、ない場合は解除
+    settings.set_excluded(user_id, ROLE_INDEX[role_key], added)
+
+async def reconcile_exclusion_session(message_id):
+    """
+    イベントを取りこぼした可能性がある場合に、メッセージのリアクションから状態を作り直す
+    """
+    session = exclusion_sessions.get(message_id)
+    # ボタン操作はゲートウェイの切断で失われないので照合不要
+    if session is None or session.executed or session.view is not None:
+        return
     
-    # メッセージを再取得してリアクション状態を確認
-    try:
-        message = await interaction.channel.fetch_message(reaction.message.id)
-        user_has_non_participation = False
+    with tracing.activate(session.trace):
+        try:
+            with tracing.span('fetch_message'):
+                message = await session.channel.fetch_message(message_id)
+        except discord.NotFound:
+            return
         
+        settings = session.settings = ExclusionSettings()
         for msg_reaction in message.reactions:
-            if str(msg_reaction.emoji) == '❌':
+            emoji = str(msg_reaction.emoji)
+            if emoji != '❌' and emoji not in ROLE_LETTERS:
+                continue
+            # ページごとの取得は REST 呼び出しの区間として中に記録される
+            with tracing.span('reaction_users', emoji=emoji):
                 async for reaction_user in msg_reaction.users():
-                    if reaction_user.id == user.id:
-                        user_has_non_participation = True
-                        break
-        
-        # リアクションがある場合は不参加、ない場合は参加
-        user_role_exclusions[session_id][user.id]['participating'] = not user_has_non_participation
-        
-    except discord.NotFound:
-        pass
+                    if reaction_user.id not in session.member_ids:
+                        continue
+                    if emoji == '❌':
+                        handle_non_participation_reaction(settings, reaction_user.id, True)
+                    else:
+                        handle_exclusion_reaction(settings, reaction_user.id, ROLE_LETTERS[emoji], True)
+        await publish_exclusion_settings(session)
 
-async def handle_exclusion_reaction(interaction, reaction, user, session_id):
+async def reconcile_exclusion_sessions():
     """
-    除外ロールのリアクション処理
+    切断中に取りこぼしたかもしれないリアクションを進行中の全セッションで照合する
     """
-    letter = str(reaction.emoji)
-    
-    # 文字からロールキーを取得
-    role_key = ROLE_LETTERS.get(letter)
-    if not role_key:
+    global reaction_events_may_be_missed
+    if not reaction_events_may_be_missed:
         return
+    reaction_events_may_be_missed = False
+    for message_id in list(exclusion_sessions.keys()):
+        try:
+            await reconcile_exclusion_session(message_id)
+        except discord.HTTPException as e:
+            print(f"リアクション状態の照合に失敗しました: {e}")
+
+@bot.event
+async def on_disconnect():
+    global reaction_events_may_be_missed
+    reaction_events_may_be_missed = True
+
+@bot.event
+async def on_resumed():
+    await reconcile_exclusion_sessions()
+
+async def resume_shared_sessions():
+    """
+    保存先に残っている他のプロセスのセッションのうち、このプロセスが受け持つサーバーのもので、
+    持ち主の期限が切れたものを引き継ぐ
+
+    停止・交代したプロセスのセッションを、リアクションの状態を照合してから続ける。
+    引き継ぎは保存先の compare-and-set で行うので、同じセッションを2つのプロセスが引き継ぐことはない。
+    ボタン・メニュー方式のセッションは、ボタンを作り直せないので引き継がない。
+    """
+    served_guild_ids = {guild.id for guild in bot.guilds}
+    for prefix, resume in (('exclusion:', resume_exclusion_session), ('secret:', resume_secret_session)):
+        try:
+            keys = await session_backend.keys(prefix)
+        except BACKEND_ERRORS as e:
+            print(f"引き継ぐセッションを確認できませんでした: {e!r}")
+            return
+        for key in keys:
+            try:
+                record, _ = await session_backend.get(key)
+            except BACKEND_ERRORS as e:
+                print(f"セッション状態を読み込めませんでした（{key}）: {e!r}")
+                continue
+            if (record is None or record['message_id'] is None or record['owner'] == INSTANCE_ID
+                    or record['lease_until'] > time.time()
+                    or record['ui'] != 'reactions' or record['guild_id'] not in served_guild_ids):
+                continue
+            record = await take_over_shared_session(key, record['owner'])
+            if record is None:
+                continue
+            print(f"セッションを引き継ぎました（{key}）")
+            if prefix == 'secret:' and channel_pool.enabled:
+                # 使用中の一時チャンネルをプールに回収されないように
+                channel_pool.lease(record['guild_id'], record['channel_id'])
+            asyncio.create_task(resume(key, record))
+
+async def fetch_session_message(key, record):
+    """
+    引き継ぐセッションのチャンネルとメッセージ。消されていれば記録を削除して None
+    """
+    channel = bot.get_channel(record['channel_id'])
+    try:
+        if channel is None:
+            channel = await bot.fetch_channel(record['channel_id'])
+        message = await channel.fetch_message(record['message_id'])
+    except discord.HTTPException as e:
+        print(f"引き継いだセッションのメッセージが見つかりません（{key}）: {e!r}")
+        await delete_shared_session(key)
+        return None, None
+    return channel, message
+
+async def resume_exclusion_session(key, record):
+    """
+    他のプロセスから引き継いだ /exclude_role・/team_role のセッションを続ける
+    """
+    channel, message = await fetch_session_message(key, record)
+    if message is None:
+        return
+    vc_members = await resolve_members(channel.guild, record['member_ids'])
+    # 結果は元のインタラクションのフォローアップとして送る（トークンは15分有効）
+    interaction_record = record['interaction']
+    interaction = SimpleNamespace(
+        id=interaction_record['id'],
+        guild_id=record['guild_id'],
+        channel=channel,
+        channel_id=channel.id,
+        followup=discord.Webhook.partial(interaction_record['application_id'], interaction_record['token'], client=bot)
+    )
     
-    # ユーザーの除外リストを初期化
-    if user.id not in user_role_exclusions[session_id]:
-        user_role_exclusions[session_id][user.id] = {'user': user, 'excluded_roles': set(), 'participating': True}
+    session = ExclusionSession(
+        record['session_id'],
+        channel,
+        record['member_ids'],
+        asyncio.get_running_loop().time(),
+        ReactionInbox(timers=scheduler),
+        team_mode=record['team_mode'],
+        ratings={int(user_id): rating for user_id, rating in record['ratings'].items()}
+    )
+    session.settings = ExclusionSettings.from_dict(record['flags'])
+    session.shared_key = key
+    exclusion_sessions[message.id] = session
+    reaction_router.register(message.id, lambda event: apply_exclusion_reaction_event(session, event))
     
-    # メッセージを再取得してリアクション状態を確認
+    # 引き継ぐまでの間に付け外しされたリアクションを取り込む
+    try:
+        await reconcile_exclusion_session(message.id)
+    except discord.HTTPException as e:
+        print(f"リアクション状態の照合に失敗しました: {e}")
+    await monitor_exclusion_and_lottery(interaction, message, vc_members)
+
+async def resume_secret_session(key, record):
+    """
+    他のプロセスから引き継いだ /secret_role のセッションを続ける
+    """
+    temp_channel, message = await fetch_session_message(key, record)
+    if message is None:
+        return
+    role_mapping = {emoji: tuple(value) for emoji, value in record['role_mapping'].items()}
+    session = SecretSession(discord.Embed.from_dict(record['embed']), role_mapping)
+    session.shared_key = key
+    session.selected = record['selected']
+    session.picks = [tuple(pick) for pick in record['picks']]
+    session.inbox = ReactionInbox(reaction_router, message.id, timers=scheduler)
+    reaction_router.register(message.id, lambda event: claim_secret_pick(session, event))
+    session.status_message = CoalescedEditor(
+        message, lambda: {'embed': build_secret_status_embed(session)}, delay=SECRET_STATUS_EDIT_DELAY,
+        edit=edit_message
+    )
+    
+    # 引き継ぐまでの間に押された数字を確定する（既にロールが決まっている人は除く）
+    member_ids = set(record['member_ids'])
+    picked_ids = {pick[0] for pick in session.picks}
     try:
-        message = await interaction.channel.fetch_message(reaction.message.id)
-        user_reactions = []
-        
         for msg_reaction in message.reactions:
-            if str(msg_reaction.emoji) == letter:
-                async for reaction_user in msg_reaction.users():
-                    if reaction_user.id == user.id:
-                        user_reactions.append(letter)
-                        break
-        
-        # リアクションがある場合は除外リストに追加、ない場合は削除
-        if letter in user_reactions:
-            user_role_exclusions[session_id][user.id]['excluded_roles'].add(role_key)
-        else:
-            user_role_exclusions[session_id][user.id]['excluded_roles'].discard(role_key)
-            
-    except discord.NotFound:
-        pass
+            emoji = str(msg_reaction.emoji)
+            if emoji not in role_mapping:
+                continue
+            async for reaction_user in msg_reaction.users():
+                if reaction_user.id in member_ids and reaction_user.id not in picked_ids:
+                    claim_secret_pick(session, ReactionEvent(emoji, reaction_user.id, reaction_user, True))
+    except discord.HTTPException as e:
+        print(f"リアクション状態の照合に失敗しました: {e}")
+    session.status_message.update()
+    
+    schedule_temp_channel_disposal(temp_channel, SECRET_SESSION_TIMEOUT + SECRET_CHANNEL_DELETE_DELAY)
+    await monitor_temp_channel_role_selection(None, message, session, temp_channel)
 
-async def execute_exclusion_lottery(interaction, message, vc_members, session_id):
+async def execute_exclusion_lottery(interaction, message, vc_members, settings):
     """
     除外設定を考慮したロール抽選を実行
     """
@@ -695,23 +1816,14 @@ async def execute_exclusion_lottery(interaction, message, vc_members, session_id
         description="各プレイヤーの除外ロールと参加状況を確認しています...",
         color=0xffff00
     )
-    await interaction.followup.send(embed=lottery_embed)
+    with tracing.span('followup_send', step='staging'):
+        await send_followup(interaction, embed=lottery_embed)
     
-    await asyncio.sleep(2)
+    with tracing.span('staging_sleep'):
+        await asyncio.sleep(2)
     
     # 参加者のみをフィルタリング
-    participating_members = []
-    non_participating_members = []
-    
-    for member in vc_members:
-        is_participating = True
-        if member.id in user_role_exclusions[session_id]:
-            is_participating = user_role_exclusions[session_id][member.id].get('participating', True)
-        
-        if is_participating:
-            participating_members.append(member)
-        else:
-            non_participating_members.append(member)
+    participating_members, non_participating_members = split_participation(vc_members, settings)
     
     # 参加者が少なすぎる場合
     if len(participating_members) < 2:
@@ -720,7 +1832,7 @@ async def execute_exclusion_lottery(interaction, message, vc_members, session_id
             description=f"ロール決めには最低2人の参加者が必要です。\n現在の参加者: {len(participating_members)}人",
             color=0xff0000
         )
-        await interaction.followup.send(embed=error_embed)
+        await send_followup(interaction, embed=error_embed)
         return
     
     # 参加者が多すぎる場合
@@ -732,56 +1844,46 @@ async def execute_exclusion_lottery(interaction, message, vc_members, session_id
         )
         participating_list = ", ".join([member.display_name for member in participating_members])
         error_embed.add_field(name="現在の参加者", value=participating_list, inline=False)
-        await interaction.followup.send(embed=error_embed)
+        await send_followup(interaction, embed=error_embed)
         return
     
     # 除外設定の確認と表示
-    exclusion_summary = "**🚫 除外設定一覧**\n"
-    valid_assignments = []
-    
-    for member in participating_members:
-        excluded_roles = set()
-        if member.id in user_role_exclusions[session_id]:
-            excluded_roles = user_role_exclusions[session_id][member.id]['excluded_roles']
-        
-        # 除外されていないロール = 利用可能なロール
-        available_roles = [role for role in ROLES.keys() if role not in excluded_roles]
-        
-        if excluded_roles:
-            excluded_names = [ROLES[role] for role in excluded_roles]
-            exclusion_summary += f"• {member.display_name}: 除外 {', '.join(excluded_names)}\n"
-        else:
-            exclusion_summary += f"• {member.display_name}: 除外なし（全ロールOK）\n"
-        
-        valid_assignments.append({
-            'user': member,
-            'available_roles': available_roles,
-            'excluded_count': len(excluded_roles)
-        })
-    
-    # 不参加者の情報も表示
-    if non_participating_members:
-        non_participating_list = ", ".join([member.display_name for member in non_participating_members])
-        exclusion_summary += f"\n**👥 参加状況**\n"
-        exclusion_summary += f"• 参加者: {len(participating_members)}人\n"
-        exclusion_summary += f"• 不参加: {non_participating_list}\n"
+    allowed_masks, exclusion_summary = summarize_exclusions(participating_members, non_participating_members, settings)
     
     # 割り当て可能性をチェック
     all_roles = list(ROLES.keys())
-    
+    with tracing.span('count_assignments'):
+        assignment_count = FEASIBILITY_INDEX.count(allowed_masks)
+
     # 割り当てアルゴリズム実行
     try:
-        assignments = assign_roles_with_exclusions(valid_assignments, all_roles)
-        
-        if not assignments:
+        if assignment_count == 0:
+            # 割り当て不可能な原因（衝突しているプレイヤーとロール）を特定
             error_embed = discord.Embed(
                 title="❌ 割り当て失敗",
                 description="除外設定により、全員にロールを割り当てることができませんでした。\n除外するロールを減らしてください。",
                 color=0xff0000
             )
+            violation = FEASIBILITY_INDEX.hall_violation(allowed_masks)
+            if violation:
+                conflict_players, conflict_roles = violation
+                conflict_names = ", ".join([participating_members[p].display_name for p in conflict_players])
+                conflict_role_names = [ROLES[all_roles[r]] for r in mask_to_indices(conflict_roles)]
+                if conflict_role_names:
+                    conflict_text = (f"{conflict_names} の{len(conflict_players)}人が "
+                                     f"{', '.join(conflict_role_names)} の{len(conflict_role_names)}ロールしか担当できません。\n"
+                                     f"このうち誰かが除外するロールを減らしてください。")
+                else:
+                    conflict_text = f"{conflict_names} は全てのロールを除外しています。"
+                error_embed.add_field(name="⚠️ 衝突している組み合わせ", value=conflict_text, inline=False)
             error_embed.add_field(name="除外状況", value=exclusion_summary, inline=False)
-            await interaction.followup.send(embed=error_embed)
+            await send_followup(interaction, embed=error_embed)
             return
+
+        with tracing.span('sample_assignment'):
+            assignments = assign_roles_from_masks(participating_members, allowed_masks, all_roles)
+        # 割り当て数が1以上（上で確認済み）なら必ず割り当てられる
+        assert assignments, "割り当て可能と判定した除外設定で割り当てに失敗しました"
         
         # 結果表示
         result_embed = discord.Embed(
@@ -798,10 +1900,15 @@ async def execute_exclusion_lottery(interaction, message, vc_members, session_id
         
         result_embed.add_field(name="🎯 ロール割り当て結果", value=result_text, inline=False)
         result_embed.add_field(name="📊 詳細情報", value=exclusion_summary, inline=False)
+        result_embed.add_field(name="🎲 組み合わせ数", value=f"{assignment_count}通りの中から抽選しました", inline=False)
         
         # 参加者に通知
         mentions = " ".join([user.mention for user in assignments.keys()])
-        await interaction.followup.send(f"🎉 {mentions}", embed=result_embed)
+        with tracing.span('followup_send', step='result'):
+            await send_followup(interaction, f"🎉 {mentions}", embed=result_embed)
+        
+        await save_role_result(f"{interaction.channel_id}_{message.id}", interaction.guild_id, interaction.channel_id, 'exclude_role',
+                         [(user.id, user.display_name, role_key) for user, role_key in assignments.items()])
         
     except Exception as e:
         error_embed = discord.Embed(
@@ -809,61 +1916,183 @@ async def execute_exclusion_lottery(interaction, message, vc_members, session_id
             description="ロール割り当て中にエラーが発生しました。",
             color=0xff0000
         )
-        await interaction.followup.send(embed=error_embed)
+        await send_followup(interaction, embed=error_embed)
         print(f"Role assignment error: {e}")
+
+def split_participation(vc_members, settings):
+    """
+    VC参加者を参加者と不参加者（❌ を押した人）に分ける
+    """
+    participating_members = []
+    non_participating_members = []
     
-    finally:
-        # セッションデータをクリア
-        if session_id in user_role_exclusions:
-            del user_role_exclusions[session_id]
+    for member in vc_members:
+        if settings.is_participating(member.id):
+            participating_members.append(member)
+        else:
+            non_participating_members.append(member)
+    return participating_members, non_participating_members
 
-def assign_roles_with_exclusions(valid_assignments, all_roles):
+def summarize_exclusions(participating_members, non_participating_members, settings):
     """
-    除外設定を考慮したロール割り当てアルゴリズム
+    参加者ごとの担当可能ロールのビットマスク（participating_members と同じ順）と、結果に添える除外設定一覧の文章を作る
+    """
+    exclusion_summary = "**🚫 除外設定一覧**\n"
+    allowed_masks = []
+    
+    for member in participating_members:
+        excluded = settings.excluded_mask(member.id)
+        
+        if excluded:
+            excluded_names = [name for role, name in ROLES.items() if excluded >> ROLE_INDEX[role] & 1]
+            exclusion_summary += f"• {member.display_name}: 除外 {', '.join(excluded_names)}\n"
+        else:
+            exclusion_summary += f"• {member.display_name}: 除外なし（全ロールOK）\n"
+        
+        # 除外されていないロール = 利用可能なロール
+        allowed_masks.append(ALL_ROLES_MASK & ~excluded)
+    
+    # 不参加者の情報も表示
+    if non_participating_members:
+        non_participating_list = ", ".join([member.display_name for member in non_participating_members])
+        exclusion_summary += "\n**👥 参加状況**\n"
+        exclusion_summary += f"• 参加者: {len(participating_members)}人\n"
+        exclusion_summary += f"• 不参加: {non_participating_list}\n"
+    return allowed_masks, exclusion_summary
+
+async def execute_team_lottery(interaction, message, vc_members, settings, ratings):
+    """
+    除外設定とレートを考慮して2チームに分け、チームごとにロール抽選を実行
     """
-    import random
+    # 実行開始メッセージ
+    lottery_embed = discord.Embed(
+        title="🎰 チーム分け中...",
+        description="各プレイヤーの除外ロールとレートからチームを分けています...",
+        color=0xffff00
+    )
+    with tracing.span('followup_send', step='staging'):
+        await send_followup(interaction, embed=lottery_embed)
     
-    # 参加者数分のロールをランダムに選択
-    available_roles = random.sample(all_roles, len(valid_assignments))
+    with tracing.span('staging_sleep'):
+        await asyncio.sleep(2)
     
-    # 制約が厳しい（利用可能ロールが少ない）プレイヤーから順に割り当て
-    sorted_assignments = sorted(valid_assignments, key=lambda x: len(x['available_roles']))
+    participating_members, non_participating_members = split_participation(vc_members, settings)
     
-    # 複数回試行して最適解を見つける
-    for attempt in range(100):
-        assignments = {}
-        used_roles = set()
-        success = True
+    # 参加者がちょうど2チーム分でない場合
+    if len(participating_members) != TEAM_MATCH_SIZE:
+        description = (f"チーム分けには参加者がちょうど{TEAM_MATCH_SIZE}人必要です。\n"
+                       f"現在の参加者: {len(participating_members)}人")
+        if len(participating_members) > TEAM_MATCH_SIZE:
+            description += "\n\n追加で ❌ を押して不参加にしてください。"
+        error_embed = discord.Embed(
+            title="❌ 参加人数エラー",
+            description=description,
+            color=0xff0000
+        )
+        participating_list = ", ".join([member.display_name for member in participating_members])
+        error_embed.add_field(name="現在の参加者", value=participating_list or "なし", inline=False)
+        await send_followup(interaction, embed=error_embed)
+        return
+    
+    allowed_masks, exclusion_summary = summarize_exclusions(participating_members, non_participating_members, settings)
+    
+    all_roles = list(ROLES.keys())
+    
+    # レート未指定の人は、指定された人の平均として扱う
+    known_ratings = [ratings[member.id] for member in participating_members if member.id in ratings]
+    default_rating = sum(known_ratings) / len(known_ratings) if known_ratings else 0
+    player_ratings = [ratings.get(member.id, default_rating) for member in participating_members]
+    
+    try:
+        with tracing.span('split_teams'):
+            result = assign_teams(allowed_masks, FEASIBILITY_INDEX, player_ratings)
+        
+        if result is None:
+            error_embed = discord.Embed(
+                title="❌ チーム分け失敗",
+                description="除外設定により、どのように分けても両チームの全員にロールを割り当てることができませんでした。\n除外するロールを減らしてください。",
+                color=0xff0000
+            )
+            scarce = scarce_roles(allowed_masks, len(all_roles))
+            if scarce:
+                scarce_text = ", ".join([ROLES[all_roles[r]] for r in scarce])
+                error_embed.add_field(name="⚠️ 担当できる人が足りないロール",
+                                      value=f"{scarce_text}（各チームに1人ずつ、合計2人以上必要です）", inline=False)
+            error_embed.add_field(name="除外状況", value=exclusion_summary, inline=False)
+            await send_followup(interaction, embed=error_embed)
+            return
         
-        # シャッフルして毎回異なる結果を得る
-        current_available_roles = available_roles.copy()
-        random.shuffle(current_available_roles)
-        assignment_order = sorted_assignments.copy()
-        random.shuffle(assignment_order)
+        teams, difference = result
         
-        for player_data in assignment_order:
-            user = player_data['user']
-            available_for_user = [role for role in player_data['available_roles'] 
-                                 if role in current_available_roles and role not in used_roles]
-            
-            if not available_for_user:
-                success = False
-                break
-            
-            # ランダムに選択
-            chosen_role = random.choice(available_for_user)
-            assignments[user] = chosen_role
-            used_roles.add(chosen_role)
+        # 結果表示
+        result_embed = discord.Embed(
+            title="🎊 チーム分け・ロール割り当て完了！",
+            description="各プレイヤーの希望を考慮して2チームに分け、ロールを決定しました！",
+            color=0x00ff88
+        )
         
-        if success and len(assignments) == len(valid_assignments):
-            return assignments
+        assignments = []
+        for team_name, (members, roles) in zip(("🟦 チーム1", "🟥 チーム2"), teams):
+            team_text = ""
+            # ロール順に並べて表示
+            for p, role_number in sorted(zip(members, roles), key=lambda pair: pair[1]):
+                user = participating_members[p]
+                role_key = all_roles[role_number]
+                team_text += f"{user.mention} → **{ROLE_MESSAGES[role_key]['emoji']} {ROLES[role_key]}**\n"
+                assignments.append((user, role_key))
+            if ratings:
+                team_name += f"（レート合計 {sum(player_ratings[p] for p in members):g}）"
+            result_embed.add_field(name=team_name, value=team_text, inline=False)
         
-        # 失敗した場合は、利用可能ロールを再選択して再試行
-        if attempt % 10 == 9:  # 10回ごとに利用可能ロールを変更
-            available_roles = random.sample(all_roles, len(valid_assignments))
+        if ratings:
+            result_embed.add_field(name="⚖️ レート差", value=f"{difference:g}", inline=False)
+        result_embed.add_field(name="📊 詳細情報", value=exclusion_summary, inline=False)
+        
+        # 参加者に通知
+        mentions = " ".join([user.mention for user, _ in assignments])
+        with tracing.span('followup_send', step='result'):
+            await send_followup(interaction, f"🎉 {mentions}", embed=result_embed)
+        
+        await save_role_result(f"{interaction.channel_id}_{message.id}", interaction.guild_id, interaction.channel_id, 'team_role',
+                         [(user.id, user.display_name, role_key) for user, role_key in assignments])
+        
+    except Exception as e:
+        error_embed = discord.Embed(
+            title="❌ システムエラー",
+            description="チーム分け中にエラーが発生しました。",
+            color=0xff0000
+        )
+        await send_followup(interaction, embed=error_embed)
+        print(f"Team assignment error: {e}")
+
+def assign_roles_with_exclusions(valid_assignments, all_roles):
+    """
+    除外設定を考慮したロール割り当てアルゴリズム
+
+    二部マッチングで割り当て可能性を厳密に判定し、有効な割り当て全体から一様に1つ選ぶ。
+    割り当て不可能な場合のみ None を返す。
+    """
+    role_index = {role: i for i, role in enumerate(all_roles)}
+    allowed_masks = [
+        roles_to_mask([role for role in player_data['available_roles'] if role in role_index], role_index)
+        for player_data in valid_assignments
+    ]
+    return assign_roles_from_masks([player_data['user'] for player_data in valid_assignments], allowed_masks, all_roles)
+
+def assign_roles_from_masks(users, allowed_masks, all_roles):
+    """
+    担当可能ロールのビットマスク（users と同じ順）から、有効な割り当て全体から一様に1つ選ぶ
+
+    割り当て不可能な場合のみ None を返す。
+    """
+    player_roles = sample_assignment(allowed_masks, len(all_roles))
+    if player_roles is None:
+        return None
     
-    # 100回試行しても解が見つからない場合
-    return None
+    return {
+        user: all_roles[role_number]
+        for user, role_number in zip(users, player_roles)
+    }
 
 # 旧式のプレフィックスコマンドの案内
 @bot.command(name='role')
@@ -885,4 +2114,10 @@ if __name__ == "__main__":
         exit(1)
     
     print("Botを開始しています...")
-    bot.run(token)
\ No newline at end of file
+    try:
+        bot.run(token)
+    finally:
+        # 書き込み待ちの履歴を保存してから終了
+        if history_store is not None:
+            history_store.close()
+        scheduler.close()
\ No newline at end of file
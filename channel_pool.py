@@ -0,0 +1,211 @@
+"""
+/secret_role 用の非公開チャンネルの使い回し
+
+チャンネルの作成・削除はレート制限が厳しく時間もかかるので、
+非表示のチャンネルをサーバーごとに何個か用意しておき、
+セッションごとに権限を付け替えて貸し出し、終わったら中身を消して戻す。
+"""
+import asyncio
+import time
+from collections import deque
+
+import discord
+
+# 待機中のチャンネル名
+IDLE_CHANNEL_NAME = "role-pool"
+IDLE_CHANNEL_TOPIC = "ロール決め用の待機チャンネル（Botが管理しています）"
+# 貸し出し中のチャンネル名の接頭辞（再起動で取り残されたものの回収に使う）
+LEASED_CHANNEL_PREFIX = "🔒role-決め-"
+
+
+def idle_overwrites(guild):
+    """
+    待機中は Bot 以外の誰にも見えない
+    """
+    return {
+        guild.default_role: discord.PermissionOverwrite(read_messages=False),
+        guild.me: discord.PermissionOverwrite(read_messages=True, send_messages=True,
+                                              manage_messages=True, read_message_history=True)
+    }
+
+
+class ChannelPool:
+    """
+    サーバーごとの非公開チャンネルの貸し出し管理
+    """
+
+    def __init__(self, size, lease_timeout=60 * 60, owns=None):
+        self.size = size
+        self.lease_timeout = lease_timeout
+        # owns(channel_id): このプロセスが後片付けを予約しているチャンネルか（予約どおりに片付けるので回収しない）
+        self._owns = owns or (lambda channel_id: False)
+        # サーバーID → 待機中のチャンネルID
+        self._idle = {}
+        # チャンネルID → 貸し出した時刻
+        self._leased = {}
+        # 取り残されたチャンネルを回収済みのサーバー
+        self._adopted = set()
+        # 最近まで使われていたので回収を見送った、貸し出し中の名前のチャンネルID → サーバーID
+        self._unclaimed = {}
+        # 一度でも貸し出したサーバー（待機チャンネルを補充する対象）
+        self._used = set()
+        self.metrics = {'reused': 0, 'created': 0, 'released': 0, 'deleted': 0, 'reclaimed': 0}
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    async def acquire(self, guild, name, category, overwrites, topic):
+        """
+        チャンネルを1つ借りる。待機中のものがあれば権限と名前を1回の編集で付け替える
+        """
+        self._used.add(guild.id)
+        idle = self._idle.setdefault(guild.id, deque())
+        while idle:
+            channel = guild.get_channel(idle.popleft())
+            if channel is None:
+                continue
+            try:
+                await channel.edit(name=name, category=category, overwrites=overwrites, topic=topic)
+            except discord.NotFound:
+                continue
+            self._leased[channel.id] = time.monotonic()
+            self.metrics['reused'] += 1
+            return channel
+
+        channel = await guild.create_text_channel(name=name, category=category, overwrites=overwrites, topic=topic)
+        self._leased[channel.id] = time.monotonic()
+        self.metrics['created'] += 1
+        return channel
+
+    def lease(self, guild_id, channel_id):
+        """
+        他のプロセスから引き継いだセッションが使っているチャンネルを貸し出し中にする（回収されないように）
+        """
+        self._used.add(guild_id)
+        self._leased[channel_id] = time.monotonic()
+
+    async def release(self, channel):
+        """
+        チャンネルを返す。プールが一杯なら削除する
+        """
+        self._leased.pop(channel.id, None)
+        idle = self._idle.setdefault(channel.guild.id, deque())
+        if channel.id in idle:
+            # 再起動後の後片付けで既に回収済み
+            return
+        if len(idle) >= self.size:
+            await channel.delete()
+            self.metrics['deleted'] += 1
+            return
+
+        # 前のセッションのメッセージを消してから、誰にも見えない状態に戻す
+        await channel.purge(limit=None)
+        await channel.edit(name=IDLE_CHANNEL_NAME, topic=IDLE_CHANNEL_TOPIC, overwrites=idle_overwrites(channel.guild))
+        idle.append(channel.id)
+        self.metrics['released'] += 1
+
+    async def warm(self, guild, category=None):
+        """
+        待機中のチャンネルが size 個になるまで作っておく
+        """
+        idle = self._idle.setdefault(guild.id, deque())
+        while len(idle) < self.size:
+            channel = await guild.create_text_channel(
+                name=IDLE_CHANNEL_NAME,
+                category=category,
+                overwrites=idle_overwrites(guild),
+                topic=IDLE_CHANNEL_TOPIC
+            )
+            idle.append(channel.id)
+            self.metrics['created'] += 1
+
+    def _is_abandoned(self, channel):
+        """
+        最後のメッセージ（なければ作成）から lease_timeout 以上経った、貸し出し中の名前のチャンネルか
+
+        同じサーバーを他のプロセスも受け持つ場合（入れ替え中や引き継ぎ）、そのプロセスが使用中のチャンネルも
+        この名前になっているので、しばらく使われていないものだけを取り残されたとみなす。
+        """
+        if channel.last_message_id is not None:
+            last_activity = discord.utils.snowflake_time(channel.last_message_id)
+        else:
+            last_activity = channel.created_at
+        return (discord.utils.utcnow() - last_activity).total_seconds() >= self.lease_timeout
+
+    async def _reclaim(self, channel):
+        if channel.id in self._leased or self._owns(channel.id):
+            self._unclaimed.pop(channel.id, None)
+            return
+        if not self._is_abandoned(channel):
+            # 他のプロセスが使用中かもしれないので、後の sweep で調べ直す
+            self._unclaimed[channel.id] = channel.guild.id
+            return
+        self._unclaimed.pop(channel.id, None)
+        # 使用中のまま再起動で取り残されたチャンネル
+        await self.release(channel)
+        self.metrics['reclaimed'] += 1
+
+    async def adopt(self, guild):
+        """
+        再起動前に作られた待機中・貸し出し中のチャンネルを回収する
+
+        貸し出し中の名前のチャンネルは、このプロセスが使用中・後片付けを予約済みのものと、
+        最近まで使われていたもの（他のプロセスが使用中かもしれない）を除いて回収する。
+        """
+        self._adopted.add(guild.id)
+        for channel in guild.text_channels:
+            idle = self._idle.get(guild.id, ())
+            if channel.id in self._leased or channel.id in idle:
+                continue
+            if channel.name == IDLE_CHANNEL_NAME and channel.topic == IDLE_CHANNEL_TOPIC:
+                if len(idle) < self.size:
+                    idle = self._idle.setdefault(guild.id, deque())
+                    idle.append(channel.id)
+                else:
+                    await channel.delete()
+                    self.metrics['deleted'] += 1
+            elif channel.name.startswith(LEASED_CHANNEL_PREFIX) and channel.permissions_for(guild.me).manage_channels:
+                await self._reclaim(channel)
+
+    async def sweep(self, guilds):
+        """
+        期限切れの貸し出しを回収し、まだ調べていないサーバーの取り残しを回収し、
+        使われたサーバーの待機チャンネルを補充する
+        """
+        now = time.monotonic()
+        for guild in guilds:
+            if guild.id not in self._adopted:
+                await self.adopt(guild)
+            if guild.id in self._used:
+                await self.warm(guild)
+        for channel_id, guild_id in list(self._unclaimed.items()):
+            channel = next((guild.get_channel(channel_id) for guild in guilds if guild.id == guild_id), None)
+            if channel is None or not channel.name.startswith(LEASED_CHANNEL_PREFIX):
+                # 削除された・持ち主のプロセスが片付けた
+                self._unclaimed.pop(channel_id, None)
+                continue
+            await self._reclaim(channel)
+        for channel_id, leased_at in list(self._leased.items()):
+            if now - leased_at < self.lease_timeout:
+                continue
+            for guild in guilds:
+                channel = guild.get_channel(channel_id)
+                if channel is not None:
+                    await self.release(channel)
+                    self.metrics['reclaimed'] += 1
+                    break
+            else:
+                self._leased.pop(channel_id, None)
+
+    async def run_sweeper(self, client, interval=60):
+        """
+        定期的に sweep を実行し続ける
+        """
+        await client.wait_until_ready()
+        while not client.is_closed():
+            try:
+                await self.sweep(client.guilds)
+            except discord.HTTPException as e:
+                print(f"チャンネルプールの回収に失敗しました: {e}")
+            await asyncio.sleep(interval)
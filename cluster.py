@@ -0,0 +1,280 @@
+"""
+複数プロセスでシャードを分担して動かすクラスタ起動スクリプト
+
+シャードを連続した範囲に分けて各ワーカープロセスに割り当て、
+落ちたワーカーは再起動し、各ワーカーの状態（ハートビート）をまとめて表示する。
+ギルドのイベントとインタラクションは担当シャードのプロセスにだけ届くので、
+各セッションの状態はそのギルドを担当するプロセスの中だけで完結する。
+
+使い方:
+    python cluster.py --clusters 4 [--shard-count 16] [--health-port 8080]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ワーカーのハートビート間隔（秒）
+HEARTBEAT_INTERVAL = 15
+# この回数分ハートビートが途絶えたワーカーは固まったとみなして再起動する
+STALE_HEARTBEATS = 5
+# 再起動の待ち時間の上限（秒）
+MAX_RESTART_BACKOFF = 60
+# この秒数以上動き続けたら再起動の待ち時間をリセット
+STABLE_UPTIME = 300
+# IDENTIFY の制限（5秒に1回）に合わせた、シャード1つあたりの起動間隔（秒）
+IDENTIFY_INTERVAL = 5
+
+
+def fetch_recommended_shard_count(token):
+    """
+    Discord が推奨するシャード数を取得する
+    """
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "roleAssignmentDiscordBot cluster"}
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)["shards"]
+
+
+def split_shards(shard_count, clusters):
+    """
+    シャードIDを clusters 個の連続した範囲に分ける
+    """
+    clusters = min(clusters, shard_count)
+    base, extra = divmod(shard_count, clusters)
+    ranges = []
+    start = 0
+    for cluster_id in range(clusters):
+        size = base + (1 if cluster_id < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+def run_worker(cluster_id, shard_ids, shard_count, token, health_queue):
+    """
+    ワーカープロセスの本体: 担当シャードだけで bot.py を動かす
+    """
+    os.environ['CLUSTER_ID'] = str(cluster_id)
+    os.environ['SHARD_IDS'] = ",".join(str(shard_id) for shard_id in shard_ids)
+    os.environ['SHARD_COUNT'] = str(shard_count)
+
+    import bot as bot_module
+    client = bot_module.bot
+
+    async def report_health():
+        while not client.is_closed():
+            health_queue.put({
+                'cluster_id': cluster_id,
+                'pid': os.getpid(),
+                'shard_ids': shard_ids,
+                'ready': client.is_ready(),
+                'guilds': len(client.guilds),
+                'latency': client.latency if client.is_ready() else None,
+                'shard_latencies': dict(client.latencies) if client.is_ready() else {},
+                'active_sessions': bot_module.count_active_sessions(),
+                'timestamp': time.time()
+            })
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def main():
+        async with client:
+            reporter = asyncio.create_task(report_health())
+            try:
+                await client.start(token)
+            finally:
+                reporter.cancel()
+
+    try:
+        asyncio.run(main())
+    finally:
+        if bot_module.history_store is not None:
+            bot_module.history_store.close()
+        bot_module.scheduler.close()
+
+
+class Supervisor:
+    """
+    ワーカーの起動・再起動と状態の集約
+    """
+
+    def __init__(self, shard_ranges, shard_count, token):
+        self.shard_ranges = shard_ranges
+        self.shard_count = shard_count
+        self.token = token
+        self.context = multiprocessing.get_context('spawn')
+        self.health_queue = self.context.Queue()
+        self.processes = {}
+        self.started_at = {}
+        self.restart_at = {}
+        self.backoff = {cluster_id: 1 for cluster_id in range(len(shard_ranges))}
+        self.restarts = {cluster_id: 0 for cluster_id in range(len(shard_ranges))}
+        self.health = {}
+        self.running = True
+
+    def start_worker(self, cluster_id):
+        process = self.context.Process(
+            target=run_worker,
+            args=(cluster_id, self.shard_ranges[cluster_id], self.shard_count, self.token, self.health_queue),
+            name=f"cluster-{cluster_id}",
+            daemon=True
+        )
+        process.start()
+        self.processes[cluster_id] = process
+        self.started_at[cluster_id] = time.monotonic()
+        print(f"クラスタ {cluster_id} を起動しました (pid {process.pid}, シャード {self.shard_ranges[cluster_id]})")
+
+    def schedule_restart(self, cluster_id, reason):
+        if time.monotonic() - self.started_at[cluster_id] >= STABLE_UPTIME:
+            self.backoff[cluster_id] = 1
+        delay = self.backoff[cluster_id]
+        self.backoff[cluster_id] = min(delay * 2, MAX_RESTART_BACKOFF)
+        self.restart_at[cluster_id] = time.monotonic() + delay
+        self.restarts[cluster_id] += 1
+        self.health.pop(cluster_id, None)
+        print(f"クラスタ {cluster_id} を {delay} 秒後に再起動します（{reason}）")
+
+    def drain_health(self):
+        while True:
+            try:
+                report = self.health_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.health[report['cluster_id']] = report
+
+    def check_workers(self):
+        now = time.monotonic()
+        for cluster_id, process in list(self.processes.items()):
+            if cluster_id in self.restart_at:
+                if now >= self.restart_at[cluster_id]:
+                    del self.restart_at[cluster_id]
+                    self.start_worker(cluster_id)
+                continue
+            if not process.is_alive():
+                self.schedule_restart(cluster_id, f"終了コード {process.exitcode}")
+                continue
+            report = self.health.get(cluster_id)
+            last_seen = report['timestamp'] if report else None
+            silent_for = time.time() - last_seen if last_seen else now - self.started_at[cluster_id]
+            if silent_for > HEARTBEAT_INTERVAL * STALE_HEARTBEATS:
+                process.kill()
+                process.join()
+                self.schedule_restart(cluster_id, f"{silent_for:.0f} 秒間ハートビートなし")
+
+    def summary(self):
+        """
+        全ワーカーの状態をまとめたもの
+        """
+        clusters = []
+        for cluster_id in range(len(self.shard_ranges)):
+            report = self.health.get(cluster_id, {})
+            process = self.processes.get(cluster_id)
+            clusters.append({
+                'cluster_id': cluster_id,
+                'shard_ids': self.shard_ranges[cluster_id],
+                'alive': bool(process and process.is_alive()),
+                'ready': report.get('ready', False),
+                'guilds': report.get('guilds', 0),
+                'latency': report.get('latency'),
+                'active_sessions': report.get('active_sessions', 0),
+                'restarts': self.restarts[cluster_id],
+                'last_heartbeat': report.get('timestamp')
+            })
+        return {
+            'shard_count': self.shard_count,
+            'clusters_ready': sum(1 for cluster in clusters if cluster['ready']),
+            'guilds': sum(cluster['guilds'] for cluster in clusters),
+            'active_sessions': sum(cluster['active_sessions'] for cluster in clusters),
+            'clusters': clusters
+        }
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"[クラスタ] 準備完了 {summary['clusters_ready']}/{len(self.shard_ranges)}、"
+              f"ギルド {summary['guilds']}、進行中セッション {summary['active_sessions']}")
+
+    def stop(self, *_):
+        self.running = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        # IDENTIFY の制限を超えないよう、シャード数に応じて間隔をあけて起動
+        for cluster_id, shard_ids in enumerate(self.shard_ranges):
+            if not self.running:
+                break
+            self.start_worker(cluster_id)
+            time.sleep(IDENTIFY_INTERVAL * len(shard_ids))
+
+        last_summary = 0.0
+        while self.running:
+            self.drain_health()
+            self.check_workers()
+            if time.monotonic() - last_summary >= HEARTBEAT_INTERVAL:
+                self.print_summary()
+                last_summary = time.monotonic()
+            time.sleep(1)
+
+        print("ワーカーを停止しています...")
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=10)
+
+
+def serve_health(supervisor, port):
+    """
+    集約した状態を http://127.0.0.1:<port>/ で JSON として返す
+    """
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(supervisor.summary(), ensure_ascii=False).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), HealthHandler)
+    threading.Thread(target=server.serve_forever, name="cluster-health", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clusters', type=int, default=os.cpu_count() or 1, help="ワーカープロセス数")
+    parser.add_argument('--shard-count', type=int, default=None, help="全体のシャード数（省略時は Discord の推奨値）")
+    parser.add_argument('--health-port', type=int, default=None, help="状態をJSONで返すポート")
+    args = parser.parse_args()
+
+    token = os.getenv('DISCORD_TOKEN')
+    if not token:
+        print("DISCORD_TOKEN環境変数が設定されていません")
+        sys.exit(1)
+
+    shard_count = args.shard_count or fetch_recommended_shard_count(token)
+    shard_ranges = split_shards(shard_count, args.clusters)
+    print(f"シャード {shard_count} 個を {len(shard_ranges)} プロセスで分担します")
+
+    supervisor = Supervisor(shard_ranges, shard_count, token)
+    if args.health_port:
+        serve_health(supervisor, args.health_port)
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()
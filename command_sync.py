@@ -0,0 +1,68 @@
+"""
+スラッシュコマンド定義が変わった時だけ同期する
+
+on_ready は再接続のたびに呼ばれるので、毎回 tree.sync() すると
+レート制限の厳しいコマンド一括更新が再接続のたびに走る。
+ここではコマンド定義（Discord に送る内容そのもの）のハッシュを保存しておき、
+前回の同期から変わっていない場合は同期を省く。
+"""
+import hashlib
+import inspect
+import json
+import os
+
+
+def _command_payload(command, tree):
+    # discord.py 2.4 から to_dict() は tree を受け取る（2.3 以前は引数なし）。tree.sync() と同じ呼び方をする
+    if 'tree' in inspect.signature(command.to_dict).parameters:
+        return command.to_dict(tree)
+    return command.to_dict()
+
+
+def command_fingerprint(tree, guild=None):
+    """
+    tree.sync() が送る内容と同じコマンド定義のハッシュ
+    """
+    payload = sorted(
+        (_command_payload(command, tree) for command in tree.get_commands(guild=guild)),
+        key=lambda command: (command.get('type', 1), command['name'])
+    )
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def _load_state(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save_state(path, state):
+    # 書き込み途中で落ちても壊れないよう、別ファイルに書いてから置き換える
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+async def sync_if_changed(tree, application_id, path, guild=None, force=False):
+    """
+    前回の同期から定義が変わっていれば同期する。同期したら結果のリスト、省いたら None
+
+    guild を渡すとそのサーバーだけに同期する（即時反映されるので開発用）。
+    その場合はグローバルコマンドをサーバーにコピーしてから同期する。
+    """
+    if guild is not None:
+        tree.copy_global_to(guild=guild)
+
+    scope = f"{application_id}:{guild.id if guild is not None else 'global'}"
+    fingerprint = command_fingerprint(tree, guild)
+    state = _load_state(path)
+    if not force and state.get(scope) == fingerprint:
+        return None
+
+    synced = await tree.sync(guild=guild)
+    state[scope] = fingerprint
+    _save_state(path, state)
+    return synced
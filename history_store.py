@@ -0,0 +1,154 @@
+"""
+ロール割り当て履歴のSQLite保存
+
+書き込みは専用スレッドがまとめて（バッチで）行うので、イベントループを止めない。
+読み込みはWALモードの別接続でスレッドプール上から行う。
+"""
+import asyncio
+import contextlib
+import queue
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS assignments (
+    id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    game_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_assignments_guild_user_role ON assignments (guild_id, user_id, role);
+CREATE INDEX IF NOT EXISTS idx_assignments_guild_role ON assignments (guild_id, role);
+"""
+
+INSERT = (
+    "INSERT INTO assignments (guild_id, channel_id, game_id, kind, user_id, role, created_at) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+
+_STOP = object()
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class HistoryStore:
+    """
+    ロール割り当て履歴の保存と集計
+    """
+
+    def __init__(self, path, batch_size=500, flush_interval=0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.metrics = {'queued': 0, 'written': 0, 'batches': 0, 'errors': 0}
+
+        # sqlite3 の接続の with はコミットするだけで閉じないので、closing で閉じる
+        with contextlib.closing(_connect(path)) as connection:
+            connection.executescript(SCHEMA)
+        self._read_connection = _connect(path)
+        self._read_lock = threading.Lock()
+
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def record(self, guild_id, channel_id, game_id, kind, assignments):
+        """
+        1ゲーム分の割り当てを書き込み待ちに積む（すぐ戻る）
+
+        assignments は (ユーザーID, ロールキー) のリスト。
+        """
+        created_at = time.time()
+        for user_id, role_key in assignments:
+            self._queue.put((guild_id, channel_id, game_id, kind, user_id, role_key, created_at))
+            self.metrics['queued'] += 1
+
+    async def role_frequency(self, guild_id, user_id):
+        """
+        ユーザーがサーバー内で各ロールを担当した回数
+        """
+        rows = await asyncio.get_running_loop().run_in_executor(
+            None,
+            self._query,
+            "SELECT role, COUNT(*) FROM assignments WHERE guild_id = ? AND user_id = ? GROUP BY role",
+            (guild_id, user_id)
+        )
+        return dict(rows)
+
+    async def guild_role_frequency(self, guild_id):
+        """
+        サーバー全体で各ロールが割り当てられた回数
+        """
+        rows = await asyncio.get_running_loop().run_in_executor(
+            None,
+            self._query,
+            "SELECT role, COUNT(*) FROM assignments WHERE guild_id = ? GROUP BY role",
+            (guild_id,)
+        )
+        return dict(rows)
+
+    def flush(self, timeout=None):
+        """
+        書き込み待ちを全て書き終えるまで待つ（終了時・ベンチマーク用）
+        """
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._read_connection.close()
+
+    def _query(self, sql, parameters):
+        with self._read_lock:
+            return self._read_connection.execute(sql, parameters).fetchall()
+
+    def _write_loop(self):
+        connection = _connect(self.path)
+        running = True
+        while running:
+            batch = []
+            waiters = []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    running = False
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    with connection:
+                        connection.executemany(INSERT, batch)
+                    self.metrics['written'] += len(batch)
+                    self.metrics['batches'] += 1
+                except sqlite3.Error as e:
+                    self.metrics['errors'] += 1
+                    print(f"履歴の書き込みに失敗しました: {e}")
+            for waiter in waiters:
+                waiter.set()
+        connection.close()
@@ -0,0 +1,72 @@
+"""
+その場で書き換える進行状況メッセージ
+
+状態が変わるたびに新しいメッセージを送る代わりに、1つのメッセージを編集し続ける。
+短い間に続けて変わった分（同時に押されたリアクションなど）は待ってから
+まとめて1回の編集にするので、REST呼び出しとレート制限の待ちが減る。
+"""
+import asyncio
+import contextlib
+
+import discord
+
+
+class CoalescedEditor:
+    """
+    render() の結果で message を編集する。update() の呼び出しは delay 秒まとめてから反映する
+
+    render は message.edit に渡すキーワード引数の辞書を返す関数。
+    編集中に update() されたら、編集が終わってからもう一度編集する。
+    edit(message, **fields) を渡すと message.edit の代わりにそれで編集する（送信スケジューラー経由など）。
+    """
+
+    def __init__(self, message, render, delay=0.3, edit=None):
+        self.message = message
+        self._render = render
+        self._delay = delay
+        self._edit_message = edit
+        self._dirty = False
+        self._task = None
+        self.edits = 0
+
+    def update(self):
+        """
+        状態が変わったことを知らせる（編集は後でまとめて行う）
+        """
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._dirty:
+            await asyncio.sleep(self._delay)
+            self._dirty = False
+            await self._edit()
+
+    async def _edit(self):
+        try:
+            if self._edit_message is None:
+                await self.message.edit(**self._render())
+            else:
+                await self._edit_message(self.message, **self._render())
+            self.edits += 1
+        except discord.HTTPException as e:
+            print(f"進行状況メッセージの更新に失敗しました: {e}")
+
+    async def flush(self):
+        """
+        待っている編集を取りやめ、今の状態ですぐに編集する（セッション終了時など）
+        """
+        await self.close()
+        await self._edit()
+
+    async def close(self):
+        """
+        待っている編集を取りやめる
+        """
+        self._dirty = False
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+        self._task = None
@@ -0,0 +1,385 @@
+"""
+Prometheus 形式のメトリクス
+
+外部ライブラリは使わず、カウンター・ゲージ・ヒストグラムと、
+それを http://<host>:<port>/metrics で返す小さなHTTPサーバーだけを持つ。
+値の更新は全てイベントループ上で行い、HTTPサーバーも同じループで動かす。
+
+- コマンドごとの処理時間と進行中のセッション数: track_command デコレーター
+- REST呼び出し数（セッションの種類別）と 429: aiohttp の TraceConfig（Bot の http_trace に渡す）
+- レート制限の待ち時間: discord.http のログ
+- ゲートウェイの遅延とイベントループの遅れ: 定期的に測る
+- 起動からゲートウェイ接続・準備完了・最初のコマンド受付までの時間: mark_startup
+- 常駐メモリとキャッシュの大きさ（サーバーあたりのメモリ）: watch_cache
+- プロセス内のセッション状態の保存先の件数と、期限切れ・上限で捨てた数: watch_session_backend
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import time
+
+# REST呼び出しをどのセッションのものとして数えるか（コマンドの処理中に設定される）
+current_session_kind = contextvars.ContextVar('current_session_kind', default='other')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # バケットごとの件数、合計、件数
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, key, [('le', bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        # 出力の直前に呼ばれる関数（ゲージを最新の値にする）
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+command_duration = Histogram(registry, 'rolebot_command_duration_seconds',
+                             'スラッシュコマンドの処理時間（セッション終了まで）', ['command'])
+commands_total = Counter(registry, 'rolebot_commands_total', '実行されたスラッシュコマンドの数', ['command', 'outcome'])
+active_sessions = Gauge(registry, 'rolebot_active_sessions', '進行中のセッション数', ['kind'])
+rest_requests = Counter(registry, 'rolebot_rest_requests_total', 'Discord REST API の呼び出し数',
+                        ['session_kind', 'method', 'status'])
+rest_duration = Histogram(registry, 'rolebot_rest_request_duration_seconds',
+                          'Discord REST API の応答時間（レート制限の待ちを除く）', ['method'])
+rate_limited = Counter(registry, 'rolebot_rate_limited_total', '429 を受けた回数', ['scope'])
+rate_limit_wait = Counter(registry, 'rolebot_rate_limit_wait_seconds_total', '429 による待ち時間の合計')
+gateway_latency = Gauge(registry, 'rolebot_gateway_latency_seconds', 'ゲートウェイのハートビート遅延', ['shard'])
+loop_lag = Histogram(registry, 'rolebot_event_loop_lag_seconds', 'イベントループの遅れ',
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+outbound_pending = Gauge(registry, 'rolebot_outbound_pending', '送信待ちのREST呼び出し数')
+outbound_in_flight = Gauge(registry, 'rolebot_outbound_in_flight', '送信中のREST呼び出し数')
+outbound_coalesced = Gauge(registry, 'rolebot_outbound_coalesced', '送信前に新しい内容に置き換えた編集の数（起動からの累計）')
+sessions_rejected = Counter(registry, 'rolebot_sessions_rejected_total', '送信待ちが溢れていたため断ったセッションの数')
+resident_memory = Gauge(registry, 'rolebot_resident_memory_bytes', 'プロセスの常駐メモリ（RSS）')
+resident_memory_per_guild = Gauge(registry, 'rolebot_resident_memory_per_guild_bytes', 'キャッシュしているサーバー1つあたりの常駐メモリ')
+cached_objects = Gauge(registry, 'rolebot_cached_objects', 'キャッシュしているオブジェクトの数', ['kind'])
+session_store_entries = Gauge(registry, 'rolebot_session_store_entries', 'プロセス内のセッション状態の保存先の件数')
+session_store_evicted = Gauge(registry, 'rolebot_session_store_evicted', 'セッション状態の保存先から捨てた数（起動からの累計）', ['reason'])
+startup_seconds = Gauge(registry, 'rolebot_startup_seconds', 'プロセスの起動から各段階に達するまでの時間', ['phase'])
+members_resolved = Counter(registry, 'rolebot_voice_members_resolved_total',
+                           'キャッシュになくVC参加者の解決時に取得したメンバーの数', ['source'])
+
+
+def track_command(name):
+    """
+    コマンドの処理時間・成否・進行中の数を記録し、処理中のREST呼び出しをこのコマンドの分として数える
+
+    @bot.tree.command の下（関数の直上）に付ける。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = current_session_kind.set(name)
+            active_sessions.inc(kind=name)
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = await func(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                command_duration.observe(time.perf_counter() - start, command=name)
+                commands_total.inc(command=name, outcome=outcome)
+                active_sessions.dec(kind=name)
+                current_session_kind.reset(token)
+        return wrapper
+    return decorator
+
+
+def http_trace(trace_config=None):
+    """
+    REST呼び出しを数える aiohttp.TraceConfig（Bot(http_trace=...) に渡す）
+
+    trace_config を渡すとそれにフックを追加する。
+    """
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        rest_duration.observe(time.perf_counter() - context.start, method=params.method)
+        rest_requests.inc(session_kind=current_session_kind.get(), method=params.method, status=params.response.status)
+        if params.response.status == 429:
+            scope = params.response.headers.get('X-RateLimit-Scope', 'unknown')
+            rate_limited.inc(scope=scope)
+
+    async def on_request_exception(session, context, params):
+        rest_requests.inc(session_kind=current_session_kind.get(), method=params.method, status='error')
+
+    if trace_config is None:
+        trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+class _RateLimitLogHandler(logging.Handler):
+    """
+    discord.http が 429 の後に待つ秒数をログから拾う
+    """
+
+    def emit(self, record):
+        message = str(record.msg)
+        if message.startswith('We are being rate limited') and 'Retrying in' in message:
+            rate_limit_wait.inc(record.args[-1])
+
+
+def install_log_hooks():
+    logging.getLogger('discord.http').addHandler(_RateLimitLogHandler(logging.WARNING))
+
+
+def watch_client(client):
+    """
+    出力のたびにゲートウェイの遅延を読む
+    """
+    def collect():
+        if not client.is_ready():
+            return
+        for shard_id, latency in getattr(client, 'latencies', [(None, client.latency)]):
+            gateway_latency.set(latency, shard='' if shard_id is None else shard_id)
+    registry.add_collector(collect)
+
+
+def watch_outbound(scheduler):
+    """
+    出力のたびに送信スケジューラーの待ち行列の長さを読む
+    """
+    def collect():
+        outbound_pending.set(scheduler.pending)
+        outbound_in_flight.set(scheduler.in_flight)
+        outbound_coalesced.set(scheduler.coalesced)
+    registry.add_collector(collect)
+
+
+def resident_memory_bytes():
+    """
+    プロセスの今の常駐メモリ（バイト）。/proc がなければ最大値で代用する
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # Linux 以外の ru_maxrss はバイト単位のこともあるが、目安としては十分
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def cache_summary(client):
+    """
+    常駐メモリとキャッシュしているサーバー・メンバー・ユーザー・メッセージの数
+    """
+    rss = resident_memory_bytes()
+    guilds = len(client.guilds)
+    return {
+        'rss_bytes': rss,
+        'per_guild_bytes': rss // guilds if guilds else None,
+        'guilds': guilds,
+        'members': sum(len(guild.members) for guild in client.guilds),
+        'users': len(client.users),
+        'messages': len(client.cached_messages)
+    }
+
+
+def watch_cache(client):
+    """
+    出力のたびに常駐メモリとキャッシュの大きさを読む
+    """
+    def collect():
+        summary = cache_summary(client)
+        resident_memory.set(summary['rss_bytes'])
+        if summary['per_guild_bytes'] is not None:
+            resident_memory_per_guild.set(summary['per_guild_bytes'])
+        for kind in ('guilds', 'members', 'users', 'messages'):
+            cached_objects.set(summary[kind], kind=kind)
+    registry.add_collector(collect)
+
+
+def watch_session_backend(backend):
+    """
+    出力のたびにプロセス内の保存先（MemoryBackend）の件数と捨てた数を読む
+
+    サーバーに置いている場合は、そのサーバーのプロセスが持っているので何もしない。
+    """
+    if not hasattr(backend, 'stats'):
+        return
+
+    def collect():
+        stats = backend.stats()
+        session_store_entries.set(stats['entries'])
+        session_store_evicted.set(stats['evicted_expired'], reason='expired')
+        session_store_evicted.set(stats['evicted_capacity'], reason='capacity')
+    registry.add_collector(collect)
+
+
+def _process_started():
+    """
+    プロセスが起動した時刻（time.monotonic() 基準）。分からなければこのモジュールを読み込んだ時刻
+    """
+    try:
+        # /proc/self/stat の22番目の項目がシステム起動からのプロセス開始時刻（クロック刻み）
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rpartition(')')[2].split()[19])
+        age = time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf('SC_CLK_TCK')
+        return time.monotonic() - max(0.0, age)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.monotonic()
+
+
+PROCESS_STARTED = _process_started()
+# 段階 → 起動からの秒数（最初に達した時のみ記録）
+startup_timings = {}
+
+
+def mark_startup(phase):
+    """
+    起動から phase（'connected'・'ready'・'first_command' など）に初めて達した時間を記録して返す
+
+    2回目以降（再接続など）は記録せず None を返す。
+    """
+    if phase in startup_timings:
+        return None
+    elapsed = time.monotonic() - PROCESS_STARTED
+    startup_timings[phase] = elapsed
+    startup_seconds.set(round(elapsed, 3), phase=phase)
+    return elapsed
+
+
+async def monitor_loop_lag(interval=0.5):
+    """
+    interval 秒のスリープがどれだけ遅れて戻ってくるかでイベントループの詰まりを測る
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0.0, loop.time() - start - interval))
+
+
+async def serve(host, port):
+    """
+    GET /metrics にメトリクスを返すHTTPサーバーを起動する
+    """
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
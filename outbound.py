@@ -0,0 +1,204 @@
+"""
+Discord への送信（REST呼び出し）の一元的なスケジューラー
+
+各セッションが送信を1つずつ await すると、混んでいるレート制限のバケット
+（同じチャンネルへのリアクション追加など）の待ちに他の送信まで巻き込まれる。
+ここでは送信をバケットごとの列に積み、
+- バケットごとに同時に1件だけ送る（順番は保つ）
+- バケットの種類ごとのレート制限（bucket_limits）が分かっていれば、使い切ったバケットの送信は
+  列で待たせ、送信枠を塞がない（429 を受けてから待つより先に、空いているバケットを送る）
+- 別のバケットの送信は並行して送る（全体の同時送信数は max_in_flight まで）
+- 送信枠が空いたら優先度の高いものから送る（期限のあるインタラクションへの応答が最優先）
+- 同じ coalesce_key の送信がまだ列で待っていれば、新しい内容に置き換える（古い編集は送らない）
+- 列で待っている送信が max_pending を超えたら、新しいセッションを待たせる（wait_for_capacity）
+を行う。送信は積んだタスクのコンテキスト（セッションの種類やトレース）で実行するので、
+メトリクスやトレースは送信を積んだセッションのものとして記録される。
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+from collections import deque
+
+# 優先度（小さいほど先に送る）
+PRIORITY_RESPONSE = 0    # インタラクションへの最初の応答（3秒以内に必要）
+PRIORITY_FOLLOWUP = 1    # インタラクションのフォローアップ
+PRIORITY_NORMAL = 2
+PRIORITY_BACKGROUND = 3  # 後片付け（チャンネル削除など）
+
+
+class _Job:
+    __slots__ = ('bucket', 'priority', 'seq', 'func', 'args', 'kwargs', 'future', 'coalesce_key', 'context')
+
+    def __init__(self, bucket, priority, seq, func, args, kwargs, future, coalesce_key, context):
+        self.bucket = bucket
+        self.priority = priority
+        self.seq = seq
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.coalesce_key = coalesce_key
+        self.context = context
+
+
+class OutboundScheduler:
+    """
+    バケットを意識して送信を並べるスケジューラー
+
+    bucket は Discord のレート制限の単位に近いキー（('reactions', チャンネルID) など）。
+    bucket_limits は バケットの種類（キーの先頭） → (回数, 秒)。
+    Discord 側で制限の期間が始まるのは送信が届いてからなので、期間は margin 秒だけ長めに見る。
+    """
+
+    def __init__(self, max_in_flight=500, max_pending=5000, bucket_limits=None, margin=0.02):
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self.bucket_limits = bucket_limits or {}
+        self.margin = margin
+        self._seq = itertools.count()
+        # バケット → [残り回数, 回数が戻る時刻]
+        self._windows = {}
+        # バケット → 送信待ちの列
+        self._queues = {}
+        # 送信中、またはレート制限の回復待ちのバケット
+        self._busy = set()
+        # 送信できるバケットのヒープ: (先頭の優先度, 先頭の順番, バケット)
+        self._ready = []
+        self._coalescable = {}
+        self._in_flight = 0
+        self._pending = 0
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+        # 統計
+        self.sent = 0
+        self.coalesced = 0
+
+    @property
+    def pending(self):
+        """
+        列で待っている送信の数
+        """
+        return self._pending
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def saturated(self):
+        return self._pending >= self.max_pending
+
+    def submit(self, bucket, func, *args, priority=PRIORITY_NORMAL, coalesce_key=None, **kwargs):
+        """
+        func(*args, **kwargs) の送信を積み、結果が入る Future を返す
+
+        coalesce_key を指定し、同じキーの送信がまだ送られずに待っていれば、
+        その送信の内容を置き換えて同じ Future を返す。
+        """
+        if coalesce_key is not None:
+            job = self._coalescable.get(coalesce_key)
+            if job is not None:
+                job.func, job.args, job.kwargs = func, args, kwargs
+                job.context = contextvars.copy_context()
+                self.coalesced += 1
+                return job.future
+
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(bucket, priority, next(self._seq), func, args, kwargs, future, coalesce_key,
+                   contextvars.copy_context())
+        if coalesce_key is not None:
+            self._coalescable[coalesce_key] = job
+        queue = self._queues.get(bucket)
+        if queue is None:
+            queue = self._queues[bucket] = deque()
+        queue.append(job)
+        self._pending += 1
+        if self.saturated:
+            self._capacity.clear()
+        if len(queue) == 1 and bucket not in self._busy:
+            heapq.heappush(self._ready, (priority, job.seq, bucket))
+        self._pump()
+        return future
+
+    def _pump(self):
+        loop = asyncio.get_running_loop()
+        while self._ready and self._in_flight < self.max_in_flight:
+            _, _, bucket = heapq.heappop(self._ready)
+            retry_after = self._take(bucket, loop.time())
+            if retry_after:
+                # 回数が戻るまでこのバケットは列で待たせる
+                self._busy.add(bucket)
+                loop.call_later(retry_after, self._wake, bucket)
+                continue
+            job = self._queues[bucket].popleft()
+            self._pending -= 1
+            if job.coalesce_key is not None:
+                self._coalescable.pop(job.coalesce_key, None)
+            self._busy.add(bucket)
+            self._in_flight += 1
+            # 列を動かしたタスクではなく、送信を積んだタスクのコンテキストで送る
+            job.context.run(loop.create_task, self._send(job))
+        if self._pending <= self.max_pending // 2:
+            self._capacity.set()
+
+    def _take(self, bucket, now):
+        """
+        バケットの回数を1つ使う。使い切っていれば回数が戻るまでの秒数を返す
+        """
+        limit = self.bucket_limits.get(bucket[0] if isinstance(bucket, tuple) else bucket)
+        if limit is None:
+            return 0.0
+        window = self._windows.get(bucket)
+        if window is None or now >= window[1]:
+            if len(self._windows) > 1024 + 2 * len(self._queues):
+                # 期限の切れた記録を捨てる
+                self._windows = {key: value for key, value in self._windows.items() if value[1] > now}
+            window = self._windows[bucket] = [limit[0], now + limit[1] + self.margin]
+        if window[0] <= 0:
+            return window[1] - now
+        window[0] -= 1
+        return 0.0
+
+    def _wake(self, bucket):
+        self._busy.discard(bucket)
+        queue = self._queues.get(bucket)
+        if queue:
+            head = queue[0]
+            heapq.heappush(self._ready, (head.priority, head.seq, bucket))
+            self._pump()
+
+    async def _send(self, job):
+        try:
+            result = await job.func(*job.args, **job.kwargs)
+        except BaseException as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self.sent += 1
+            self._in_flight -= 1
+            self._busy.discard(job.bucket)
+            queue = self._queues[job.bucket]
+            if queue:
+                head = queue[0]
+                heapq.heappush(self._ready, (head.priority, head.seq, job.bucket))
+            else:
+                del self._queues[job.bucket]
+            self._pump()
+
+    async def wait_for_capacity(self, timeout=None):
+        """
+        列の送信待ちが max_pending の半分以下になるまで待つ。timeout 秒で空かなければ False
+        """
+        if not self.saturated and self._capacity.is_set():
+            return True
+        try:
+            await asyncio.wait_for(self._capacity.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
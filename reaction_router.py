@@ -0,0 +1,119 @@
+"""
+メッセージID単位のリアクションイベント振り分け
+
+bot.wait_for は全てのリアクションイベントで全リスナーの条件関数を評価するため、
+進行中のセッション数に比例してコストが増える。
+ここではメッセージIDをキーにした辞書で、イベントを持ち主のセッションへ O(1) で届ける。
+"""
+import asyncio
+from collections import deque, namedtuple
+
+# emoji: 絵文字の文字列, user_id: 押した人のID,
+# member: 押した人（追加イベントのみ、削除イベントでは None）, added: 追加なら True
+ReactionEvent = namedtuple('ReactionEvent', ['emoji', 'user_id', 'member', 'added'])
+
+
+class ReactionRouter:
+    """
+    メッセージIDごとに1つのハンドラを登録し、リアクションイベントを振り分ける
+    """
+
+    def __init__(self, timers=None):
+        self._handlers = {}
+        # 受信箱のタイムアウトに使うタイマー（call_later を持つもの。None ならイベントループ）
+        self._timers = timers
+
+    def __len__(self):
+        return len(self._handlers)
+
+    def message_ids(self):
+        """
+        ハンドラが登録されているメッセージIDの一覧
+        """
+        return self._handlers.keys()
+
+    def register(self, message_id, handler):
+        """
+        handler(event) をメッセージのリアクションイベントの受け取り先として登録する
+        """
+        self._handlers[message_id] = handler
+
+    def unregister(self, message_id):
+        self._handlers.pop(message_id, None)
+
+    def open_inbox(self, message_id):
+        """
+        メッセージ宛てのイベントを溜めておく受信箱を作って登録する
+        """
+        inbox = ReactionInbox(self, message_id, self._timers)
+        self.register(message_id, inbox.push)
+        return inbox
+
+    def dispatch(self, message_id, event):
+        """
+        イベントを持ち主のセッションへ届ける。持ち主がいなければ False
+        """
+        handler = self._handlers.get(message_id)
+        if handler is None:
+            return False
+        handler(event)
+        return True
+
+
+class ReactionInbox:
+    """
+    1つのメッセージ宛てのリアクションイベントを順番に受け取る
+
+    待機のたびにタスクを作らず、Future とタイマーだけで待つ。
+    timers を渡すとタイムアウトをそのタイマー（スケジューラーのタイマーホイールなど）に登録する。
+    """
+
+    def __init__(self, router=None, message_id=None, timers=None):
+        self._router = router
+        self._message_id = message_id
+        self._timers = timers
+        self._events = deque()
+        self._waiter = None
+
+    def push(self, event):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(event)
+            self._waiter = None
+        else:
+            self._events.append(event)
+
+    async def get(self, timeout=None):
+        """
+        次のイベントを返す。timeout 秒以内に届かなければ asyncio.TimeoutError
+        """
+        if self._events:
+            return self._events.popleft()
+        if timeout is not None and timeout <= 0:
+            raise asyncio.TimeoutError
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiter = waiter
+        timer = None
+        if timeout is not None:
+            timer = (loop if self._timers is None else self._timers).call_later(timeout, _expire, waiter)
+        try:
+            return await waiter
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if self._waiter is waiter:
+                self._waiter = None
+
+    def close(self):
+        """
+        ルーターから登録を外す
+        """
+        if self._router is not None:
+            self._router.unregister(self._message_id)
+            self._router = None
+
+
+def _expire(waiter):
+    if not waiter.done():
+        waiter.set_exception(asyncio.TimeoutError())
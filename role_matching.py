@@ -0,0 +1,386 @@
+"""
+除外設定付きロール割り当ての厳密マッチングエンジン
+
+プレイヤーとロールの二部グラフとして扱い、
+- 割り当て可能かどうかを多項式時間で判定する（Hopcroft-Karp）
+- 有効な割り当ての総数を数える（ロール集合のビットマスクDP）
+- 有効な割り当て全体から一様にランダムに1つ選ぶ
+を行う。各プレイヤーの「担当可能ロール」はロール番号のビットマスクで表す。
+"""
+import random
+from collections import deque
+
+# 厳密な一様サンプリング（数え上げDP）を必ず使うロール数の上限
+MAX_EXACT_ROLES = 16
+
+# ロール数がそれより多い場合も、DPの状態数（と再帰の深さになるプレイヤー数）がこの上限に収まれば厳密に選ぶ。
+# 収まらない場合は、定常分布が一様なマルコフ連鎖に切り替える
+MAX_EXACT_STATES = 1 << 14
+MAX_EXACT_PLAYERS = 256
+
+# マルコフ連鎖のステップ数（プレイヤー1人あたり）
+MIXING_STEPS_PER_PLAYER = 64
+
+
+def roles_to_mask(roles, role_index):
+    """
+    ロールキーの集合をビットマスクに変換する
+    """
+    mask = 0
+    for role in roles:
+        mask |= 1 << role_index[role]
+    return mask
+
+
+def mask_to_indices(mask):
+    """
+    ビットマスクに含まれるロール番号を昇順で返す
+    """
+    indices = []
+    while mask:
+        low = mask & -mask
+        indices.append(low.bit_length() - 1)
+        mask ^= low
+    return indices
+
+
+def find_matching(allowed_masks, n_roles, rng=None):
+    """
+    Hopcroft-Karp法で全プレイヤーを埋める割り当てを1つ探す
+
+    戻り値はプレイヤー順のロール番号リスト。割り当て不可能なら None。
+    rng を渡すと隣接ロールの探索順をシャッフルする。
+    """
+    n_players = len(allowed_masks)
+    if n_players > n_roles:
+        return None
+
+    adjacency = [mask_to_indices(mask) for mask in allowed_masks]
+    if rng is not None:
+        for roles in adjacency:
+            rng.shuffle(roles)
+    if any(not roles for roles in adjacency):
+        return None
+
+    unmatched = -1
+    player_role = [unmatched] * n_players
+    role_player = [unmatched] * n_roles
+    infinity = n_players + 1
+
+    def bfs(dist):
+        queue = deque()
+        for p in range(n_players):
+            if player_role[p] == unmatched:
+                dist[p] = 0
+                queue.append(p)
+            else:
+                dist[p] = infinity
+        found = False
+        while queue:
+            p = queue.popleft()
+            for r in adjacency[p]:
+                q = role_player[r]
+                if q == unmatched:
+                    found = True
+                elif dist[q] == infinity:
+                    dist[q] = dist[p] + 1
+                    queue.append(q)
+        return found
+
+    def dfs(p, dist):
+        # 反復版DFS（プレイヤー数が多くても再帰上限に当たらないように）
+        stack = [(p, iter(adjacency[p]))]
+        path = []
+        while stack:
+            current, roles = stack[-1]
+            advanced = False
+            for r in roles:
+                q = role_player[r]
+                if q == unmatched:
+                    path.append((current, r))
+                    for player, role in path:
+                        player_role[player] = role
+                        role_player[role] = player
+                    return True
+                if dist[q] == dist[current] + 1:
+                    path.append((current, r))
+                    stack.append((q, iter(adjacency[q])))
+                    advanced = True
+                    break
+            if not advanced:
+                dist[current] = infinity
+                stack.pop()
+                if path:
+                    path.pop()
+        return False
+
+    dist = [0] * n_players
+    matched = 0
+    while bfs(dist):
+        for p in range(n_players):
+            if player_role[p] == unmatched and dfs(p, dist):
+                matched += 1
+
+    if matched < n_players:
+        return None
+    return player_role
+
+
+def is_feasible(allowed_masks, n_roles):
+    """
+    全員にロールを割り当て可能かどうか
+    """
+    return find_matching(allowed_masks, n_roles) is not None
+
+
+class _TooManyStates(Exception):
+    pass
+
+
+def _counting_table(allowed_masks, max_states=None):
+    """
+    ways(i, used) = プレイヤー i 以降を used 以外のロールで埋める方法の数
+    を返すメモ化関数を作る
+
+    max_states を渡すと、メモの数がそれを超えた時点で _TooManyStates を送出する。
+    """
+    n_players = len(allowed_masks)
+    memo = {}
+
+    def ways(i, used):
+        if i == n_players:
+            return 1
+        key = (i, used)
+        cached = memo.get(key)
+        if cached is not None:
+            return cached
+        if max_states is not None and len(memo) >= max_states:
+            raise _TooManyStates
+        total = 0
+        free = allowed_masks[i] & ~used
+        while free:
+            low = free & -free
+            total += ways(i + 1, used | low)
+            free ^= low
+        memo[key] = total
+        return total
+
+    return ways
+
+
+def _constraint_order(allowed_masks):
+    # 選択肢の少ないプレイヤーから処理するとDPの状態数が小さくなる
+    return sorted(range(len(allowed_masks)), key=lambda p: bin(allowed_masks[p]).count('1'))
+
+
+def count_assignments(allowed_masks, n_roles):
+    """
+    有効な割り当て（各プレイヤーに異なる担当可能ロール）の総数
+    """
+    if len(allowed_masks) > n_roles:
+        return 0
+    if not is_feasible(allowed_masks, n_roles):
+        return 0
+    order = _constraint_order(allowed_masks)
+    ways = _counting_table([allowed_masks[p] for p in order])
+    return ways(0, 0)
+
+
+def _sample_exact(allowed_masks, rng, max_states=None):
+    order = _constraint_order(allowed_masks)
+    ordered_masks = [allowed_masks[p] for p in order]
+    ways = _counting_table(ordered_masks, max_states)
+
+    result = [None] * len(allowed_masks)
+    used = 0
+    for i, mask in enumerate(ordered_masks):
+        candidates = []
+        weights = []
+        free = mask & ~used
+        while free:
+            low = free & -free
+            weight = ways(i + 1, used | low)
+            if weight:
+                candidates.append(low)
+                weights.append(weight)
+            free ^= low
+        # 残りの割り当て数に比例して選ぶので、完成形は全体から一様になる
+        pick = rng.randrange(sum(weights))
+        for low, weight in zip(candidates, weights):
+            if pick < weight:
+                break
+            pick -= weight
+        used |= low
+        result[order[i]] = low.bit_length() - 1
+    return result
+
+
+def _sample_markov(allowed_masks, n_roles, rng):
+    """
+    交互閉路・交互路の入れ替えによるマルコフ連鎖で選ぶ（数え上げきれない場合）
+
+    1ステップでは、プレイヤー p を選んで担当可能ロールの1つへ移し、そのロールを持っていた人を
+    同じように担当可能ロールの1つへ押し出す……を、空いているロール（p が空けたものを含む）に
+    移るまで続ける。同じステップで既に誰かが移ったロールを選んだら、そのステップは何もしない。
+
+    移る確率は (1 / 人数) × 動いた各プレイヤーの (1 / 担当可能ロール数) の積で、
+    逆向きの移動も同じプレイヤーが同じ数の選択肢から選ぶので等しい
+    （閉路はどのプレイヤーから始めても同じ積になり、始め方の数も両向きで同じ）。
+    そのためメトロポリス法の採択確率 min(1, 逆向き / 順向き) は常に1で、定常分布は一様になる。
+    2つの割り当ての差は交互閉路・交互路に分かれ、それぞれが1ステップの移動なので、どの割り当ての間も移り合える。
+    ステップ数は有限なので、結果は厳密な一様ではなく一様に近づいたもの。
+    """
+    player_role = find_matching(allowed_masks, n_roles, rng=rng)
+    if player_role is None:
+        return None
+    n_players = len(allowed_masks)
+    role_player = [-1] * n_roles
+    for p, r in enumerate(player_role):
+        role_player[r] = p
+    adjacency = [mask_to_indices(mask) for mask in allowed_masks]
+
+    for _ in range(MIXING_STEPS_PER_PLAYER * n_players):
+        p = rng.randrange(n_players)
+        vacated = player_role[p]
+        moves = []
+        taken = set()
+        player = p
+        while True:
+            r = rng.choice(adjacency[player])
+            if r in taken or (player == p and r == vacated):
+                moves = None
+                break
+            moves.append((player, r))
+            taken.add(r)
+            if r == vacated or role_player[r] == -1:
+                # 閉路が閉じた・空いているロールに移った
+                break
+            player = role_player[r]
+        if not moves:
+            continue
+        for player, _ in moves:
+            role_player[player_role[player]] = -1
+        for player, r in moves:
+            player_role[player] = r
+            role_player[r] = player
+    return player_role
+
+
+def sample_assignment(allowed_masks, n_roles, rng=None):
+    """
+    有効な割り当て全体から一様にランダムに1つ選ぶ
+
+    戻り値はプレイヤー順のロール番号リスト。割り当て不可能なら None。
+    ロール数が MAX_EXACT_ROLES を超え、数え上げも MAX_EXACT_STATES に収まらない場合だけ
+    マルコフ連鎖による選び方になり、厳密な一様ではなくなる。
+    """
+    rng = rng or random
+    if len(allowed_masks) > n_roles:
+        return None
+    if not is_feasible(allowed_masks, n_roles):
+        return None
+    if not allowed_masks:
+        return []
+    if n_roles <= MAX_EXACT_ROLES:
+        return _sample_exact(allowed_masks, rng)
+    if len(allowed_masks) <= MAX_EXACT_PLAYERS:
+        try:
+            return _sample_exact(allowed_masks, rng, MAX_EXACT_STATES)
+        except _TooManyStates:
+            pass
+    return _sample_markov(allowed_masks, n_roles, rng)
+
+
+class FeasibilityIndex:
+    """
+    担当可能ロールのビットマスクの組み合わせ（多重集合）ごとに、
+    有効な割り当ての数を起動時に全て計算しておく索引
+
+    ロール数が少ない（5ロール → マスクは31種類）ので、プレイヤー数 n_roles 人までの
+    全ての組み合わせを1バイトずつ保持しても数百KBに収まる。
+    問い合わせはマスクを並べ替えて順位を計算するだけなので定数時間。
+    """
+
+    def __init__(self, n_roles):
+        if n_roles > 5:
+            # 6ロール以上は組み合わせ数と割り当て数（最大 n!）が1バイトに収まらない
+            raise ValueError("FeasibilityIndex は5ロールまで対応しています")
+        self.n_roles = n_roles
+        self.full_mask = (1 << n_roles) - 1
+        n_masks = self.full_mask  # 空マスクを除いたマスクの種類数
+
+        # 多重集合の順位計算用の二項係数表
+        self._binomial = [[0] * (n_roles + 2) for _ in range(n_masks + n_roles + 1)]
+        for n in range(len(self._binomial)):
+            self._binomial[n][0] = 1
+            for k in range(1, min(n, n_roles + 1) + 1):
+                self._binomial[n][k] = self._binomial[n - 1][k - 1] + self._binomial[n - 1][k]
+
+        # counts[k][rank] = k人の組み合わせの割り当て数（0なら割り当て不可能）
+        self._counts = [bytearray(self._binomial[n_masks + k - 1][k]) for k in range(n_roles + 1)]
+        self._counts[0][0] = 1
+
+        # transitions[mask][used] = マスク mask のプレイヤーを追加した後の使用済みロール集合
+        bits = [1 << r for r in range(n_roles)]
+        transitions = [
+            [[used | bit for bit in bits if mask & bit and not used & bit] for used in range(self.full_mask + 1)]
+            for mask in range(self.full_mask + 1)
+        ]
+
+        def build(first_mask, depth, ways, rank):
+            # ways: 使用済みロール集合 → そこに至る割り当て数
+            for mask in range(first_mask, self.full_mask + 1):
+                added = {}
+                for used, count in ways.items():
+                    for next_used in transitions[mask][used]:
+                        added[next_used] = added.get(next_used, 0) + count
+                if not added:
+                    # 割り当て不可能な組み合わせを含む拡張は全て不可能（0のまま）
+                    continue
+                next_rank = rank + self._binomial[mask - 1 + depth][depth + 1]
+                self._counts[depth + 1][next_rank] = sum(added.values())
+                if depth + 1 < n_roles:
+                    build(mask, depth + 1, added, next_rank)
+
+        build(1, 0, {0: 1}, 0)
+
+    def _rank(self, sorted_masks):
+        rank = 0
+        for i, mask in enumerate(sorted_masks):
+            rank += self._binomial[mask - 1 + i][i + 1]
+        return rank
+
+    def count(self, allowed_masks):
+        """
+        有効な割り当ての数（0なら割り当て不可能）
+        """
+        if len(allowed_masks) > self.n_roles:
+            return 0
+        sorted_masks = sorted(mask & self.full_mask for mask in allowed_masks)
+        if sorted_masks and sorted_masks[0] == 0:
+            return 0
+        return self._counts[len(sorted_masks)][self._rank(sorted_masks)]
+
+    def is_feasible(self, allowed_masks):
+        """
+        全員にロールを割り当て可能かどうか
+        """
+        return self.count(allowed_masks) > 0
+
+    def hall_violation(self, allowed_masks):
+        """
+        割り当て不可能な原因となっている最小の衝突グループを返す
+
+        ホールの定理より、割り当て不可能なら「担当可能ロールが全てロール集合 T に
+        含まれるプレイヤー」が |T| 人より多くなる T が存在する。
+        そのような T のうちロール数が最小のものを選び、
+        (該当プレイヤーの番号リスト, T のビットマスク) を返す。割り当て可能なら None。
+        """
+        if self.is_feasible(allowed_masks):
+            return None
+        masks = [mask & self.full_mask for mask in allowed_masks]
+        for role_set in sorted(range(self.full_mask + 1), key=lambda t: (bin(t).count('1'), t)):
+            players = [p for p, mask in enumerate(masks) if mask & ~role_set == 0]
+            if len(players) > bin(role_set).count('1'):
+                return players, role_set
+        return None
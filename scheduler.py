@@ -0,0 +1,318 @@
+"""
+セッションのタイムアウトと後片付けをまとめて扱うスケジューラー
+
+- TimerWheel: 全ての期限を1つのタイマーホイールで持ち、1つのタスクで発火させる。
+  登録・取り消しは O(1) で、セッションごとに待機用のタスクやタイマーを作らない。
+- Scheduler: 再起動をまたいで実行したい後片付け（一時チャンネルの削除など）を
+  SQLite に保存しておき、起動時に期限切れのものを実行し直す。
+  保存は専用スレッドがまとめて行うので、選択のたびの予約し直しでもイベントループを止めない。
+"""
+import asyncio
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+_STOP = object()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    due_at REAL NOT NULL,
+    payload TEXT NOT NULL
+);
+"""
+
+
+class TimerHandle:
+    """
+    TimerWheel.call_later の戻り値。cancel() で取り消す
+    """
+
+    __slots__ = ('tick', 'callback', 'args', '_wheel', '_slot')
+
+    def __init__(self, wheel, tick, callback, args):
+        self._wheel = wheel
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self._slot = None
+
+    def cancel(self):
+        if self._slot is not None:
+            del self._slot[self]
+            self._slot = None
+            self._wheel._count -= 1
+            self._wheel.metrics['cancelled'] += 1
+
+
+class TimerWheel:
+    """
+    刻み幅 resolution 秒、slots 個の枠を持つハッシュ式タイマーホイール
+
+    loop.call_later と同じ呼び出し方で使える（発火は期限後の最初の刻み）。
+    期限は「何刻み目か」で持ち、枠は 刻み % slots で選ぶので、
+    一周より先の期限も同じ枠に入れておき、その刻みが来た時だけ発火する。
+    """
+
+    def __init__(self, resolution=1.0, slots=512):
+        self.resolution = resolution
+        self._slots = [dict() for _ in range(slots)]
+        self._count = 0
+        # 処理し終えた刻み
+        self._tick = 0
+        self._origin = None
+        self._driver = None
+        self._wakeup = None
+        self.metrics = {'scheduled': 0, 'fired': 0, 'cancelled': 0}
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, callback, *args):
+        """
+        delay 秒後に callback(*args) をイベントループ上で呼ぶ
+        """
+        loop = asyncio.get_running_loop()
+        if self._driver is None or self._driver.done():
+            self._origin = loop.time()
+            self._tick = 0
+            self._wakeup = asyncio.Event()
+            self._driver = loop.create_task(self._run())
+
+        elapsed = loop.time() - self._origin
+        now_tick = int(elapsed // self.resolution)
+        if self._count == 0:
+            # 空の間の刻みは処理しなくてよいので飛ばす
+            self._tick = max(self._tick, now_tick)
+        # 期限より早く発火しないよう切り上げ、少なくとも次の刻みにする
+        tick = max(now_tick + 1, -int(-(elapsed + max(delay, 0)) // self.resolution))
+        handle = TimerHandle(self, tick, callback, args)
+        slot = self._slots[tick % len(self._slots)]
+        slot[handle] = None
+        handle._slot = slot
+        self._count += 1
+        self.metrics['scheduled'] += 1
+        self._wakeup.set()
+        return handle
+
+    def stop(self):
+        if self._driver is not None:
+            self._driver.cancel()
+            self._driver = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._count == 0:
+                # 何も登録されていない間は眠っておく
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            next_at = self._origin + (self._tick + 1) * self.resolution
+            await asyncio.sleep(max(0, next_at - loop.time()))
+            # 遅れた場合は追いつくまで刻みを進める
+            now_tick = int((loop.time() - self._origin) // self.resolution)
+            while self._tick < now_tick and self._count:
+                self._tick += 1
+                self._fire(self._slots[self._tick % len(self._slots)])
+
+    def _fire(self, slot):
+        due = [handle for handle in slot if handle.tick <= self._tick]
+        for handle in due:
+            del slot[handle]
+            handle._slot = None
+            self._count -= 1
+            self.metrics['fired'] += 1
+            try:
+                handle.callback(*handle.args)
+            except Exception as e:
+                print(f"タイマーの処理でエラーが発生しました: {e!r}")
+
+
+class Scheduler:
+    """
+    メモリ上のタイマー（call_later）と、保存される後片付けジョブ（schedule）
+
+    ジョブは種類ごとに登録した async ハンドラ handler(payload) で実行する。
+    path が None ならジョブは保存されず、再起動で失われる。
+    ジョブの登録・削除の保存は書き込み用のスレッドに積むだけですぐ戻る。スレッドは溜まった分を
+    ジョブIDごとに最後の状態だけにまとめ、1回のトランザクションで書き込む。
+    """
+
+    def __init__(self, path=None, resolution=1.0, clock=time.time):
+        self.path = path
+        self._clock = clock
+        self.wheel = TimerWheel(resolution)
+        self._handlers = {}
+        # ジョブID → ホイール上のタイマー
+        self._pending = {}
+        self._started = False
+        self._connection = None
+        self._writes = queue.SimpleQueue()
+        self._writer = None
+        if path:
+            self._connection = sqlite3.connect(path)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(SCHEMA)
+            self._writer = threading.Thread(target=self._write_loop, name="scheduler-writer", daemon=True)
+            self._writer.start()
+        self.metrics = {'scheduled': 0, 'run': 0, 'replayed': 0, 'errors': 0, 'writes': 0, 'write_batches': 0}
+
+    def call_later(self, delay, callback, *args):
+        """
+        保存しないタイマー（セッションのタイムアウトなど）
+        """
+        return self.wheel.call_later(delay, callback, *args)
+
+    def job(self, kind):
+        """
+        ジョブの種類に対応するハンドラを登録するデコレーター
+        """
+        def decorator(handler):
+            self._handlers[kind] = handler
+            return handler
+        return decorator
+
+    def schedule(self, kind, delay, payload, job_id=None):
+        """
+        delay 秒後に kind のハンドラを payload で実行する。同じ job_id があれば置き換える
+        """
+        job_id = job_id or f"{kind}:{json.dumps(payload, sort_keys=True)}"
+        due_at = self._clock() + delay
+        if self._writer is not None:
+            self._writes.put((job_id, (kind, due_at, json.dumps(payload))))
+        self._arm(job_id, kind, delay, payload)
+        self.metrics['scheduled'] += 1
+        return job_id
+
+    def is_scheduled(self, job_id):
+        """
+        job_id のジョブが実行待ちか（保存済みのものは start() の後から分かる）
+        """
+        return job_id in self._pending
+
+    def cancel(self, job_id):
+        handle = self._pending.pop(job_id, None)
+        if handle is not None:
+            handle.cancel()
+        if self._writer is not None:
+            self._writes.put((job_id, None))
+
+    async def start(self):
+        """
+        保存されているジョブを読み込む。期限切れのものはここで実行し終えてから戻る（2回目以降は何もしない）
+        """
+        if self._started:
+            return
+        self._started = True
+        if self._connection is None:
+            return
+
+        # 起動前に登録・削除した分を書き終えてから読む
+        self.flush()
+        now = self._clock()
+        rows = self._connection.execute(
+            "SELECT job_id, kind, due_at, payload FROM scheduled_jobs ORDER BY due_at"
+        ).fetchall()
+        for job_id, kind, due_at, payload in rows:
+            if job_id in self._pending:
+                # 起動後に同じIDで登録し直されたもの
+                continue
+            payload = json.loads(payload)
+            if due_at <= now:
+                self.metrics['replayed'] += 1
+                await self._run(job_id, kind, payload)
+            else:
+                self._arm(job_id, kind, due_at - now, payload)
+
+    def flush(self, timeout=None):
+        """
+        書き込み待ちを全て書き終えるまで待つ（起動時・終了時・ベンチマーク用）
+        """
+        if self._writer is None:
+            return True
+        done = threading.Event()
+        self._writes.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        self.wheel.stop()
+        if self._writer is not None:
+            self._writes.put(_STOP)
+            self._writer.join()
+            self._writer = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _arm(self, job_id, kind, delay, payload):
+        previous = self._pending.pop(job_id, None)
+        if previous is not None:
+            previous.cancel()
+        self._pending[job_id] = self.wheel.call_later(delay, self._fire, job_id, kind, payload)
+
+    def _fire(self, job_id, kind, payload):
+        self._pending.pop(job_id, None)
+        asyncio.get_running_loop().create_task(self._run(job_id, kind, payload))
+
+    async def _run(self, job_id, kind, payload):
+        handler = self._handlers.get(kind)
+        try:
+            if handler is None:
+                print(f"未登録のジョブの種類です: {kind}")
+            else:
+                await handler(payload)
+                self.metrics['run'] += 1
+        except Exception as e:
+            self.metrics['errors'] += 1
+            print(f"ジョブ {job_id} の実行に失敗しました: {e!r}")
+        finally:
+            # 失敗したジョブも繰り返さない。実行中に登録し直された場合は残す
+            if self._writer is not None and job_id not in self._pending:
+                self._writes.put((job_id, None))
+
+    def _write_loop(self):
+        connection = sqlite3.connect(self.path)
+        running = True
+        while running:
+            # ジョブID → 最後の状態（(種類, 期限, payload)、削除なら None）
+            latest = {}
+            waiters = []
+            item = self._writes.get()
+            while True:
+                if item is _STOP:
+                    running = False
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    job_id, row = item
+                    latest[job_id] = row
+                    self.metrics['writes'] += 1
+                try:
+                    item = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+
+            if latest:
+                try:
+                    with connection:
+                        connection.executemany(
+                            "DELETE FROM scheduled_jobs WHERE job_id = ?",
+                            [(job_id,) for job_id, row in latest.items() if row is None]
+                        )
+                        connection.executemany(
+                            "INSERT OR REPLACE INTO scheduled_jobs (job_id, kind, due_at, payload) VALUES (?, ?, ?, ?)",
+                            [(job_id, *row) for job_id, row in latest.items() if row is not None]
+                        )
+                    self.metrics['write_batches'] += 1
+                except sqlite3.Error as e:
+                    self.metrics['errors'] += 1
+                    print(f"ジョブの保存に失敗しました: {e}")
+            for waiter in waiters:
+                waiter.set()
+        connection.close()
@@ -0,0 +1,355 @@
+"""
+セッション状態の保存先
+
+ロール結果や進行中のセッション（除外設定・/secret_role の確定したロール）をここに置くと、
+複数のBotプロセスで同じセッションを扱えるようになり、1つのプロセスが再起動・交代しても
+進行中のセッションを失わない。
+
+- MemoryBackend: プロセス内の辞書（既定。1プロセスだけで動かす場合）
+- NetworkBackend: TCP でキー・値サーバーにつなぐ（kv://host:port）
+- serve: MemoryBackend をサーバーとして公開する。手元で試す時や小さな構成の代役サーバーとして
+  python session_backend.py --port 7700 で起動できる
+
+値は JSON にできるもの。各キーは書き込みのたびに増える版番号を持ち、compare_and_set は
+版番号が読んだ時のままの時だけ書き込む。update はこれを使い、他のプロセスが同時に
+書き換えていたら読み直してやり直すので、ロールの確定や除外の切り替えが他の変更を上書きしない。
+"""
+import argparse
+import asyncio
+import heapq
+import itertools
+import json
+import random
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+# update が衝突で読み直す回数の上限と、やり直す前に待つ時間の目安（秒、回数に比例してばらつかせる）
+MAX_UPDATE_ATTEMPTS = 20
+UPDATE_BACKOFF = 0.002
+
+
+class BackendError(Exception):
+    """
+    サーバーが要求を処理できなかった
+    """
+
+
+class ConflictError(BackendError):
+    """
+    update が何度やり直しても他の書き込みと衝突した
+    """
+
+
+# 保存先が使えない時に起こりうる例外（呼び出し側はセッション自体は続けられるように扱う）
+BACKEND_ERRORS = (BackendError, OSError, asyncio.TimeoutError)
+
+
+class SessionBackend:
+    """
+    保存先の共通部分。get・set・compare_and_set・delete・keys を実装する
+
+    get は (値, 版番号) を返し、キーがなければ (None, 0)。
+    compare_and_set(key, version, value) は版番号が version の時だけ書き込んで新しい版番号を返し、
+    衝突したら None を返す（version=0 は「まだ存在しない時だけ」）。
+    ttl を指定した書き込みは、最後の書き込みから ttl 秒で消える。
+    """
+
+    async def update(self, key, func, ttl=None):
+        """
+        今の値を func(値) で書き換える。キーがなければ func(None)
+
+        func が None を返したら書き込まない（キーがなくなっていた時など）。
+        同じ値（同じオブジェクト）を返したら変更なしとして書き込まない。
+        他の書き込みと衝突したら読み直して func を呼び直すので、func は副作用を持たないこと。
+        戻り値は書き込んだ（または今の）値。
+        """
+        for attempt in range(MAX_UPDATE_ATTEMPTS):
+            value, version = await self.get(key)
+            new_value = func(value)
+            if new_value is None or new_value is value:
+                return new_value
+            if await self.compare_and_set(key, version, new_value, ttl) is not None:
+                return new_value
+            # 同じキーを取り合っている他の書き込みと足並みがそろわないよう、ばらつかせて待つ
+            await asyncio.sleep(random.uniform(0, UPDATE_BACKOFF * (attempt + 1)))
+        raise ConflictError(key)
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(SessionBackend):
+    """
+    プロセス内の辞書に保存する
+
+    期限の切れたものは書き込みのたびにまとめて捨てるので、二度と読まれないものも溜まり続けない。
+    max_entries を超えたら最も古く書き込まれたものから捨てる。
+    """
+
+    def __init__(self, max_entries=100000, clock=time.monotonic):
+        self.max_entries = max_entries
+        self._clock = clock
+        # キー → [値, 版番号, 期限（なければ None）]。先頭ほど古く書き込まれたもの
+        self._entries = OrderedDict()
+        # (期限, キー, 版番号) のヒープ。書き直されたキーの古い期限は、取り出した時に読み飛ばす
+        self._deadlines = []
+        self._versions = itertools.count(1)
+        self.metrics = {
+            'evicted_expired': 0,
+            'evicted_capacity': 0
+        }
+
+    def __len__(self):
+        self._purge_expired()
+        return len(self._entries)
+
+    def stats(self):
+        """
+        現在の件数と、期限切れ・上限で捨てた数の累計
+        """
+        stats = dict(self.metrics)
+        stats['entries'] = len(self)
+        return stats
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= self._clock():
+            del self._entries[key]
+            self.metrics['evicted_expired'] += 1
+            return None
+        return entry
+
+    def _purge_expired(self):
+        now = self._clock()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, key, version = heapq.heappop(self._deadlines)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == version:
+                del self._entries[key]
+                self.metrics['evicted_expired'] += 1
+
+    def _write(self, key, value, ttl):
+        # JSON を通して、サーバー経由と同じ形（キーが文字列の辞書、タプルはリスト）にそろえる
+        value = json.loads(json.dumps(value))
+        version = next(self._versions)
+        expires_at = self._clock() + ttl if ttl else None
+        self._entries[key] = [value, version, expires_at]
+        self._entries.move_to_end(key)
+        if expires_at is not None:
+            heapq.heappush(self._deadlines, (expires_at, key, version))
+        self._purge_expired()
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.metrics['evicted_capacity'] += 1
+        return version
+
+    async def get(self, key):
+        entry = self._lookup(key)
+        if entry is None:
+            return None, 0
+        return entry[0], entry[1]
+
+    async def set(self, key, value, ttl=None):
+        return self._write(key, value, ttl)
+
+    async def compare_and_set(self, key, version, value, ttl=None):
+        entry = self._lookup(key)
+        if (entry[1] if entry is not None else 0) != version:
+            return None
+        return self._write(key, value, ttl)
+
+    async def delete(self, key):
+        self._entries.pop(key, None)
+
+    async def keys(self, prefix=''):
+        return [key for key in list(self._entries) if key.startswith(prefix) and self._lookup(key) is not None]
+
+
+class NetworkBackend(SessionBackend):
+    """
+    serve() で公開されたサーバーに保存する
+
+    1本の接続に要求を番号付きで流し、応答を番号で受け取る。接続が切れていたら次の要求でつなぎ直す。
+    """
+
+    def __init__(self, host, port, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+        self._waiters = {}
+        self._writer = None
+        self._reader_task = None
+        self._connecting = None
+
+    async def _connect(self):
+        """
+        つながっている writer を返す（切れていればつなぎ直す）
+        """
+        if self._writer is not None and not self._writer.is_closing():
+            return self._writer
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._open())
+        try:
+            await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+        # つないだ直後に切れていることもある
+        writer = self._writer
+        if writer is None or writer.is_closing():
+            raise ConnectionError("セッション状態のサーバーとの接続が切れました")
+        return writer
+
+    async def _open(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        self._writer = writer
+        self._reader_task = asyncio.ensure_future(self._read_responses(reader, writer))
+
+    async def _read_responses(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                waiter = self._waiters.pop(response.pop('id'), None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(response)
+        except (OSError, ValueError) as e:
+            print(f"セッション状態のサーバーからの応答を読めませんでした: {e!r}")
+        finally:
+            # 応答待ちの要求は失敗させる（呼び出し側が再試行する）
+            waiters, self._waiters = self._waiters, {}
+            for waiter in waiters.values():
+                if not waiter.done():
+                    waiter.set_exception(ConnectionError("セッション状態のサーバーとの接続が切れました"))
+            writer.close()
+            if self._writer is writer:
+                self._writer = None
+
+    async def _request(self, op, **fields):
+        writer = await self._connect()
+        request_id = next(self._ids)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[request_id] = waiter
+        writer.write(json.dumps({'id': request_id, 'op': op, **fields}).encode() + b'\n')
+        try:
+            response = await asyncio.wait_for(waiter, self.timeout)
+        finally:
+            self._waiters.pop(request_id, None)
+        if 'error' in response:
+            raise BackendError(response['error'])
+        return response
+
+    async def get(self, key):
+        response = await self._request('get', key=key)
+        return response['value'], response['version']
+
+    async def set(self, key, value, ttl=None):
+        return (await self._request('set', key=key, value=value, ttl=ttl))['version']
+
+    async def compare_and_set(self, key, version, value, ttl=None):
+        return (await self._request('cas', key=key, version=version, value=value, ttl=ttl))['version']
+
+    async def delete(self, key):
+        await self._request('delete', key=key)
+
+    async def keys(self, prefix=''):
+        return (await self._request('keys', prefix=prefix))['keys']
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+
+
+async def handle_request(backend, request):
+    """
+    1件の要求を backend で処理し、応答の辞書を返す
+    """
+    op = request.get('op')
+    key = request.get('key')
+    if op == 'get':
+        value, version = await backend.get(key)
+        return {'value': value, 'version': version}
+    if op == 'set':
+        return {'version': await backend.set(key, request['value'], request.get('ttl'))}
+    if op == 'cas':
+        return {'version': await backend.compare_and_set(key, request['version'], request['value'], request.get('ttl'))}
+    if op == 'delete':
+        await backend.delete(key)
+        return {}
+    if op == 'keys':
+        return {'keys': await backend.keys(request.get('prefix', ''))}
+    return {'error': f"不明な操作です: {op}"}
+
+
+async def serve(host, port, backend=None):
+    """
+    backend（省略時は新しい MemoryBackend）を TCP で公開するサーバーを起動する
+
+    要求・応答は1行1つの JSON。MemoryBackend の操作は途中で他の要求に割り込まれないので、
+    compare_and_set は接続をまたいでも不可分に行われる。
+    """
+    if backend is None:
+        backend = MemoryBackend()
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = {}
+                try:
+                    request = json.loads(line)
+                    response = await handle_request(backend, request)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    response = {'error': repr(e)}
+                response['id'] = request.get('id') if isinstance(request, dict) else None
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+def open_backend(url=None):
+    """
+    URL から保存先を作る。未設定ならプロセス内の MemoryBackend、kv://host:port ならサーバー
+    """
+    if not url:
+        return MemoryBackend()
+    parts = urlsplit(url)
+    if parts.scheme != 'kv' or not parts.hostname or not parts.port:
+        raise ValueError(f"セッション状態の保存先は kv://host:port の形式で指定してください: {url}")
+    return NetworkBackend(parts.hostname, parts.port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7700)
+    parser.add_argument('--max-entries', type=int, default=100000)
+    args = parser.parse_args()
+
+    async def run():
+        server = await serve(args.host, args.port, MemoryBackend(args.max_entries))
+        print(f"セッション状態のサーバーを kv://{args.host}:{args.port} で起動しました")
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+ロール決めセッションの状態
+
+1セッションごとに辞書（Member・ロール名の set・参加フラグ）を作る代わりに、__slots__ 付きの
+小さなオブジェクトにまとめる。
+- メンバーは Member ではなくユーザーIDで持つ（表示に使うメンバーはコマンドの処理側が持っている）
+- 除外したロール・選択済みのロールはロール番号のビットマスク（int）で持つ
+ので、1セッションあたりのメモリが減り、抽選時に set からビットマスクへ変換する手間もなくなる。
+"""
+import asyncio
+
+# 不参加の印（ロールのビットと重ならない上位ビット）
+ABSENT_BIT = 1 << 30
+
+
+class OrderedTasks:
+    """
+    セッションの裏で行う処理（保存先への書き込みなど）を、受け取った順に1つずつ実行する
+
+    失敗はその場で表示して次の処理に進む。セッションの終了時は drain() で残りが終わるのを待つ。
+    """
+    __slots__ = ('label', '_tail', '_pending')
+
+    def __init__(self, label):
+        # 失敗を表示する時の処理の名前
+        self.label = label
+        self._tail = None
+        self._pending = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, func, *args):
+        """
+        先に受け取った処理が終わってから await func(*args) を実行するタスク
+        """
+        previous = self._tail
+
+        async def run():
+            if previous is not None:
+                # 前の処理の成否によらず、順番だけを守る
+                await asyncio.wait([previous])
+            return await func(*args)
+
+        task = asyncio.ensure_future(run())
+        self._tail = task
+        self._pending.add(task)
+        task.add_done_callback(self._finished)
+        return task
+
+    def _finished(self, task):
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"{self.label}に失敗しました: {task.exception()!r}")
+
+    async def drain(self):
+        """
+        受け取った処理が全て終わるまで待つ（失敗は表示済みなので送出しない）
+        """
+        if self._tail is not None:
+            await asyncio.wait([self._tail])
+
+
+class ExclusionSettings:
+    """
+    /exclude_role・/team_role の除外設定: ユーザーID → 除外したロールのビットマスク（不参加なら ABSENT_BIT も立てる）
+
+    一度も操作していない人は載せない（全ロールOK・参加扱い）。
+    """
+    __slots__ = ('flags',)
+
+    def __init__(self):
+        self.flags = {}
+
+    def __len__(self):
+        return len(self.flags)
+
+    def _set(self, user_id, bit, on):
+        flags = self.flags.get(user_id, 0)
+        flags = flags | bit if on else flags & ~bit
+        if flags:
+            self.flags[user_id] = flags
+        else:
+            self.flags.pop(user_id, None)
+
+    def set_excluded(self, user_id, role_number, excluded):
+        self._set(user_id, 1 << role_number, excluded)
+
+    def set_participating(self, user_id, participating):
+        self._set(user_id, ABSENT_BIT, not participating)
+
+    def is_participating(self, user_id):
+        return not self.flags.get(user_id, 0) & ABSENT_BIT
+
+    def excluded_mask(self, user_id):
+        return self.flags.get(user_id, 0) & ~ABSENT_BIT
+
+    def to_dict(self):
+        """
+        JSON にできる形（ユーザーIDは文字列）。セッション状態の保存先に置く時に使う
+        """
+        return {str(user_id): flags for user_id, flags in self.flags.items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        settings = cls()
+        settings.flags = {int(user_id): flags for user_id, flags in data.items() if flags}
+        return settings
+
+
+class ExclusionSession:
+    """
+    進行中の /exclude_role・/team_role のセッション
+
+    除外設定（ExclusionSettings）もセッションが持つので、進行中のセッションの設定が先に捨てられることはない。
+    """
+    __slots__ = ('session_id', 'channel', 'member_ids', 'settings', 'executed', 'last_activity', 'inbox', 'view',
+                 'trace', 'team_mode', 'ratings', 'shared_key', 'writes')
+
+    def __init__(self, session_id, channel, member_ids, last_activity, inbox, trace=None, team_mode=False, ratings=None):
+        self.session_id = session_id
+        self.channel = channel
+        # VC参加者のユーザーID（この人たち以外の操作は無視する）
+        self.member_ids = frozenset(member_ids)
+        self.settings = ExclusionSettings()
+        self.executed = False
+        self.last_activity = last_activity
+        self.inbox = inbox
+        self.view = None
+        # 再接続時の照合も同じタイムラインに記録する
+        self.trace = trace
+        self.team_mode = team_mode
+        self.ratings = ratings or {}
+        # セッション状態の保存先のキーと、保存先への書き込み（受け取った順に1つずつ行う）
+        self.shared_key = None
+        self.writes = OrderedTasks("除外設定の保存")
+
+
+class SecretSession:
+    """
+    進行中の /secret_role のセッション
+    """
+    __slots__ = ('embed', 'role_mapping', 'selected', 'picks', 'warnings', 'status', 'closed', 'inbox',
+                 'status_message', 'shared_key', 'claims')
+
+    def __init__(self, embed, role_mapping):
+        self.embed = embed
+        # 数字の絵文字 → (ロール番号, ロールキー)
+        self.role_mapping = role_mapping
+        # 選択済みのロール番号のビットマスク
+        self.selected = 0
+        # 確定した (ユーザーID, 表示名, ロールキー)。1人1ロールまで
+        self.picks = []
+        # ユーザーID → 選べなかった時の注意
+        self.warnings = {}
+        # 終了時に表示する (見出し, 本文)
+        self.status = None
+        self.closed = False
+        self.inbox = None
+        self.status_message = None
+        # セッション状態の保存先のキー（選択はここで不可分に確定する）
+        self.shared_key = None
+        # 受け取った順に確定する選択
+        self.claims = OrderedTasks("ロールの選択の確定")
+
+    @property
+    def complete(self):
+        return bin(self.selected).count('1') >= len(self.role_mapping)
@@ -0,0 +1,143 @@
+"""
+ボタン・セレクトメニューによるセッションUI
+
+リアクションを1つずつ追加する代わりに、メッセージ作成と同時にUIを付けられる。
+押されたボタンはリアクションの追加・削除と同じ ReactionEvent に変換して
+handler に渡すので、各セッションの監視処理はリアクション方式と共通のまま使える。
+"""
+import discord
+
+from reaction_router import ReactionEvent
+
+
+class SessionView(discord.ui.View):
+    """
+    ボタン操作をリアクションイベントとしてセッションに渡すView
+
+    allowed_user_ids を指定すると、それ以外のユーザーの操作は断る。
+    """
+
+    def __init__(self, handler, allowed_user_ids=None):
+        # セッションの寿命は監視処理が管理するので、View自体はタイムアウトさせない
+        super().__init__(timeout=None)
+        self.handler = handler
+        self.allowed_user_ids = allowed_user_ids
+        # (ユーザーID, 絵文字) → 押されている状態か（トグルボタン用）
+        self.pressed = set()
+
+    async def interaction_check(self, interaction):
+        if self.allowed_user_ids is not None and interaction.user.id not in self.allowed_user_ids:
+            await interaction.response.send_message("⚠️ このロール決めの対象者ではありません。", ephemeral=True)
+            return False
+        return True
+
+    def emit(self, user, emoji, added):
+        if added:
+            self.pressed.add((user.id, emoji))
+        else:
+            self.pressed.discard((user.id, emoji))
+        self.handler(ReactionEvent(emoji, user.id, user, added))
+
+    def disable_all(self):
+        for item in self.children:
+            item.disabled = True
+        self.stop()
+
+
+class ToggleButton(discord.ui.Button):
+    """
+    押すたびにリアクションの追加・削除を切り替えるボタン
+    """
+
+    def __init__(self, emoji, label=None, row=None):
+        super().__init__(style=discord.ButtonStyle.secondary, emoji=emoji, label=label, row=row)
+        self.reaction_emoji = emoji
+
+    async def callback(self, interaction):
+        added = (interaction.user.id, self.reaction_emoji) not in self.view.pressed
+        self.view.emit(interaction.user, self.reaction_emoji, added)
+        text = "を選択しました" if added else "の選択を取り消しました"
+        await interaction.response.send_message(f"{self.reaction_emoji} {text}", ephemeral=True)
+
+
+class ActionButton(discord.ui.Button):
+    """
+    押すとリアクションの追加として扱われるボタン（抽選開始・数字の確定など）
+    """
+
+    def __init__(self, emoji, label=None, style=discord.ButtonStyle.primary, row=None):
+        super().__init__(style=style, emoji=emoji, label=label, row=row)
+        self.reaction_emoji = emoji
+
+    async def callback(self, interaction):
+        self.view.emit(interaction.user, self.reaction_emoji, True)
+        await interaction.response.defer()
+
+
+class ExclusionSelect(discord.ui.Select):
+    """
+    やりたくないロールをまとめて選ぶセレクトメニュー
+
+    前回の選択との差分をリアクションの追加・削除として渡す。
+    """
+
+    def __init__(self, role_options, row=None):
+        options = [
+            discord.SelectOption(label=label, value=emoji, emoji=emoji)
+            for emoji, label in role_options
+        ]
+        super().__init__(
+            placeholder="やりたくないロールを選択（複数可）",
+            min_values=0,
+            max_values=len(options),
+            options=options,
+            row=row
+        )
+        self.labels = dict(role_options)
+
+    async def callback(self, interaction):
+        user = interaction.user
+        selected = set(self.values)
+        for emoji in self.labels:
+            was_selected = (user.id, emoji) in self.view.pressed
+            if (emoji in selected) != was_selected:
+                self.view.emit(user, emoji, emoji in selected)
+
+        if selected:
+            excluded_text = ", ".join([self.labels[emoji] for emoji in self.labels if emoji in selected])
+            text = f"🚫 除外: {excluded_text}"
+        else:
+            text = "✅ 除外なし（全ロールOK）"
+        await interaction.response.send_message(text, ephemeral=True)
+
+
+def lottery_view(handler, number_emojis):
+    """
+    /role 用: 数字ボタン（参加表明のトグル）と抽選開始ボタン
+    """
+    view = SessionView(handler)
+    for emoji in number_emojis:
+        view.add_item(ToggleButton(emoji, row=0))
+    view.add_item(ActionButton('🎲', label="抽選開始", style=discord.ButtonStyle.success, row=1))
+    return view
+
+
+def secret_selection_view(handler, number_emojis, allowed_user_ids):
+    """
+    /secret_role 用: 押すと即座にロールが確定する数字ボタン
+    """
+    view = SessionView(handler, allowed_user_ids)
+    for emoji in number_emojis:
+        view.add_item(ActionButton(emoji, style=discord.ButtonStyle.secondary, row=0))
+    return view
+
+
+def exclusion_view(handler, role_options, allowed_user_ids):
+    """
+    /exclude_role 用: 除外ロールのセレクトメニュー、不参加トグル、実行開始ボタン
+    """
+    view = SessionView(handler, allowed_user_ids)
+    view.add_item(ExclusionSelect(role_options, row=0))
+    view.add_item(ToggleButton('❌', label="不参加", row=1))
+    view.add_item(ActionButton('▶️', label="ロール分け実行", style=discord.ButtonStyle.success, row=1))
+    return view
@@ -0,0 +1,153 @@
+"""
+10人カスタム用のチーム分け
+
+10人を5人ずつの2チームに分け、各チームで全ロールを1人ずつ担当させる。
+各プレイヤーの担当可能ロール（ビットマスク）を両チームとも守れる分け方のうち、
+レートの合計の差が最も小さいものを選ぶ。
+
+分け方は C(10,5) = 252 通り（左右を入れ替えたものを同一視すると126通り）しかないので、
+- 全ての5人組のビットマスク（人数ごとに一度だけ作る）
+- 部分集合ごとのレート合計の表（1024通りを1回の走査で作る）
+- 部分集合ごとの割り当て可否の表（同じく1回の走査で、使用済みロール集合をビット列でまとめて更新する）
+を引くだけで、全ての分け方をまとめて採点する。
+"""
+import functools
+import itertools
+import random
+
+from role_matching import sample_assignment
+
+# 同点とみなすレート差の誤差
+RATING_EPSILON = 1e-9
+
+
+@functools.lru_cache(maxsize=None)
+def team_combinations(n_players, team_size):
+    """
+    n_players 人から team_size 人を選ぶ組み合わせの (ビットマスク, メンバー番号) の一覧
+    """
+    return tuple(
+        (sum(1 << p for p in members), members)
+        for members in itertools.combinations(range(n_players), team_size)
+    )
+
+
+def subset_sums(values):
+    """
+    sums[mask] = mask に含まれる要素の値の合計 となる表
+    """
+    sums = [0] * (1 << len(values))
+    for mask in range(1, len(sums)):
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + values[low.bit_length() - 1]
+    return sums
+
+
+@functools.lru_cache(maxsize=None)
+def _lacking_role(n_roles):
+    # lacking[r] = ロール r を含まないロール集合 u のビット（1 << u）を全て立てたもの
+    return tuple(
+        sum(1 << used for used in range(1 << n_roles) if not used >> r & 1)
+        for r in range(n_roles)
+    )
+
+
+def reachable_role_sets(allowed_masks, n_roles):
+    """
+    reach[mask] = mask のプレイヤーに異なるロールを割り当てた時の、使用済みロール集合 u の全体
+    （1 << u のビットを立てた整数。0 なら割り当て不可能）となる表
+
+    subset_sums と同じく1回の走査で作る。プレイヤーを1人加えると、担当可能なロール r ごとに
+    「r を使っていない集合」を r の分だけずらす（u → u | 1 << r）ので、全ての集合を1回のビット演算でまとめて進める。
+    """
+    lacking = _lacking_role(n_roles)
+    roles = [[(lacking[r], 1 << r) for r in range(n_roles) if mask >> r & 1] for mask in allowed_masks]
+    reach = [0] * (1 << len(allowed_masks))
+    reach[0] = 1
+    for mask in range(1, len(reach)):
+        low = mask & -mask
+        previous = reach[mask ^ low]
+        if not previous:
+            continue
+        current = 0
+        for lacks, shift in roles[low.bit_length() - 1]:
+            current |= (previous & lacks) << shift
+        reach[mask] = current
+    return reach
+
+
+def score_splits(allowed_masks, ratings, index):
+    """
+    全ての分け方のうち、両チームとも割り当て可能なものを採点する
+
+    戻り値は (チームAのマスク, チームBのマスク, レート差) のリスト。
+    左右を入れ替えただけの分け方は、プレイヤー0がいる側をチームAとして1回だけ数える。
+    """
+    n_players = len(allowed_masks)
+    full = (1 << n_players) - 1
+    reach = reachable_role_sets(allowed_masks, index.n_roles)
+    sums = subset_sums(ratings)
+    total = sums[full]
+    return [
+        (mask, full ^ mask, abs(2 * sums[mask] - total))
+        for mask, _ in team_combinations(n_players, n_players // 2)
+        if mask & 1 and reach[mask] and reach[full ^ mask]
+    ]
+
+
+def choose_split(allowed_masks, index, ratings=None, rng=None):
+    """
+    レート差が最小の分け方を1つ選ぶ（同点の分け方からは一様にランダム）
+
+    戻り値は (チームAのプレイヤー番号リスト, チームBのプレイヤー番号リスト, レート差)。
+    人数が奇数、またはどう分けても割り当て不可能なら None。
+    """
+    rng = rng or random
+    n_players = len(allowed_masks)
+    if n_players == 0 or n_players % 2:
+        return None
+    if ratings is None:
+        ratings = [0] * n_players
+
+    splits = score_splits(allowed_masks, ratings, index)
+    if not splits:
+        return None
+    best = min(difference for _, _, difference in splits)
+    team_a, team_b, difference = rng.choice(
+        [split for split in splits if split[2] - best <= RATING_EPSILON]
+    )
+    # プレイヤー0が常にチームAにならないよう左右もランダムに
+    if rng.random() < 0.5:
+        team_a, team_b = team_b, team_a
+    members = [[p for p in range(n_players) if team >> p & 1] for team in (team_a, team_b)]
+    return members[0], members[1], difference
+
+
+def assign_teams(allowed_masks, index, ratings=None, rng=None):
+    """
+    チームを分け、各チーム内でロールを割り当てる
+
+    戻り値は [(チームのプレイヤー番号リスト, 各プレイヤーのロール番号リスト), ...] とレート差。
+    割り当て不可能なら None。
+    """
+    rng = rng or random
+    split = choose_split(allowed_masks, index, ratings, rng)
+    if split is None:
+        return None
+    team_a, team_b, difference = split
+    teams = []
+    for members in (team_a, team_b):
+        # チーム内は有効な割り当て全体から一様に選ぶ
+        roles = sample_assignment([allowed_masks[p] for p in members], index.n_roles, rng)
+        teams.append((members, roles))
+    return teams, difference
+
+
+def scarce_roles(allowed_masks, n_roles, n_teams=2):
+    """
+    担当できるプレイヤーがチーム数より少ないロールの番号一覧（割り当て不可能の原因の目安）
+    """
+    return [
+        r for r in range(n_roles)
+        if sum(1 for mask in allowed_masks if mask >> r & 1) < n_teams
+    ]
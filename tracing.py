@@ -0,0 +1,194 @@
+"""
+セッションごとの処理のタイムライン記録
+
+「抽選に時間がかかった」時に、どの段階（メッセージ送信、リアクション追加、
+メッセージ再取得、待機など）で時間を使ったかを見るために、
+1回のセッションの各段階を区間（span）として記録し、ファイルに書き出す。
+
+- Chrome のトレース形式（chrome://tracing や Perfetto で開ける）
+- 区間を並べただけの JSON
+のどちらかで書き出せる。
+
+記録中のセッションは contextvars で辿るので、記録していない時の span() は
+コンテキスト変数を1回読むだけで何もしない。
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import time
+import uuid
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+_NULL_SPAN = contextlib.nullcontext()
+
+# 書き出し先のディレクトリ（None なら記録しない）と形式
+_directory = None
+_format = 'chrome'
+
+
+def configure(directory, fmt='chrome'):
+    """
+    記録を有効にする。directory が None なら無効
+    """
+    global _directory, _format
+    if fmt not in ('chrome', 'json'):
+        raise ValueError(f"未対応のトレース形式です: {fmt}")
+    _directory = directory
+    _format = fmt
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+class Trace:
+    """
+    1回のセッションで記録した区間の一覧
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.started_at = time.time()
+        self._origin = time.perf_counter()
+        # [名前, 開始(µs), 長さ(µs), タスク番号, 属性]
+        self.spans = []
+        self._task_ids = {}
+
+    def begin(self, name, attrs):
+        task = asyncio.current_task()
+        task_id = self._task_ids.setdefault(id(task), len(self._task_ids))
+        record = [name, (time.perf_counter() - self._origin) * 1e6, None, task_id, attrs]
+        self.spans.append(record)
+        return record
+
+    def end(self, record, **attrs):
+        record[2] = (time.perf_counter() - self._origin) * 1e6 - record[1]
+        if attrs:
+            record[4].update(attrs)
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        record = self.begin(name, attrs)
+        try:
+            yield record
+        except BaseException as e:
+            record[4]['error'] = repr(e)
+            raise
+        finally:
+            self.end(record)
+
+    def to_chrome(self):
+        events = [
+            {
+                'name': name, 'ph': 'X', 'ts': start, 'dur': duration if duration is not None else 0,
+                'pid': 1, 'tid': task_id, 'args': attrs
+            }
+            for name, start, duration, task_id, attrs in self.spans
+        ]
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'kind': self.kind, 'trace_id': self.trace_id, 'started_at': self.started_at}
+        }
+
+    def to_timeline(self):
+        return {
+            'kind': self.kind,
+            'trace_id': self.trace_id,
+            'started_at': self.started_at,
+            'spans': [
+                {
+                    'name': name,
+                    'start_ms': round(start / 1e3, 3),
+                    'duration_ms': round(duration / 1e3, 3) if duration is not None else None,
+                    'task': task_id,
+                    'attrs': attrs
+                }
+                for name, start, duration, task_id, attrs in sorted(self.spans, key=lambda span: span[1])
+            ]
+        }
+
+    def export(self, directory, fmt='chrome'):
+        data = self.to_chrome() if fmt == 'chrome' else self.to_timeline()
+        started = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))
+        path = os.path.join(directory, f"{self.kind}_{started}_{self.trace_id}.{fmt}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, default=str)
+        return path
+
+
+def span(name, **attrs):
+    """
+    記録中のセッションがあれば区間を記録する with 文用のオブジェクト
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return _NULL_SPAN
+    return trace.span(name, **attrs)
+
+
+@contextlib.contextmanager
+def activate(trace):
+    """
+    別のタスク（再接続時の照合など）で、あるセッションの記録を続ける
+    """
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+
+
+def traced(kind):
+    """
+    コマンドの処理全体を1つのセッションとして記録し、終わったら書き出す
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if _directory is None:
+                return await func(*args, **kwargs)
+            trace = Trace(kind)
+            token = current_trace.set(trace)
+            try:
+                with trace.span(kind):
+                    return await func(*args, **kwargs)
+            finally:
+                current_trace.reset(token)
+                try:
+                    trace.export(_directory, _format)
+                except OSError as e:
+                    print(f"トレースの書き出しに失敗しました: {e}")
+        return wrapper
+    return decorator
+
+
+def http_trace(trace_config=None):
+    """
+    記録中のセッションの REST 呼び出しを区間として記録する aiohttp.TraceConfig
+    """
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        trace = current_trace.get()
+        context.trace = trace
+        if trace is not None:
+            context.trace_span = trace.begin(f"{params.method} {params.url.path}", {})
+
+    async def on_request_end(session, context, params):
+        if context.trace is not None:
+            context.trace.end(context.trace_span, status=params.response.status)
+
+    async def on_request_exception(session, context, params):
+        if context.trace is not None:
+            context.trace.end(context.trace_span, error=repr(params.exception))
+
+    if trace_config is None:
+        trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config